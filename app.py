@@ -1,14 +1,17 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
-from pysqlgen.apputils import app_state_to_opts, get_trigger, \
-    standard_query_to_panel_indices, standard_query_to_opts, get_query_from_index
-from pysqlgen.utils import not_none, cur_time_ms
-import pysqlgen.query
+from dash.dependencies import Input, Output, State, ClientsideFunction, ALL, MATCH
+from dash.exceptions import PreventUpdate
+import time
+from pysqlgen.apputils import app_state_to_opts, get_trigger, field_options, \
+    field_option_tables, standard_query_to_opts, standard_query_to_panel_indices, \
+    get_query_from_index
+from pysqlgen.api import register_api
+from pysqlgen.compiled import canonical_order, spec_key
+from pysqlgen.querylog import QueryLog
 
 import decovid
-from decovid import standard_queries
 
 # --------- "GLOBALS" -------------------------------------------------
 main_text_style = {'text-align': 'center', 'max-width': '800px', 'margin': 'auto'}
@@ -21,73 +24,111 @@ main_div_style = {'margin':'auto', 'padding-left': '100px', 'padding-right': '10
 
 
 # --------- DATA ------------------------------------------------------
-primary_fields = decovid.opts_primary
-primary_fields[0].set_aggregation('count')
-secondary_fields = decovid.opts_secondary
+# The catalog is reloaded in the background when db_fields.yaml / decovid.py change;
+# each callback uses whichever version is current when it is called.
+catalog_manager = decovid.catalog_manager()
+catalog_manager.start()
+sql_table = decovid.load_sql_table()   # None if not compiled (or out of date)
+query_log = QueryLog(decovid.query_log_file)    # every query generated (see README)
 debug_ui = False
 print("BEGIN")
 
+
+def current_fields():
+    catalog = catalog_manager.current
+    return catalog['opts_primary'], catalog['opts_secondary']
+
+
+def current_standard_queries():
+    return catalog_manager.current['standard_queries']
+
+
+def generate_sql(use_opts, allow_coalesce):
+    # The secondary fields are put in canonical order, so the SQL is the same
+    # whether it is served from the compiled table or generated live.
+    use_opts = canonical_order(use_opts)
+    catalog = catalog_manager.current
+    start = time.perf_counter()
+    sql, source = None, 'table'
+    if sql_table is not None and catalog.version == 0:    # (table is stale on reload)
+        sql = sql_table.get(spec_key(use_opts, catalog['opts_primary'],
+                                     catalog['opts_secondary'], allow_coalesce))
+    if sql is None:
+        sql, source = catalog_manager.construct_query(
+            *use_opts, allow_coalesce=allow_coalesce), 'live'
+    query_log.record(use_opts, 1e3 * (time.perf_counter() - start),
+                     allow_coalesce=allow_coalesce, source=source)
+    return sql
+
+
 # --------- DEFINE INPUT ----------------------------------------------
 dropdown_sQuery = dcc.Dropdown(
             id='dropdown-squery', optionHeight=30,
             options=[{'label': k, 'value': i}
-                     for i, (k, v) in enumerate(standard_queries.items())],
-            style={'font-size': '13px'}, value=0)
-dropdown_Primary = dcc.Dropdown(
-            id='dropdown-primary',
-            options=[{'label': opt.item, 'value': i}
-                     for i, opt in enumerate(primary_fields)],
+                     for i, (k, v) in enumerate(current_standard_queries().items())],
             style={'font-size': '13px'}, value=0)
-dropdown_Primary_trans = dcc.Dropdown(
-            id='dropdown-primary-trans',
-            options=[
-                {'label': '<None>', 'value': 0}
-            ], style={'font-size': '13px'}, value=0)
-dropdown_Primary_agg = dcc.Dropdown(
-            id='dropdown-primary-agg',
-            options=[
-                {'label': '<None>', 'value': 0},
-                {'label': 'Count', 'value': 1}
-            ], style={'font-size': '13px'}, value=0)
-primary_stack = dcc.Store(id='stack-primary')
-
-
-secondary_var_options = [{'label': '<None>', 'value': 0}]
-secondary_var_options.extend([{'label': opt.item, 'value': i+1} for i, opt in
-                              enumerate(secondary_fields)])
-
-def construct_dropdowns(id, opts):
-    opts = [None, *opts]
-    return dcc.Dropdown(id=id, optionHeight=25,
-                        options=secondary_var_options,
-                        style={'font-size': '13px'}, value=0), \
-           dcc.Dropdown(id=id+'-trans', optionHeight=25,
-                        options=[{'label': '<None>', 'value': 0}],
-                        style={'font-size': '13px'}, value=None), \
-           dcc.Dropdown(id=id+'-agg', optionHeight=25,
-                        options=[{'label': '<None>', 'value': 0}],
-                        style={'font-size': '13px'}, value=None)
-
-
-def construct_checkbox(id):
-    return dcc.Checklist(id=id,
-                         options=[{'label': '', 'value': 1}], value=[])
-
-
-num_secondary = 4
-secondary_dropdown_div = []
-for i in range(num_secondary):
-    # create a row of secondary variable dropdowns
-    dropdowns = construct_dropdowns('dropdown-' + str(i), secondary_fields)
-    secondary_dropdown_div.append(
-        html.Div([
-                html.Div(dropdowns[0], className="four columns"),
-                html.Div(dropdowns[1], className="three columns"),
-                html.Div(dropdowns[2], className="three columns"),
-                html.Div(construct_checkbox(f'check-{i}'), className="one column")
-            ], className="row", style={'padding-bottom': '15px'})
-    )
-secondary_stacks = [dcc.Store(id=f'stack-{i}') for i in range(num_secondary)]
+
+
+# Each row of dropdowns has pattern-matching ids {'type': <kind>, 'row': i}, where
+# row 0 is the primary variable, so that a single callback serves any number of rows.
+num_secondary = 4   # (initial number of secondary rows: more may be added)
+row_kinds = ['field', 'trans', 'agg', 'check']
+
+
+def construct_row(i, opts, row=None):
+    """
+    The row of dropdowns for row `i` (0: the primary variable) with fields `opts`,
+    and the indices `row` (field, transformation, aggregation[, name]) selected.
+    If `row` is None, the first field (primary), or no field (secondary) is
+    selected.
+    """
+    is_primary = i == 0
+    field_opts = [{'label': opt.item, 'value': j + (not is_primary)}
+                  for j, opt in enumerate(opts)]
+    if not is_primary:
+        field_opts.insert(0, {'label': '<None>', 'value': 0})
+    val = row[0] if row is not None else 0
+    opt = opts[val] if is_primary else (opts[val - 1] if val else None)
+
+    none_option = [{'label': '<None>', 'value': 0}]
+    if opt is None:
+        trans, agg = (none_option, -1, True), (none_option, -1, True)
+        check = ([{'label': '', 'value': 1, 'disabled': True}], [])
+    else:
+        o = field_options(opt)
+        trans = (o['trans'], o['trans_default'] if row is None else row[1],
+                 o['trans_disabled'])
+        agg = (o['agg'], o['agg_default'] if row is None else row[2], o['agg_disabled'])
+        check = ([{'label': '', 'value': 1,
+                   'disabled': is_primary or not o['has_lkp']}],
+                 [1] if (row is not None and not is_primary and row[3]) else [])
+
+    def dropdown(kind, options, value, disabled=False):
+        return dcc.Dropdown(id={'type': kind, 'row': i}, optionHeight=25,
+                            options=options, value=value, disabled=disabled,
+                            style={'font-size': '13px'})
+
+    return html.Div([
+            html.Div(dropdown('field', field_opts, val), className="four columns"),
+            html.Div(dropdown('trans', *trans), className="three columns"),
+            html.Div(dropdown('agg', *agg), className="three columns"),
+            # (the primary variable has no name lookup: its checkbox is hidden)
+            html.Div(dcc.Checklist(id={'type': 'check', 'row': i}, options=check[0],
+                                   value=check[1]),
+                     className="one column",
+                     style={'display': 'none'} if is_primary else {})
+        ], className="row", style={'padding-bottom': '15px'})
+
+
+def construct_secondary_rows(opts, rows=()):
+    return [construct_row(i + 1, opts, rows[i] if i < len(rows) else None)
+            for i in range(max(num_secondary, len(rows)))]
+
+
+def standard_query_rows(query_ix, primary_fields, secondary_fields):
+    query = get_query_from_index(query_ix, current_standard_queries())
+    return standard_query_to_panel_indices(query, primary_fields, secondary_fields)
+
 
 # --------- COPY ------------------------------------------------------
 
@@ -113,70 +154,75 @@ add more.
 # external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__) #, external_stylesheets=external_stylesheets)
 server = app.server
+# JSON API for machine clients: /api/sql
+register_api(server, catalog_manager, query_log=query_log)
 
 custom_space = lambda x: html.Div([html.Br()], style={'line-height': f'{x}%'})
 
-app.layout = html.Div([
-    dcc.Markdown(children=introduction, style=main_text_style, className="row"),
-    html.Br(),
-    html.Div([
+def serve_layout():
+    # (a function, so that each page load shows the current catalog)
+    primary_fields, secondary_fields = current_fields()
+    rows = standard_query_rows(0, primary_fields, secondary_fields)
+    return html.Div([
+        dcc.Markdown(children=introduction, style=main_text_style, className="row"),
+        html.Br(),
         html.Div([
+            html.Div([
+                    html.Div([
+                        dcc.Markdown("**Standard query**:", style=tab_header_text_style,
+                                     className="four columns"),
+                        html.Div(dropdown_sQuery, className="six columns"),
+                    ], className="row"),
+                    html.Br(),
+                    html.Button(id='submit-button-standard', n_clicks=0,
+                                children='Submit', className="four offset-by-four columns"),
+                    html.Div([dcc.Checklist(id='check-keep-nulls',
+                                            options=[{'label': ' Replace NULLs', 'value': 1}],
+                                            value=[1])],
+                                  className="four columns")
+                ], className="row", style={'background-color': '#EEEEEE', 'padding': '10px'}
+            ),
+            html.Br(),
+            html.Div([
                 html.Div([
-                    dcc.Markdown("**Standard query**:", style=tab_header_text_style,
+                    dcc.Markdown("&nbsp;&nbsp;**Customise**:"),
+                    html.Br(),
+                    dcc.Markdown("Primary variable:", style=tab_header_text_style,
+                                 className="four columns"),
+                    dcc.Markdown("Transform:", style=tab_header_text_style,
+                                 className="three columns"),
+                    dcc.Markdown("Aggregation:", style=tab_header_text_style,
                                  className="four columns"),
-                    html.Div(dropdown_sQuery, className="six columns"),
+                    dcc.Markdown("Name:", style=tab_header_text_style,
+                                 className="one column")
                 ], className="row"),
+                custom_space(30),
+                html.Div(construct_row(0, primary_fields, rows[0]), id='primary-row'),
                 html.Br(),
-                html.Button(id='submit-button-standard', n_clicks=0,
-                            children='Submit', className="four offset-by-four columns"),
-                html.Div([dcc.Checklist(id='check-keep-nulls',
-                                        options=[{'label': ' Replace NULLs', 'value': 1}],
-                                        value=[1])],
-                              className="four columns")
-            ], className="row", style={'background-color': '#EEEEEE', 'padding': '10px'}
-        ),
-        html.Br(),
-        html.Div([
-            html.Div([
-                dcc.Markdown("&nbsp;&nbsp;**Customise**:"),
+                html.Div([
+                    dcc.Markdown("Secondary variables:", style=tab_header_text_style,
+                                 className="four columns"),
+                ], className="row"),
+                custom_space(30),
+                html.Div(construct_secondary_rows(secondary_fields, rows[1:]),
+                         id='secondary-rows'),
+                html.Button(id='add-row', n_clicks=0, children='Add variable'),
                 html.Br(),
-                dcc.Markdown("Primary variable:", style=tab_header_text_style,
-                             className="four columns"),
-                dcc.Markdown("Transform:", style=tab_header_text_style,
-                             className="three columns"),
-                dcc.Markdown("Aggregation:", style=tab_header_text_style,
-                             className="four columns"),
-                dcc.Markdown("Name:", style=tab_header_text_style,
-                             className="one column")
-            ], className="row"),
-            custom_space(30),
-            html.Div([
-                html.Div(dropdown_Primary, className="four columns"),
-                html.Div(dropdown_Primary_trans, className="three columns"),
-                html.Div(dropdown_Primary_agg, className="three columns"),
-            ], className="row"),
-            html.Br(),
-            html.Div([
-                dcc.Markdown("Secondary variables:", style=tab_header_text_style,
-                             className="four columns"),
-            ], className="row"),
-            custom_space(30),
-            *secondary_dropdown_div,
-            html.Br(),
-            html.Button(id='submit-button', n_clicks=0, children='Submit')
-        ], style={'background-color': '#EEEEEE', 'padding': '10px'})
-    ], className="four columns"),
-    html.Div([
-        html.Div(id='sql-output-container')
-        ], className="six columns", style={'border': 'solid #CCCCCC 1px',
-                                           'padding': '10px'}),
-    primary_stack,
-    *secondary_stacks
-
-])
-
+                html.Br(),
+                html.Button(id='submit-button', n_clicks=0, children='Submit')
+            ], style={'background-color': '#EEEEEE', 'padding': '10px'})
+        ], className="four columns"),
+        html.Div([
+            html.Div(id='sql-output-container')
+            ], className="six columns", style={'border': 'solid #CCCCCC 1px',
+                                               'padding': '10px'}),
+        # option tables for the client side callbacks.
+        dcc.Store(id='field-tables',
+                  data=field_option_tables(primary_fields, secondary_fields))
+    ])
 
 
+app.layout = serve_layout
 
 
 # --------- REACTIVE -------------------------------------------------
@@ -187,14 +233,9 @@ app.layout = html.Div([
 # (note that each output may currently have a max
 #  of ONE function to change it, and hence must
 #  share the same function if needed :( )
-all_states = [State('dropdown-primary', 'value'),
-               State('dropdown-primary-trans', 'value'),
-               State('dropdown-primary-agg', 'value')]
-for i in range(num_secondary):
-    all_states.extend([State(f'dropdown-{i}', 'value'),
-                   State(f'dropdown-{i}-trans', 'value'),
-                   State(f'dropdown-{i}-agg', 'value'),
-                   State(f'check-{i}', 'value')])
+# The rows are read with ALL wildcards, so this is one callback however many rows.
+all_states = [State({'type': kind, 'row': ALL}, 'value') for kind in row_kinds]
+all_states.append(State({'type': 'field', 'row': ALL}, 'id'))
 all_states.append(State(f'dropdown-squery', 'value'))
 all_states.append(State('check-keep-nulls', 'value'))
 
@@ -202,10 +243,10 @@ all_states.append(State('check-keep-nulls', 'value'))
               [Input('submit-button', 'n_clicks'),
                Input('submit-button-standard', 'n_clicks')],
               all_states)
-def update_output(n_clicks1, n_clicks2, *args):
+def update_output(n_clicks1, n_clicks2, fields, trans, aggs, checks, ids, query_ix,
+                  replace_nulls):
 
-    replace_nulls = args[-1]
-    args = args[:-1]
+    primary_fields, secondary_fields = current_fields()
 
     # which button called the function?
     ctx = dash.callback_context
@@ -215,17 +256,17 @@ def update_output(n_clicks1, n_clicks2, *args):
         button_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
     if button_id == 'submit-button-standard':
-        query = get_query_from_index(args[-1], standard_queries)
+        query = get_query_from_index(query_ix, current_standard_queries())
         use_opts, dbg_str = standard_query_to_opts(query, primary_fields,
                                                    secondary_fields)
     else:
-        print(args)
-        use_opts, dbg_str = app_state_to_opts(args[:-1], primary_fields, secondary_fields)
+        # one row per field dropdown (in row order; the primary row has no name flag)
+        rows = sorted(zip([x['row'] for x in ids], fields, trans, aggs, checks))
+        rows = [r[1:4] if r[0] == 0 else r[1:] for r in rows]
+        use_opts, dbg_str = app_state_to_opts(rows, primary_fields, secondary_fields)
 
-    print(use_opts)
     if len(use_opts) > 0:
-        print(f"Create query with {len(use_opts)} fields selected")
-        sql = pysqlgen.query.construct_query(*use_opts, allow_coalesce=replace_nulls)
+        sql = generate_sql(use_opts, bool(replace_nulls))
     else:
         sql = "\n\n~~~~ NO VARIABLES SELECTED ~~~~~\n\n"
 
@@ -236,166 +277,47 @@ def update_output(n_clicks1, n_clicks2, *args):
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 ###################################################
-# Update dropdowns based on selected STANDARD QUERY
-#     OR any of the LHS variable dropdowns.
+# Render the rows for the selected STANDARD QUERY,
+#     OR add a new (empty) secondary row.
 ###################################################
-elements_to_update = ['options', 'value', 'disabled']
-dd_types = ['-trans', '-agg']
-primary_outs = [Output(f'dropdown-primary{t}', element)
-                for t in dd_types for element in elements_to_update]
-
-secondary_outs = []
-for i in range(num_secondary):
-    row = []
-    row.extend([Output(f'dropdown-{i}{t}', element) for t in dd_types for element in
-                elements_to_update])
-    row.append(Output(f'check-{i}', 'options'))
-    row.append(Output(f'check-{i}', 'value'))
-    secondary_outs.append(row)
-
-secondary_var_inputs = [Input(f'dropdown-{i}', 'value') for i in range(num_secondary)]
-
-##################
-# PRIMARY VARIABLE
-##################
-@app.callback([Output('dropdown-primary', 'value'),
-               Output('stack-primary', 'data'),
-               Output('stack-primary', 'modified_timestamp')],
-              [Input('submit-button-standard', 'n_clicks')],
-              [State('dropdown-squery', 'value')])
-def update_std_primary(n_clicks, query_ix):
-
-    query = get_query_from_index(query_ix, standard_queries)
-    panel_rows = standard_query_to_panel_indices(query, primary_fields,
-                                                 secondary_fields,
-                                                 as_obj=True)
-    # primary variable
-    first_row = panel_rows[0]
-    trans_id = not_none(first_row.trans_id, 0)
-    agg_id = not_none(first_row.agg_id, 0)
-    push_to_stack = f'{trans_id},{agg_id}'
-
-    return [first_row.item_id, push_to_stack, cur_time_ms()]
-
-
-@app.callback([*primary_outs],
-              [Input(f'dropdown-primary', 'value')],
-              [State('stack-primary', 'data'),
-               State('stack-primary', 'modified_timestamp')])
-def update_dds_primary(val, stack, stack_ts):
-    if val is None:
-        # * User has cleared the Field dropdown using [x]
-        return ([{'label': '<None>', 'value': 0}], -1, True,
-                [{'label': '<None>', 'value': 0}], -1, True)
-
-    cur_time = cur_time_ms()
-    timedelta_s = (cur_time - stack_ts)/1000
-    stale = timedelta_s > 1  # (> 1 seconds since stack last pushed)
-    if stale or (stack is None) or (len(stack) == 0):
-        print(f'Not using primary stack. Timedelta: {timedelta_s}. Contents: {stack}')
-        stackvals = []
-        use_stack = False
-    else:
-        print(f'Using primary stack. Contents: {stack}')
-        try:
-            stackvals = [int(x) for x in stack.split(',')]
-        except Exception as e:
-            print("STACK IS:", stack)
-            raise e
-        assert len(stackvals) == 2, f"stack {stack} is invalid for primary row"
-        use_stack = True
-
-    field = primary_fields[val]
-    out = []
-    trans_ix = stackvals[0] if use_stack else field.default_transformation_ix
-    agg_ix = stackvals[1] if use_stack else field.default_aggregation_ix
-    out.extend([field.transformation_options, trans_ix, field.transformation_is_disabled])
-    out.extend([field.aggregation_options, agg_ix, field.aggregation_is_disabled])
-
-    return out
-
-
-#####################
-# SECONDARY VARIABLES
-#####################
-def _generate_update_std_secondary(i):
-    def update_std(n_clicks, query_ix):
-
-        query = get_query_from_index(query_ix, standard_queries)
-        panel_rows = standard_query_to_panel_indices(query, primary_fields,
-                                                     secondary_fields,
-                                                     as_obj=True)
-        if len(panel_rows) > i+1:
-            row = panel_rows[i+1]
-            ix = row.item_id
-            push_to_stack = f'{row.trans_id},{row.agg_id},{row.perform_lkp}'
-        else:
-            ix = None
-            push_to_stack = ''
-        return [ix, push_to_stack, cur_time_ms()]
-    return update_std
-
-
-for i in range(num_secondary):
-    update_std = _generate_update_std_secondary(i)
-    app.callback([Output(f'dropdown-{i}', 'value'),
-                  Output(f'stack-{i}', 'data'),
-                  Output(f'stack-{i}', 'modified_timestamp')],
-                 [Input('submit-button-standard', 'n_clicks')],
-                 [State('dropdown-squery', 'value')])(update_std)
-
-
-def _generate_update_dds_secondary(i):
-    def update_dds(val, stack, stack_ts):
-        if val is None or val == 0:
-            # EITHER:
-            # * User has cleared the Field dropdown using [x]
-            # * No variable is selected via the <None> field.
-            return ([{'label': '<None>', 'value': 0}], -1, True,
-                    [{'label': '<None>', 'value': 0}], -1, True,
-                    [{'label': '', 'value': 1, 'disabled': True}],
-                    [])
-
-        cur_time = cur_time_ms()
-        timedelta_s = (cur_time - stack_ts) / 1000
-        stale = timedelta_s > 1  # (> 1 seconds since stack last pushed)
-        if stale or (stack is None) or (len(stack) == 0):
-            print(f'Not using stack {i}. Timedelta: {timedelta_s}. Contents: {stack}')
-            stackvals = []
-            use_stack = False
-        else:
-            print(f'Using stack {i}. Timedelta: {timedelta_s}. Contents: {stack}')
-            stacksplit = stack.split(',')
-            stackvals = [int(x) for x in stacksplit[:2]]
-            stackvals.append(stacksplit[2] == 'True')
-            assert len(stackvals) == 3, f"stack {stack} is invalid for secondary row"
-            use_stack = True
-
-
-        field = secondary_fields[val-1]
-        out = []
-        trans_ix = stackvals[0] if use_stack else field.default_transformation_ix
-        agg_ix = stackvals[1] if use_stack else field.default_aggregation_ix
-        chkmark = stackvals[2] if use_stack else False
-        out.extend([field.transformation_options, trans_ix,
-                    field.transformation_is_disabled])
-        out.extend([field.aggregation_options, agg_ix,
-                    field.aggregation_is_disabled])
-
-        chk_disabled = not field.has_dim_lkp
-        out.append([{'label': '', 'value': 1, 'disabled': chk_disabled}])
-        out.append([1] if chkmark else [])  # checklist value
-        # print(out)
-        return out
-    return update_dds
-
-
-for i in range(num_secondary):
-    update_dds = _generate_update_dds_secondary(i)
-    app.callback(secondary_outs[i],
-                 [Input(f'dropdown-{i}', 'value')],
-                 [State(f'stack-{i}', 'data'),
-                  State(f'stack-{i}', 'modified_timestamp')])(update_dds)
+# The rows are rendered with their options and values, so the row callback below
+# need not (and does not) run when they are inserted.
+@app.callback([Output('primary-row', 'children'),
+               Output('secondary-rows', 'children')],
+              [Input('submit-button-standard', 'n_clicks'),
+               Input('add-row', 'n_clicks')],
+              [State('dropdown-squery', 'value'),
+               State('secondary-rows', 'children')],
+              prevent_initial_call=True)
+def update_rows(n_clicks_std, n_clicks_add, query_ix, secondary_rows):
+    primary_fields, secondary_fields = current_fields()
+    if get_trigger() == 'add-row':
+        new_row = construct_row(len(secondary_rows) + 1, secondary_fields)
+        return dash.no_update, [*secondary_rows, new_row]
+    if query_ix is None:
+        raise PreventUpdate    # standard query dropdown has been cleared.
+    rows = standard_query_rows(query_ix, primary_fields, secondary_fields)
+    return construct_row(0, primary_fields, rows[0]), \
+        construct_secondary_rows(secondary_fields, rows[1:])
+
+
+###################################################
+# Update a row's dropdowns when its FIELD changes.
+###################################################
+# A single MATCH callback, run client side (assets/clientside.js) using the option
+# tables in the `field-tables` store.
+app.clientside_callback(
+    ClientsideFunction(namespace='pysqlgen', function_name='update_row'),
+    [Output({'type': 'trans', 'row': MATCH}, element)
+     for element in ['options', 'value', 'disabled']] +
+    [Output({'type': 'agg', 'row': MATCH}, element)
+     for element in ['options', 'value', 'disabled']] +
+    [Output({'type': 'check', 'row': MATCH}, 'options'),
+     Output({'type': 'check', 'row': MATCH}, 'value')],
+    [Input({'type': 'field', 'row': MATCH}, 'value')],
+    [State({'type': 'field', 'row': MATCH}, 'id'),
+     State('field-tables', 'data')],
+    prevent_initial_call=True)
 
 
 # --------- RUN APP -------------------------------------------------
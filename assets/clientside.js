@@ -0,0 +1,31 @@
+// Client-side callbacks for app.py. The dropdown options of every field are
+// computed once on the server (`apputils.field_option_tables`) and held in the
+// `field-tables` store, so the dependent dropdowns are updated without a round
+// trip to the server.
+(function () {
+    var NONE_OPTION = [{'label': '<None>', 'value': 0}];
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        pysqlgen: {
+            // The transformation/aggregation/name dropdowns of a row, set to the
+            // defaults of its field. `id` is the id of the row's field dropdown,
+            // {'type': 'field', 'row': i}; row 0 is the primary variable.
+            update_row: function (val, id, tables) {
+                var is_primary = id.row === 0;
+                if (val === null || val === undefined || (!is_primary && val === 0)) {
+                    // EITHER:
+                    // * User has cleared the Field dropdown using [x]
+                    // * No variable is selected via the <None> field.
+                    return [NONE_OPTION, -1, true, NONE_OPTION, -1, true,
+                            [{'label': '', 'value': 1, 'disabled': true}], []];
+                }
+                var field = is_primary ? tables.primary[val] : tables.secondary[val - 1];
+                return [field.trans, field.trans_default, field.trans_disabled,
+                        field.agg, field.agg_default, field.agg_disabled,
+                        [{'label': '', 'value': 1,
+                          'disabled': is_primary || !field.has_lkp}],
+                        []];
+            }
+        }
+    });
+})();
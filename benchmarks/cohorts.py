@@ -0,0 +1,103 @@
+"""
+Check and time queries restricted to cohorts materialized in temporary tables.
+
+Cohorts (`pysqlgen.cohort.Cohort`) of persons are materialized by a CohortSession
+on a random sample database in SQLite (see `query_shapes.sample_db`). Each of the
+standard queries and random specs, restricted to a cohort by a semi-join on its
+temporary table, must return the same rows as when the cohort is computed inline
+in the query, and the reference counts must drop each table with its last user.
+The times of the queries against the temporary table and inline are reported. Run
+from the repository root:
+
+    python benchmarks/cohorts.py [--specs N] [--rows N]
+
+Exits with a non-zero status if a cohort is empty (its queries would compare only
+empty results), any query returns different rows, or a table is not dropped.
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.cohort import Cohort, CohortSession, CohortTable
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+from query_shapes import sample_db
+from sharded import normalize
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=5000, help='rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    context, fields = decovid.context, decovid.all_fields
+    db = sample_db(context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+    person = decovid.node_lkp['Person']
+    cohorts = {
+        'covid positive': Cohort([(fields['covid_positive'].to_spec(aggregation='max'),
+                                   '= 1')], person),
+        # (the sample's years of birth are 0-100, so its ages are 1920-2020)
+        'measured, age < 1970': Cohort([
+            (fields['measurement_type'].to_spec(aggregation='count', perform_lkp=False),
+             '> 0'),
+            (fields['age'].to_spec(transform=None), '< 1970')], person)}
+
+    def execute(sql):
+        return db.execute(sql).fetchall()
+
+    def temp_tables():
+        return {name for name, in execute("SELECT name FROM sqlite_temp_master "
+                                          "WHERE type = 'table'")}
+
+    failures = 0
+    with CohortSession(execute, dialect='SQLite') as session:
+        for label, cohort in cohorts.items():
+            inline = CohortTable(cohort, f'({cohort.select_sql("SQLite")}) AS i')
+            n, skipped, mismatches = 0, 0, 0
+            elapsed = {'temp table': 0.0, 'inline': 0.0}
+            start = time.perf_counter()
+            with session.use(cohort) as table:
+                materialize = time.perf_counter() - start
+                size = execute(f'SELECT COUNT(*) FROM {table.table}')[0][0]
+                failures += size == 0
+                for opts, allow_coalesce in specs:
+                    rows = {}
+                    try:
+                        for name, t in (('temp table', table), ('inline', inline)):
+                            sql = construct_query(*opts, dialect='SQLite', cohort=t,
+                                                  allow_coalesce=allow_coalesce)
+                            start = time.perf_counter()
+                            rows[name] = normalize(execute(sql))
+                            elapsed[name] += time.perf_counter() - start
+                    except Exception:    # not supported by the planner or by SQLite.
+                        skipped += 1
+                        continue
+                    n += 1
+                    mismatches += rows['temp table'] != rows['inline']
+                with session.use(cohort):   # (a second user of the same table)
+                    pass
+                failures += cohort.name not in temp_tables()
+            failures += cohort.name in temp_tables() or session.references(cohort) != 0
+            failures += mismatches
+            print(f'{label}: {size} persons, materialized in {1e3 * materialize:.1f} ms; '
+                  f'{n} queries ({skipped} skipped), {mismatches} mismatches; ' +
+                  ', '.join(f'{k} {1e3 * v / n:.2f} ms/query' for k, v in elapsed.items()))
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
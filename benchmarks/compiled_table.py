@@ -0,0 +1,77 @@
+"""
+Check and time the compiled SQL table against live query generation.
+
+Random specs (with the secondary fields in a random order) are looked up in the
+compiled table, and every hit is checked to be identical to the SQL generated
+live from the canonical order. Lookup and generation times are reported. First
+compile the table, then run from the repository root:
+
+    python decovid.py --compile-queries 2
+    python benchmarks/compiled_table.py [--specs N]
+
+Exits with a non-zero status if the table is missing/out of date, or if any
+compiled SQL differs from the live SQL.
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.compiled import canonical_order, spec_key
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=2000, help='number of random specs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    table = decovid.load_sql_table()
+    if table is None:
+        print(f'No up-to-date table at {decovid.sql_table_file}: run '
+              f'`python decovid.py --compile-queries` first.')
+        return 1
+    max_secondary = table.header['max_secondary']
+    primary_opts, secondary_opts = decovid.ui_options()
+    specs = random_specs(args.specs, primary_opts, secondary_opts,
+                         max_secondary=max_secondary, seed=args.seed)
+
+    hits, misses, mismatches = 0, 0, 0
+    t_lookup, t_live = 0.0, 0.0
+    for opts, allow_coalesce in specs:
+        start = time.perf_counter()
+        sql = table.get(spec_key(opts, primary_opts, secondary_opts, allow_coalesce))
+        t_lookup += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            live = construct_query(*canonical_order(opts), allow_coalesce=allow_coalesce)
+        except Exception:    # some specs are not supported by the planner.
+            live = None
+        t_live += time.perf_counter() - start
+
+        if sql is None:
+            misses += 1
+            mismatches += live is not None     # compiled table should hold every query.
+        else:
+            hits += 1
+            mismatches += sql != live
+
+    n = len(specs)
+    print(f'{len(table)} queries compiled (max_secondary={max_secondary})')
+    print(f'{hits} hits, {misses} misses (unsupported by the planner), '
+          f'{mismatches} mismatches')
+    print(f'lookup: {1e6 * t_lookup / n:8.1f} us/query')
+    print(f'live:   {1e6 * t_live / n:8.1f} us/query')
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Concurrency stress test for query generation.
+
+N threads each generate SQL for the same M random specs (in a shuffled order),
+and every result is checked to be byte-identical to a serial run. Throughput
+is reported for each thread count so that any scaling (or contention) is
+visible. Run from the repository root:
+
+    python benchmarks/concurrency.py [--specs M] [--threads 1 2 4 8] [--rounds R]
+
+Exits with a non-zero status if any threaded result differs from the serial one.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.fields import FieldSpec
+from pysqlgen.query import construct_query
+
+
+def random_specs(n, primary_opts, secondary_opts, max_secondary=4, seed=0):
+    """
+    Draw `n` random specs (tuples of FieldSpecs) as the UI could produce them.
+    """
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        opt = rng.choice(primary_opts)
+        spec = [FieldSpec(opt, transform=rng.choice(opt.transformations),
+                          aggregation=rng.choice(opt.aggregations), perform_lkp=False,
+                          is_secondary=False)]
+        for _ in range(rng.randint(0, max_secondary)):
+            opt = rng.choice(secondary_opts)
+            spec.append(FieldSpec(opt, transform=rng.choice(opt.transformations),
+                                  aggregation=rng.choice(opt.aggregations),
+                                  perform_lkp=opt.has_dim_lkp and rng.random() < 0.5,
+                                  is_secondary=True))
+        out.append((tuple(spec), rng.random() < 0.5))
+    return out
+
+
+def generate(spec):
+    opts, allow_coalesce = spec
+    try:
+        return construct_query(*opts, allow_coalesce=allow_coalesce)
+    except Exception as e:   # some random specs are not supported by the planner.
+        return f'{type(e).__name__}: {e}'
+
+
+def run_threaded(specs, expected, n_threads, rounds, seed=0):
+    def worker(k):
+        order = list(range(len(specs)))
+        random.Random(seed + k).shuffle(order)
+        mismatches = 0
+        for _ in range(rounds):
+            for i in order:
+                mismatches += generate(specs[i]) != expected[i]
+        return mismatches
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        start = time.perf_counter()
+        mismatches = sum(pool.map(worker, range(n_threads)))
+        elapsed = time.perf_counter() - start
+    return mismatches, n_threads * rounds * len(specs) / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=200, help='number of random specs')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--rounds', type=int, default=3, help='passes per thread')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    specs = random_specs(args.specs, decovid.opts_primary, decovid.opts_secondary,
+                         seed=args.seed)
+    expected = [generate(s) for s in specs]
+
+    failed = False
+    base = None
+    print(f'{"threads":>8} {"queries/s":>12} {"scaling":>8} {"mismatches":>11}')
+    for n in args.threads:
+        mismatches, throughput = run_threaded(specs, expected, n, args.rounds, args.seed)
+        base = throughput if base is None else base
+        failed |= mismatches > 0
+        print(f'{n:>8d} {throughput:>12.1f} {throughput / base:>8.2f} {mismatches:>11d}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
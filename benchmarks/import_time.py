@@ -0,0 +1,56 @@
+"""
+Import-time budget for the core package.
+
+Imports the core modules (schema, spec, planner, renderer) in a fresh
+interpreter, checks that none of the optional dependencies (YAML, Dash/Flask)
+were imported along the way, and that the import time (the best of several
+runs) is within budget. Run from the repository root:
+
+    python benchmarks/import_time.py [--budget-ms 50] [--repeat 5]
+
+Exits with a non-zero status if the budget is exceeded.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+CORE_MODULES = ['pysqlgen.dbtree', 'pysqlgen.fields', 'pysqlgen.query']
+OPTIONAL_MODULES = ['yaml', 'dash', 'flask']
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def measure_import(modules):
+    """
+    Import `modules` in a fresh interpreter. Returns the time taken (seconds) and
+    the optional modules which were imported.
+    """
+    code = ('import sys, time\n' + 't = time.perf_counter()\n' +
+            ''.join(f'import {m}\n' for m in modules) +
+            'print(time.perf_counter() - t)\n' +
+            f'print(",".join(m for m in {OPTIONAL_MODULES!r} if m in sys.modules))')
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    elapsed, loaded = proc.stdout.split('\n')[:2]
+    return float(elapsed), [m for m in loaded.split(',') if m]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--budget-ms', type=float, default=50.)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    times, loaded = [], []
+    for _ in range(args.repeat):
+        t, loaded = measure_import(CORE_MODULES)
+        times.append(t)
+    best_ms = min(times) * 1000
+
+    print(f'core import: {best_ms:.1f} ms (budget {args.budget_ms:.1f} ms)')
+    print(f'optional modules imported: {", ".join(loaded) if loaded else "none"}')
+    return 0 if (best_ms <= args.budget_ms and len(loaded) == 0) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
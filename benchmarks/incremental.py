@@ -0,0 +1,129 @@
+"""
+Check and time the incremental refresh of stored query results.
+
+The standard queries and random specs are added to an AggregateStore
+(`pysqlgen.incremental`) over a random sample database in SQLite (see
+`query_shapes.sample_db`), and the database is then changed in steps: rows with
+later dates are appended to the fact tables, then rows with fractional seconds,
+persons with new IDs are appended, a late-arriving row (with an old date) is
+inserted, and nothing changes. Dates are read as datetimes (as by most drivers),
+so that watermarks are datetimes. After each step the store is refreshed, and the
+rows of every stored query must be the same as those of the query run whole; when
+nothing changes, every query must be unchanged (not rebuilt). The refresh statuses
+('built', 'delta', 'unchanged') and the times of the refresh and of running every
+query whole are reported per step. Run from the repository root:
+
+    python benchmarks/incremental.py [--specs N] [--rows N]
+
+Exits with a non-zero status if any stored query returns different rows, or is
+rebuilt when nothing changed.
+"""
+import argparse
+import collections
+import datetime
+import os
+import re
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.incremental import AggregateStore
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+from query_shapes import sample_db
+from sharded import normalize
+
+
+def append(db, context, node, replace, every):
+    """ Append a copy of every `every`th row of `node`, with columns replaced (SQL) """
+    table = f'{context.schema}.{node.name}'
+    cols = [row[1] for row in db.execute(f'PRAGMA {context.schema}.table_info({node.name})')]
+    select = ', '.join(replace.get(c, c) for c in cols)
+    db.execute(f'INSERT INTO {table} SELECT {select} FROM {table} WHERE rowid % {every} = 0')
+
+
+DATETIME = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d+)?$')
+
+
+def datetimes(rows):
+    """ The `rows` with datetime strings parsed, as a driver would return them """
+    return [tuple(datetime.datetime.fromisoformat(x) if isinstance(x, str) and
+                  DATETIME.match(x) else x for x in row) for row in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=5000, help='rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    context = decovid.context
+    db = sample_db(context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+
+    def execute(sql):
+        return datetimes(db.execute(sql).fetchall())
+
+    store, queries, skipped = AggregateStore(context, dialect='SQLite'), {}, 0
+    for opts, allow_coalesce in specs:
+        try:
+            sql = construct_query(*opts, dialect='SQLite', allow_coalesce=allow_coalesce)
+            db.execute('EXPLAIN ' + sql)
+            key = store.add(*opts, allow_coalesce=allow_coalesce)
+        except Exception:    # not supported by the planner, by SQLite or incrementally.
+            skipped += 1
+            continue
+        queries[key] = sql
+    print(f'{len(queries)} stored queries ({skipped} skipped)')
+
+    later = "'2020-1' || (rowid % 3) || '-15 12:00:00'"
+    subsecond = "'2020-12-20 12:00:00.' || (100000 + rowid % 900000)"
+    facts = [node for node in context.nodes
+             if node.primary_date_field is not None and node.name != 'Visit_Occurrence']
+    persons = next(node for node in context.nodes if node.name == 'Person')
+    steps = [('initial', lambda: None),
+             ('append facts', lambda: [append(db, context, node,
+                                              {node.primary_date_field: later}, 20)
+                                       for node in facts]),
+             ('sub-second', lambda: [append(db, context, node,
+                                            {node.primary_date_field: subsecond}, 20)
+                                     for node in facts]),
+             ('append persons', lambda: append(db, context, persons, {
+                 'person_id': f'person_id + (SELECT MAX(person_id) + 1 '
+                              f'FROM {context.schema}.Person)'}, 10)),
+             ('late arrival', lambda: append(db, context, facts[0], {}, 1000)),
+             ('no change', lambda: None)]
+
+    mismatches = 0
+    for name, change in steps:
+        change()
+        start = time.perf_counter()
+        status = store.refresh(execute)
+        refresh = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = {key: normalize(execute(sql)) for key, sql in queries.items()}
+        whole = time.perf_counter() - start
+        differ = sum(normalize(store.rows(key)) != rows for key, rows in expected.items())
+        mismatches += differ
+        if name == 'no change':
+            mismatches += sum(s != 'unchanged' for s in status.values())
+        counts = collections.Counter(status.values())
+        print(f'{name:>15}: ' + ', '.join(f'{counts[s]} {s}' for s in
+                                          ('built', 'delta', 'unchanged')) +
+              f'; refresh {1e3 * refresh:.0f} ms, whole {1e3 * whole:.0f} ms, '
+              f'{differ} mismatches')
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
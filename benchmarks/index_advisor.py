@@ -0,0 +1,96 @@
+"""
+Check the index recommendations of the advisor against SQLite query plans.
+
+Index recommendations (`pysqlgen.advisor.IndexAdvisor`) are made for a workload of
+the standard queries and random specs, and checked on a random sample database
+in SQLite (see `query_shapes.sample_db`, which indexes each table's first primary
+key). Each query is planned with EXPLAIN QUERY PLAN before and after creating the
+recommended indexes: the number of full table scans, the plans changed and the
+estimated costs (`sqlite_cost`) are reported, and every query must return the same
+rows with the indexes. Run from the repository root:
+
+    python benchmarks/index_advisor.py [--specs N] [--rows N] [--max-indexes N]
+
+Exits with a non-zero status if any query returns different rows.
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.advisor import IndexAdvisor, compare_sqlite_plans
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+from query_shapes import sample_db
+
+
+def scans(plan):
+    """ The number of full scans of (schema) tables in a plan """
+    return sum(line.startswith('SCAN') and 'COVERING INDEX' not in line and
+               'SUBQUERY' not in line and 'CO-ROUTINE' not in line for line in plan)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=2000, help='rows per table')
+    parser.add_argument('--max-indexes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    context = decovid.context
+    db = sample_db(context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+
+    queries, workload = [], []
+    for opts, allow_coalesce in specs:
+        try:
+            sql = construct_query(*opts, dialect='SQLite', allow_coalesce=allow_coalesce)
+            db.execute('EXPLAIN QUERY PLAN ' + sql)
+        except Exception:    # not supported by the planner or by SQLite.
+            continue
+        queries.append(sql)
+        workload.append(opts)
+
+    start = time.perf_counter()
+    advisor = IndexAdvisor()
+    advisor.add_workload(workload)
+    existing = [(node.name, node.pk[:1]) for node in context.nodes]
+    recs = advisor.recommend(max_indexes=args.max_indexes, existing=existing)
+    elapsed = time.perf_counter() - start
+    print(f'{len(recs)} indexes recommended for {advisor.n_queries} queries '
+          f'in {1e3 * elapsed:.1f} ms:')
+    for rec in recs:
+        print(f'  {rec.weight:5d}  {rec.sql("SQLite")}')
+
+    before = [sorted(map(repr, db.execute(sql))) for sql in queries]
+    results = compare_sqlite_plans(db, queries, recs, keep=True)
+    mismatches = sum(sorted(map(repr, db.execute(sql))) != rows
+                     for sql, rows in zip(queries, before))
+
+    changed = sum(b != a for b, a, _, _ in results)
+    scans_before = sum(scans(b) for b, _, _, _ in results)
+    scans_after = sum(scans(a) for _, a, _, _ in results)
+    cost_before = sum(c for _, _, c, _ in results)
+    cost_after = sum(c for _, _, _, c in results)
+    better = sum(a < b for _, _, b, a in results)
+    worse = sum(a > b for _, _, b, a in results)
+    print(f'{len(queries)} queries, {changed} plans changed, {mismatches} mismatches')
+    print(f'table scans: {scans_before} -> {scans_after}')
+    print(f'est. cost:   {cost_before:.0f} -> {cost_after:.0f} '
+          f'({better} queries cheaper, {worse} dearer)')
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""
+Load test of the Dash app's server callbacks, via Flask's test client.
+
+Each worker process imports `app` and runs `--threads` threads, each replaying
+random interaction traces against `app.server` (no browser, no network):
+
+    page load -> select a standard query and Submit -> (maybe add a row) -> edit
+    some of the secondary rows -> Submit
+
+The dependent dropdowns are updated client side (assets/clientside.js), so the
+trace applies the same logic locally, from the `field-tables` store of the
+page; only requests which reach the server are timed. Latency percentiles and
+throughput are reported per callback, along with the growth in resident memory
+of each worker. Run from the repository root:
+
+    python benchmarks/load_app.py [--workers W] [--threads T] [--traces N]
+
+Failed requests (e.g. specs which the planner does not support) are counted.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import warnings
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # (peak)
+
+
+def prop_key(component_id, prop):
+    """ The key of a component property: ids may be strings or (pattern) dicts """
+    if isinstance(component_id, dict):
+        component_id = json.dumps(component_id, sort_keys=True, separators=(',', ':'))
+    return f'{component_id}.{prop}'
+
+
+def initial_callbacks(app):
+    """ The outputs of the callbacks which are called on page load """
+    import dash
+    callback_list = [*getattr(app, '_callback_list', []),
+                     *getattr(getattr(dash, '_callback', None), 'GLOBAL_CALLBACK_LIST', [])]
+    skip = {c['output'] for c in callback_list if c.get('prevent_initial_call')}
+    return set(app.callback_map) - skip
+
+
+class Session:
+    """
+    One browser session: the values of the UI components, and the server
+    callbacks (from `app.callback_map`) which are fired as the user interacts.
+    Component trees returned by the server (the layout, and re-rendered rows) are
+    read for their ids and values, and the client side callbacks are mirrored
+    locally from the `field-tables` store.
+    """
+    containers = ('primary-row', 'secondary-rows')
+
+    def __init__(self, client, app, rng, timings):
+        self.client = client
+        self.rng = rng
+        self.timings = timings       # callback name -> list of latencies (s)
+        self.errors = 0
+        self.props = dict()          # prop key -> value
+        self.ids = dict()            # component id -> container it was rendered in
+        self.initial = initial_callbacks(app)
+        self.callbacks = []
+        for key, cb in app.callback_map.items():
+            func = cb.get('callback')
+            if func is None:
+                continue                # a clientside callback
+            name = getattr(func, '__name__', key)
+            if key.startswith('..'):
+                outputs = [dict(zip(('id', 'property'), o.rsplit('.', 1)))
+                           for o in key[2:-2].split('...')]
+            else:
+                outputs = dict(zip(('id', 'property'), key.rsplit('.', 1)))
+            self.callbacks.append((key, name, outputs, cb['inputs'], cb.get('state', [])))
+
+    def _timed(self, name, request):
+        start = time.perf_counter()
+        response = request()
+        self.timings.setdefault(name, []).append(time.perf_counter() - start)
+        if response.status_code not in (200, 204):
+            self.errors += 1
+        return response
+
+    def absorb(self, tree, container=None):
+        """ Record the ids and values of the components in `tree` """
+        if isinstance(tree, list):
+            for child in tree:
+                self.absorb(child, container)
+        elif isinstance(tree, dict) and 'props' in tree:
+            props = tree['props']
+            component_id = props.get('id')
+            if component_id is not None:
+                self.ids[json.dumps(component_id, sort_keys=True)] = container
+                for prop in ('value', 'options', 'data'):
+                    if prop in props:
+                        self.props[prop_key(component_id, prop)] = props[prop]
+                if component_id in self.containers:
+                    container = component_id
+            self.absorb(props.get('children'), container)
+
+    def replace_children(self, container, children):
+        for k, c in list(self.ids.items()):
+            if c == container:
+                del self.ids[k]
+                component_id = json.loads(k)
+                for prop in ('value', 'options', 'data'):
+                    self.props.pop(prop_key(component_id, prop), None)
+        self.absorb(children, container)
+
+    def rows(self):
+        return sorted(json.loads(k)['row'] for k in self.ids
+                      if k.startswith('{') and json.loads(k).get('type') == 'field')
+
+    def load_page(self):
+        self.props, self.ids = dict(), dict()
+        response = self._timed('serve_layout', lambda: self.client.get('/_dash-layout'))
+        self.absorb(json.loads(response.data))
+        self.tables = self.props[prop_key('field-tables', 'data')]
+        self.props.update({'submit-button.n_clicks': 0,
+                           'submit-button-standard.n_clicks': 0,
+                           'add-row.n_clicks': 0})
+        self.fire(None)                 # initial call of the callbacks on page load
+
+    def expand(self, dependency):
+        """ The dependency, with its value(s) ({'id', 'property', 'value'}) """
+        component_id, prop = dependency['id'], dependency['property']
+        if not component_id.startswith('{'):
+            return dict(dependency, value=self.props.get(prop_key(component_id, prop)))
+        pattern = json.loads(component_id)      # (ALL wildcards only)
+        out = []
+        for k in self.ids:
+            cid = json.loads(k) if k.startswith('{') else None
+            if not isinstance(cid, dict) or cid.keys() != pattern.keys() or \
+                    any(v != cid[f] for f, v in pattern.items() if v != ['ALL']):
+                continue
+            value = cid if prop == 'id' else self.props.get(prop_key(cid, prop))
+            out.append({'id': cid, 'property': prop, 'value': value})
+        return out
+
+    def fire(self, changed):
+        """
+        Fire the server callbacks with `changed` (prop id) among their inputs (those
+        called on page load if None).
+        """
+        for key, name, outputs, inputs, state in self.callbacks:
+            if changed is None and key not in self.initial:
+                continue
+            if changed is not None and \
+                    not any(f"{x['id']}.{x['property']}" == changed for x in inputs):
+                continue
+            payload = {'output': key, 'outputs': outputs,
+                       'inputs': [self.expand(x) for x in inputs],
+                       'state': [self.expand(x) for x in state],
+                       'changedPropIds': [] if changed is None else [changed]}
+            response = self._timed(name, lambda: self.client.post(
+                '/_dash-update-component', json=payload))
+            if response.status_code == 200:
+                for component_id, props in response.get_json()['response'].items():
+                    if component_id in self.containers and 'children' in props:
+                        self.replace_children(component_id, props['children'])
+
+    # ---------- user actions ----------
+    def click(self, button):
+        self.props[f'{button}.n_clicks'] += 1
+        self.fire(f'{button}.n_clicks')
+
+    def select_standard_query(self):
+        options = self.props['dropdown-squery.options']
+        self.props['dropdown-squery.value'] = self.rng.choice(options)['value']
+        self.click('submit-button-standard')
+
+    def edit_row(self, i):
+        # (the dependent dropdowns are set client side: as assets/clientside.js)
+        val = self.rng.randrange(len(self.tables['secondary']) + 1)   # (0: <None>)
+        key = lambda kind: prop_key({'type': kind, 'row': i}, 'value')
+        self.props[key('field')] = val
+        self.props[key('check')] = []
+        if val == 0:
+            self.props[key('trans')], self.props[key('agg')] = -1, -1
+            return
+        field = self.tables['secondary'][val - 1]
+        self.props[key('trans')] = self.rng.choice(field['trans'])['value']
+        self.props[key('agg')] = self.rng.choice(field['agg'])['value']
+        if field['has_lkp'] and self.rng.random() < 0.5:
+            self.props[key('check')] = [1]
+
+    def trace(self):
+        self.load_page()
+        self.select_standard_query()
+        if self.rng.random() < 0.3:
+            self.click('add-row')
+        rows = self.rows()[1:]
+        for i in self.rng.sample(rows, self.rng.randint(1, len(rows))):
+            self.edit_row(i)
+        if self.rng.random() < 0.2:
+            self.props['check-keep-nulls.value'] = [] if \
+                self.props['check-keep-nulls.value'] else [1]
+        self.click('submit-button')
+
+
+def worker(args, k, out):
+    warnings.simplefilter('ignore')
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    sink = open(os.devnull, 'w')
+
+    def run(j, timings, errors):
+        rng = random.Random(args.seed + 1000 * k + j)
+        session = Session(app.app.server.test_client(), app.app, rng, timings)
+        for _ in range(args.traces):
+            session.trace()
+        errors.append(session.errors)
+
+    # warm up (first requests set up the server), then measure.
+    app.app.server.test_client().get('/')
+    run(-1, dict(), [])
+    rss_start = rss_bytes()
+    timings = [dict() for _ in range(args.threads)]
+    errors = []
+    threads = [threading.Thread(target=run, args=(j, timings[j], errors))
+               for j in range(args.threads)]
+    with contextlib.redirect_stdout(sink):
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    merged = dict()
+    for t in timings:
+        for name, xs in t.items():
+            merged.setdefault(name, []).extend(xs)
+    out.put({'worker': k, 'timings': merged, 'elapsed': elapsed, 'errors': sum(errors),
+             'rss_start': rss_start, 'rss_end': rss_bytes()})
+
+
+def percentile(xs, p):
+    """ Nearest-rank percentile of the sorted list `xs` """
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs))) - 1))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--traces', type=int, default=50, help='traces per thread')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=worker, args=(args, k, out))
+             for k in range(args.workers)]
+    for p in procs:
+        p.start()
+    results = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    elapsed = max(r['elapsed'] for r in results)
+    timings = dict()
+    for r in results:
+        for name, xs in r['timings'].items():
+            timings.setdefault(name, []).extend(xs)
+
+    n_traces = args.workers * args.threads * args.traces
+    print(f'{args.workers} worker(s) x {args.threads} thread(s) x {args.traces} traces')
+    print(f'{"callback":<16} {"requests":>9} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8}')
+    for name, xs in sorted(timings.items()):
+        xs = sorted(xs)
+        print(f'{name:<16} {len(xs):>9d} {len(xs) / elapsed:>9.1f} '
+              f'{1e3 * percentile(xs, 50):>8.2f} {1e3 * percentile(xs, 95):>8.2f} '
+              f'{1e3 * percentile(xs, 99):>8.2f}')
+    n_requests = sum(len(xs) for xs in timings.values())
+    print(f'{n_traces / elapsed:.1f} traces/s, {n_requests / n_traces:.1f} server '
+          f'requests per trace')
+    for r in sorted(results, key=lambda r: r['worker']):
+        growth = (r['rss_end'] - r['rss_start']) / 2 ** 20
+        print(f'worker {r["worker"]}: RSS {r["rss_end"] / 2 ** 20:.1f} MiB '
+              f'({growth:+.1f} MiB during the run)')
+    errors = sum(r['errors'] for r in results)
+    if errors > 0:
+        print(f'{errors} failed requests (e.g. specs not supported by the planner)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
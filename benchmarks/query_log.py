@@ -0,0 +1,101 @@
+"""
+Check and time the query log.
+
+A workload of random specs, drawn with Zipf-like frequencies (a few specs are hot),
+is generated and run on a random sample database in SQLite (see
+`query_shapes.sample_db`) by several threads, each query being recorded in a
+`pysqlgen.querylog.QueryLog` in a temporary file with its generation and execution
+times and row count. The log must hold every query, and its hottest specs must have
+the counts drawn. The time to record a query is reported, with the reports of the
+log. Run from the repository root:
+
+    python benchmarks/query_log.py [--queries N] [--specs N] [--threads N]
+
+Exits with a non-zero status if the log is incomplete or its counts are wrong.
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.query import construct_query
+from pysqlgen.querylog import QueryLog, spec_hash
+from concurrency import random_specs
+from query_shapes import sample_db
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--specs', type=int, default=200, help='number of random specs')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1000, help='rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    db = sample_db(decovid.context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    specs = random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                         seed=args.seed)
+    rng = random.Random(args.seed)
+    workload = rng.choices(specs, weights=[1 / (k + 1) for k in range(len(specs))],
+                           k=args.queries)
+    db_lock = threading.Lock()
+    tmp = tempfile.TemporaryDirectory()
+    log = QueryLog(os.path.join(tmp.name, 'queries.log'))
+    recording = [0.0] * args.threads
+
+    def worker(t):
+        for opts, allow_coalesce in workload[t::args.threads]:
+            start = time.perf_counter()
+            exec_ms, n_rows, error = None, None, None
+            try:
+                sql = construct_query(*opts, dialect='SQLite', allow_coalesce=allow_coalesce)
+                gen_ms = 1e3 * (time.perf_counter() - start)
+                start = time.perf_counter()
+                with db_lock:
+                    n_rows = len(db.execute(sql).fetchall())
+                exec_ms = 1e3 * (time.perf_counter() - start)
+            except Exception as e:   # not supported by the planner or by SQLite.
+                gen_ms, error = 1e3 * (time.perf_counter() - start), type(e).__name__
+            start = time.perf_counter()
+            log.record(opts, gen_ms, dialect='SQLite', allow_coalesce=allow_coalesce,
+                       exec_ms=exec_ms, n_rows=n_rows, error=error)
+            recording[t] += time.perf_counter() - start
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counts = collections.Counter(spec_hash(opts, 'SQLite', allow_coalesce)
+                                 for opts, allow_coalesce in workload)
+    ratios, n_queries, n_distinct = log.cache_potential()
+    hottest = log.hottest_specs(10)
+    wrong = sum(count != counts[key] for key, _, count, _, _, _ in hottest)
+    wrong += n_queries != len(workload) or n_distinct != len(counts)
+    print(f'{n_queries} queries logged ({len(workload)} run), {n_distinct} distinct specs; '
+          f'record {1e3 * sum(recording) / len(workload):.3f} ms/query')
+    print('hottest specs: ' + ', '.join(str(count) for _, _, count, _, _, _ in hottest))
+    print('slowest tables (execution): ' + ', '.join(
+        f'{table} {mean:.2f} ms' for table, _, mean, _ in log.slowest_tables(5)))
+    print('cache hit potential: ' + ', '.join(
+        f'{"unbounded" if size is None else size}: {ratio:.0%}'
+        for size, ratio in ratios.items()))
+    log.close()
+    tmp.cleanup()
+    return 1 if wrong > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
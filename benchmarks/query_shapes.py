@@ -0,0 +1,153 @@
+"""
+Check and time the EXPLAIN-driven choice between the shapes of a query's SQL.
+
+A small random sample database is built in SQLite with the tables and columns
+referenced by the app's fields; pairs of rows of a dimension table share a name.
+For the standard queries and random specs, the equivalent shapes
+(`pysqlgen.explain.EQUIVALENT_SHAPES`) are costed with EXPLAIN QUERY PLAN, and
+every one which SQLite can run must return the same rows as the default shape.
+The late shapes, which keep distinct IDs of the same name apart, are run too, and
+the queries whose rows they change are counted (they are not chosen). The shapes
+chosen, and the time to choose (first time, and memoized), are reported. Run from
+the repository root:
+
+    python benchmarks/query_shapes.py [--specs N] [--rows N]
+
+Exits with a non-zero status if any equivalent shape returns different rows.
+"""
+import argparse
+import collections
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.explain import EQUIVALENT_SHAPES, SHAPES, ShapeSelector, shape_query, \
+    sqlite_cost
+from concurrency import random_specs
+
+KEYWORDS = {'case', 'when', 'then', 'else', 'end', 'is', 'not', 'null', 'and', 'or',
+            'day', 'datediff', 'in'}
+
+
+def sample_db(context, options, n_rows, seed=0):
+    """
+    A sqlite3 connection to a random database with the tables of the fields. An ID
+    column compared to a literal code in a field (e.g. a concept ID) takes one of
+    these codes in a third of its rows, so that such fields select some rows.
+    """
+    columns = {node: dict.fromkeys(node.pk + node.fks) for node in context.nodes}
+    codes = collections.defaultdict(set)    # (node, column) -> literal codes
+    for node in context.nodes:
+        if node.primary_date_field is not None:
+            columns[node][node.primary_date_field] = None
+        if node.default_lkp is not None:
+            columns[node][node.default_lkp] = None
+    for opt in options:
+        if opt.table in columns:
+            words = re.findall(r'[a-z_][a-z0-9_]*', opt.sql_template.fieldname)
+            columns[opt.table].update(dict.fromkeys(w for w in words if w not in KEYWORDS))
+            for column, code in re.findall(r'([a-z_][a-z0-9_]*_id)\s*=\s*(\d+)',
+                                           opt.sql_template.fieldname):
+                codes[opt.table, column].add(int(code))
+        if opt.dimension_table is not None and opt.dim_where_template is not None:
+            where = opt.dim_where_template.fieldname
+            columns[opt.dimension_table].update(dict.fromkeys(
+                w for w in re.findall(r'[a-z_][a-z0-9_]*', where) if w not in KEYWORDS))
+
+    rng = random.Random(seed)
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    db.execute(f"ATTACH ':memory:' AS {context.schema}")
+    for node, cols in columns.items():
+        table = f'{context.schema}.{node.name}'
+        db.execute(f'CREATE TABLE {table} ({", ".join(cols)})')
+        n = 200 if node.name == 'Concept' else n_rows
+        rows = []
+        for i in range(n):
+            row = []
+            for c in cols:
+                if c in node.pk[:1]:
+                    row.append(i)       # (unique: e.g. concept_id, person_id)
+                elif c.endswith('_id') and codes[node, c] and rng.random() < 1 / 3:
+                    row.append(rng.choice(sorted(codes[node, c])))
+                elif c.endswith('_id'):
+                    row.append(rng.choice([None] + list(range(n_rows // 10 + 1))))
+                elif 'date' in c:
+                    row.append(f'2020-0{rng.randint(1, 9)}-1{rng.randint(0, 9)} '
+                               f'{rng.randint(10, 23)}:00:00')
+                elif c == 'standard_concept':
+                    row.append('S' if rng.random() < 0.8 else None)
+                elif c == node.default_lkp:
+                    row.append(f'{c}_{i // 2}')     # (names are not unique)
+                else:
+                    row.append(rng.randint(0, 100))
+            rows.append(row)
+        db.executemany(f'INSERT INTO {table} VALUES ({", ".join("?" * len(cols))})', rows)
+        db.execute(f'CREATE INDEX {context.schema}.ix_{node.name} ON {node.name} '
+                   f'({node.pk[0]})')
+    db.execute('ANALYZE')
+    return db
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=2000, help='rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    db = sample_db(decovid.context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    selector = ShapeSelector(sqlite_cost(db))
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+
+    chosen, checked, mismatches, late = collections.Counter(), 0, 0, 0
+    t_first, t_cached, n = 0.0, 0.0, 0
+    for opts, allow_coalesce in specs:
+        try:
+            default = sorted(map(repr, db.execute(shape_query(
+                opts, 'cte', dialect='SQLite', allow_coalesce=allow_coalesce))))
+        except Exception:    # not supported by the planner or by SQLite.
+            continue
+        start = time.perf_counter()
+        shape = selector.choose(opts, allow_coalesce=allow_coalesce)
+        t_first += time.perf_counter() - start
+        start = time.perf_counter()
+        selector.choose(opts, allow_coalesce=allow_coalesce)
+        t_cached += time.perf_counter() - start
+        chosen[shape] += 1
+        n += 1
+        differs = set()
+        for other in SHAPES:
+            sql = shape_query(opts, other, dialect='SQLite', allow_coalesce=allow_coalesce)
+            if sql is None:
+                continue
+            checked += 1
+            if sorted(map(repr, db.execute(sql))) != default:
+                differs.add(other)
+        mismatches += len(differs.intersection(EQUIVALENT_SHAPES))
+        late += len(differs - set(EQUIVALENT_SHAPES)) > 0
+        for other in differs.intersection(EQUIVALENT_SHAPES):
+            print(f'{other} differs from cte for {opts}')
+
+    print(f'{n} queries, {checked} shapes run, {mismatches} mismatches; the late shapes '
+          f'change the rows of {late} queries')
+    print('chosen: ' + ', '.join(f'{k} {v}' for k, v in chosen.most_common()))
+    print(f'choose: {1e3 * t_first / n:8.2f} ms/query (first), '
+          f'{1e6 * t_cached / n:8.1f} us/query (memoized)')
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Check and time the compact SQL rendering mode against the pretty (default) mode.
+
+The standard queries and random specs are rendered in both modes, for each
+dialect; the SQL must be the same token for token (quoted literals compared
+verbatim), i.e. the modes differ only in whitespace. Output sizes and rendering
+times are reported. Run from the repository root:
+
+    python benchmarks/render_modes.py [--specs N]
+
+Exits with a non-zero status if any query differs between the modes.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.query import build_statement
+from concurrency import random_specs
+
+TOKEN = re.compile(r"""'(?:[^']|'')*'|"[^"]*"|\w+|[^\w\s]""")
+
+
+def tokens(sql):
+    return TOKEN.findall(sql)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=1000, help='number of random specs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, seed=args.seed)
+
+    n, mismatches = 0, 0
+    size = {True: 0, False: 0}
+    elapsed = {True: 0.0, False: 0.0}
+    for dialect in ('MSSS', 'Postgres'):
+        for opts, allow_coalesce in specs:
+            try:
+                build_statement(*opts, dialect=dialect, allow_coalesce=allow_coalesce)
+            except Exception:    # some specs are not supported by the planner.
+                continue
+            sql = dict()
+            for pretty in (True, False):
+                # a fresh statement each time: inner statements are cached on it.
+                stmt = build_statement(*opts, dialect=dialect,
+                                       allow_coalesce=allow_coalesce)
+                start = time.perf_counter()
+                sql[pretty] = stmt.generate_statement(dialect=dialect, pretty=pretty)
+                elapsed[pretty] += time.perf_counter() - start
+                size[pretty] += len(sql[pretty])
+            n += 1
+            mismatches += tokens(sql[True]) != tokens(sql[False])
+            if '\n' in sql[False]:
+                mismatches += 1
+
+    print(f'{n} queries rendered in each mode, {mismatches} mismatches')
+    for pretty, name in ((True, 'pretty'), (False, 'compact')):
+        print(f'{name + ":":<9}{size[pretty] / n:8.0f} chars/query '
+              f'{1e6 * elapsed[pretty] / n:8.1f} us/query')
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
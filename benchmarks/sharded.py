@@ -0,0 +1,144 @@
+"""
+Check two-phase (partial/final) aggregation of queries over sharded schemas.
+
+The random sample database of `query_shapes.sample_db` is made consistent (each
+row belongs to a person, and references rows of the same person) and partitioned
+by person into several schemas (shards); tables without a person, e.g. Concept,
+are copied to every shard. For the standard queries and random specs, the query
+on the whole database must return the same rows as the sharded query of
+`pysqlgen.partial.sharded_query`, both as one UNION ALL statement and with the
+partial queries run per shard in parallel and merged locally. The partial rows
+sent by the shards are reported, with exact and with disjoint distinct counts.
+Run from the repository root:
+
+    python benchmarks/sharded.py [--shards N] [--specs N] [--rows N]
+
+Exits with a non-zero status if any sharded query returns different rows.
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.partial import sharded_query
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+from query_shapes import sample_db
+
+
+def shard_db(db, context, n_shards):
+    """ Partition the tables of the sample database by person into schemas site0, ... """
+    schema = context.schema
+    columns = {node: [row[1] for row in db.execute(
+        f'PRAGMA {schema}.table_info({node.name})')] for node in context.nodes}
+    done, order = set(), []
+    while len(order) < len(context.nodes):      # (parents before children)
+        for node in context.nodes:
+            if node not in done and all(p in done for p in node.parents):
+                done.add(node)
+                order.append(node)
+
+    for node in order:
+        cols = columns[node]
+        if 'person_id' not in cols or node.pk[0] == 'person_id':
+            continue
+        n_persons = db.execute(f'SELECT COUNT(*) FROM {schema}.Person').fetchone()[0]
+        db.execute(f'UPDATE {schema}.{node.name} SET person_id = rowid % {n_persons} '
+                   f'WHERE person_id IS NULL')
+        for parent in node.parents:
+            key = parent.pk[0]
+            shared = [c for c in parent.pk + parent.fks if c != key and c in cols and
+                      c in columns[parent]]
+            if key == 'person_id' or key not in cols or len(shared) == 0:
+                continue
+            db.execute(f'UPDATE {schema}.{node.name} AS t SET ({", ".join(shared)}) = '
+                       f'(SELECT {", ".join(shared)} FROM {schema}.{parent.name} AS p '
+                       f'WHERE p.{key} = t.{key}) WHERE t.{key} IS NOT NULL')
+
+    sites = [f'site{k}' for k in range(n_shards)]
+    for k, site in enumerate(sites):
+        db.execute(f"ATTACH ':memory:' AS {site}")
+        for node in context.nodes:
+            where = f' WHERE person_id % {n_shards} = {k}' \
+                if 'person_id' in columns[node] else ''
+            db.execute(f'CREATE TABLE {site}.{node.name} AS '
+                       f'SELECT * FROM {schema}.{node.name}{where}')
+    return sites
+
+
+def normalize(rows):
+    return sorted(repr(tuple(round(x, 6) if isinstance(x, float) else x for x in row))
+                  for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=2000, help='rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    context = decovid.context
+    db = sample_db(context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    sites = shard_db(db, context, args.shards)
+    partitioned = {node.name for node in context.nodes if 'person_id' in
+                   [row[1] for row in db.execute(f'PRAGMA site0.table_info({node.name})')]}
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+
+    def execute(schema, sql):
+        return db.execute(sql).fetchall()
+
+    n, skipped, mismatches = 0, 0, 0
+    sent = {'exact': 0, 'disjoint': 0}
+    elapsed = {'whole': 0.0, 'union': 0.0, 'local': 0.0}
+    for opts, allow_coalesce in specs:
+        # (the rows of the root table must be partitioned between the shards)
+        root = getattr(opts[0].get_table(), 'name', None)
+        try:
+            assert root in partitioned
+            sql = construct_query(*opts, dialect='SQLite', allow_coalesce=allow_coalesce)
+            start = time.perf_counter()
+            expected = normalize(db.execute(sql))
+            elapsed['whole'] += time.perf_counter() - start
+            sharded = {d: sharded_query(*opts, schemas=sites, dialect='SQLite',
+                                        allow_coalesce=allow_coalesce, distinct=d)
+                       for d in sent}
+        except Exception:    # not supported by the planner, by SQLite or in parts.
+            skipped += 1
+            continue
+        n += 1
+        query = sharded['exact']
+        start = time.perf_counter()
+        union = normalize(db.execute(query.sql))
+        elapsed['union'] += time.perf_counter() - start
+        start = time.perf_counter()
+        local = normalize(query.run(execute))
+        elapsed['local'] += time.perf_counter() - start
+        if union != expected or local != expected:
+            mismatches += 1
+            print(f'{"union" if union != expected else "local"} differs for {opts}')
+        for d, q in sharded.items():
+            sent[d] += sum(len(execute(s, q.partials[s])) for s in sites)
+
+    print(f'{n} queries over {len(sites)} shards ({skipped} skipped), '
+          f'{mismatches} mismatches')
+    print(f'partial rows sent: {sent["exact"] / n:.1f}/query (exact distinct counts), '
+          f'{sent["disjoint"] / n:.1f}/query (disjoint)')
+    print('time: ' + ', '.join(f'{k} {1e3 * v / n:.2f} ms/query'
+                               for k, v in elapsed.items()))
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
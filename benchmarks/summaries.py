@@ -0,0 +1,126 @@
+"""
+Check and time the substitution of summary tables for recurring CTEs.
+
+The CTEs recurring in a workload of the standard queries and random specs are
+materialized as summary tables (`pysqlgen.materialize.SummaryStore`) in a random
+sample database in SQLite (see `query_shapes.sample_db`). Every query must return
+the same rows when planned with the summaries as without them. Rows are then
+appended to a fact table: a check (without rebuilding) must find the summaries of
+its CTEs stale, and the planner must not read them, until a refresh rebuilds them.
+A further refresh, with no change, must build nothing (not even summaries over the
+size budget, `--max-rows`). The times of the queries with and without the summaries are reported. Run from the
+repository root:
+
+    python benchmarks/summaries.py [--specs N] [--rows N] [--max-rows N]
+
+Exits with a non-zero status if any query returns different rows, a stale summary
+is read, or a refresh without changes builds a summary.
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.materialize import SummaryStore
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+from query_shapes import sample_db
+from sharded import normalize
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=5000, help='rows per table')
+    parser.add_argument('--max-rows', type=int, default=None, help='size budget (rows)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    context = decovid.context
+    db = sample_db(context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+
+    def execute(sql):
+        return db.execute(sql).fetchall()
+
+    workload = []
+    for opts, allow_coalesce in specs:
+        try:
+            db.execute('EXPLAIN ' + construct_query(*opts, dialect='SQLite',
+                                                    allow_coalesce=allow_coalesce))
+        except Exception:    # not supported by the planner or by SQLite.
+            continue
+        workload.append((opts, allow_coalesce))
+
+    store = SummaryStore(context, dialect='SQLite', max_rows=args.max_rows)
+    advised = store.advise(opts for opts, _ in workload)
+    start = time.perf_counter()
+    status = store.refresh(execute)
+    print(f'{len(workload)} queries, {len(advised)} recurring CTEs '
+          f'(used {sum(n for _, n in advised)} times); built in '
+          f'{1e3 * (time.perf_counter() - start):.0f} ms: ' +
+          ', '.join(f'{n} {s}' for s, n in collections.Counter(status.values()).items()))
+    for error, n in collections.Counter(store.errors.values()).most_common():
+        print(f'  failed ({n}): {error}')
+
+    def check(label):
+        mismatches, substituted = 0, 0
+        elapsed = {'CTEs': 0.0, 'summaries': 0.0}
+        fresh = [s.table for s in store.summaries.values() if store.get(s.node.cte)]
+        stale = [s.table for s in store.summaries.values()
+                 if store.get(s.node.cte) is None]
+        for opts, allow_coalesce in workload:
+            rows = {}
+            for name, summaries in (('CTEs', None), ('summaries', store)):
+                sql = construct_query(*opts, dialect='SQLite', summaries=summaries,
+                                      allow_coalesce=allow_coalesce)
+                start = time.perf_counter()
+                rows[name] = normalize(execute(sql))
+                elapsed[name] += time.perf_counter() - start
+            substituted += any(table in sql for table in fresh)
+            mismatches += rows['CTEs'] != rows['summaries']
+            mismatches += any(table in sql for table in stale)
+        print(f'{label:>12}: {substituted} queries read summaries, {mismatches} '
+              f'mismatches; ' + ', '.join(f'{k} {1e3 * v / len(workload):.2f} ms/query'
+                                          for k, v in elapsed.items()))
+        return mismatches
+
+    mismatches = check('built')
+    node = next(node for node in context.nodes if node.name == 'Measurement')
+    db.execute(f'INSERT INTO {context.schema}.{node.name} SELECT * FROM '
+               f'{context.schema}.{node.name} WHERE rowid % 10 = 0')
+    status = store.refresh(execute, rebuild=False)
+    print('appended rows, checked: ' + ', '.join(
+        f'{n} {s}' for s, n in collections.Counter(status.values()).items()))
+    mismatches += check('stale')
+    status = store.refresh(execute)
+    print('refreshed: ' + ', '.join(
+        f'{n} {s}' for s, n in collections.Counter(status.values()).items()))
+    mismatches += check('rebuilt')
+    created = []
+
+    def counting(sql):
+        if sql.startswith('CREATE TABLE') and ' AS ' in sql:
+            created.append(sql)
+        return execute(sql)
+
+    status = store.refresh(counting)
+    print(f'no change: {len(created)} summaries built; ' + ', '.join(
+        f'{n} {s}' for s, n in collections.Counter(status.values()).items()))
+    mismatches += len(created)
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Check and time the time-sliced parallel execution of queries.
+
+A random sample database (see `query_shapes.sample_db`) is written to a temporary
+SQLite file. For the standard queries and random specs, the query is split into
+time slices on the primary date field of its root table (or of the first joined
+table with one) by `pysqlgen.partial.sliced_query`; the slices run concurrently on
+a pool of connections and their partial aggregates are merged in Python. The rows
+must be the same as those of the query run whole, and as those of the single
+UNION ALL statement of the slices. Each slice would compute the CTEs of
+aggregations again, so queries with them are run as one slice, unless
+`--slice-ctes`. Times are reported per query, for the queries with and without
+such CTEs. Run from the repository root:
+
+    python benchmarks/time_slices.py [--slices N] [--specs N] [--rows N] [--slice-ctes]
+
+Exits with a non-zero status if any sliced query returns different rows.
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+warnings.simplefilter('ignore')
+
+import decovid
+from pysqlgen.apputils import standard_query_to_opts
+from pysqlgen.partial import ConnectionPool, aggregate_ctes, date_range_query, even_cuts, \
+    partial_statement, sliced_query
+from pysqlgen.query import construct_query
+from concurrency import random_specs
+from query_shapes import sample_db
+from sharded import normalize
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--slices', type=int, default=4)
+    parser.add_argument('--specs', type=int, default=300, help='number of random specs')
+    parser.add_argument('--rows', type=int, default=5000, help='rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--slice-ctes', action='store_true',
+                        help='also slice queries with CTEs of aggregations')
+    args = parser.parse_args(argv)
+
+    primary_opts, secondary_opts = decovid.ui_options()
+    context = decovid.context
+    db = sample_db(context, [*primary_opts, *secondary_opts], args.rows, args.seed)
+    tmp = tempfile.TemporaryDirectory()
+    filename = os.path.join(tmp.name, 'sample.db')
+    db.commit()
+    db.execute(f"VACUUM {context.schema} INTO '{filename}'")
+    db.close()
+
+    def connect():
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        connection.execute(f"ATTACH 'file:{filename}?mode=ro' AS {context.schema}")
+        return connection
+
+    specs = [(standard_query_to_opts(q, primary_opts, secondary_opts)[0], True)
+             for q in decovid.standard_queries.values()]
+    specs += random_specs(args.specs, primary_opts, secondary_opts, max_secondary=3,
+                          seed=args.seed)
+
+    n, skipped, mismatches = 0, 0, 0
+    # (per group of queries, with and without CTEs: [queries, whole, sliced])
+    elapsed = {'without CTEs': [0, 0.0, 0.0], 'with CTEs': [0, 0.0, 0.0]}
+    with ConnectionPool(connect) as pool:
+        db = connect()
+        for opts, allow_coalesce in specs:
+            try:
+                sql = construct_query(*opts, dialect='SQLite', allow_coalesce=allow_coalesce)
+                lo, hi = db.execute(date_range_query(*opts, dialect='SQLite')).fetchone()
+                cuts = even_cuts(datetime.datetime.fromisoformat(lo),
+                                 datetime.datetime.fromisoformat(hi), args.slices)
+                query = sliced_query(*opts, cuts=cuts, dialect='SQLite',
+                                     allow_coalesce=allow_coalesce,
+                                     slice_ctes=args.slice_ctes)
+                stmt, _ = partial_statement(*opts, dialect='SQLite',
+                                            allow_coalesce=allow_coalesce)
+                group = elapsed['with CTEs' if aggregate_ctes(stmt) else 'without CTEs']
+                start = time.perf_counter()
+                expected = normalize(db.execute(sql))
+                whole = time.perf_counter() - start
+            except Exception:    # not supported by the planner, by SQLite or in slices.
+                skipped += 1
+                continue
+            n += 1
+            start = time.perf_counter()
+            rows = normalize(query.run(pool))
+            group[0] += 1
+            group[1] += whole
+            group[2] += time.perf_counter() - start
+            if rows != expected or normalize(db.execute(query.sql)) != expected:
+                mismatches += 1
+                print(f'sliced query differs for {opts}')
+        db.close()
+    tmp.cleanup()
+
+    print(f'{n} queries in {args.slices} time slices ({skipped} skipped), '
+          f'{mismatches} mismatches')
+    for name, (count, whole, sliced) in elapsed.items():
+        if count > 0:
+            print(f'{name:>12} ({count} queries): whole {1e3 * whole / count:.2f} ms/query, '
+                  f'sliced {1e3 * sliced / count:.2f} ms/query')
+    return 1 if mismatches > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,12 @@
-import yaml, json
+import json, os, runpy, sys
 from collections import OrderedDict
-from pysqlgen.dbtree import *
-from pysqlgen.fields import *
+from functools import lru_cache
+from pysqlgen import snapshot
+from pysqlgen.dbtree import SchemaNode, DBMetadata
+from pysqlgen.fields import read_all_fields_from_yaml
 from pysqlgen.query import construct_query
+from pysqlgen.catalog import CatalogManager
+from pysqlgen.compiled import CompiledTable, compile_table, enumerate_space, rows_to_specs
 
 # ########################## OBJECTS REFLECTING DATABASE ##############################
 # ~~~~~~~~~~~~~~~~~~~~ Define Schema ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -58,74 +62,239 @@ context = DBMetadata(nodes, custom_tables, schema, AGGREGATIONS, TRANSFORMATIONS
 dim_lkp_where = dict()
 dim_lkp_where['standard'] = "{alias:s}standard_concept = 'S'"
 
-# Read all field definitions (incl transforms/aggs/lkps) from YAML file.
-all_fields = read_all_fields_from_yaml("db_fields.yaml", context, tbl_lkp=node_lkp,
-                                       dim_lkp_where=dim_lkp_where)
+_here = os.path.dirname(os.path.abspath(__file__))
+fields_file = os.path.join(_here, "db_fields.yaml")
+standard_queries_file = os.path.join(_here, "standard_queries.json")
+snapshot_file = os.path.join(_here, "catalog.snapshot")
+snapshot_sources = [fields_file, standard_queries_file, os.path.abspath(__file__)]
+sql_table_file = os.path.join(_here, "queries.sqltable")
+query_log_file = os.path.join(_here, "queries.log")
 
 
-# Create options for primary variable
-# -------------------------------------------------------------------------
+def make_options(all_fields):
+    """
+    The primary and secondary options (with their defaults) offered in the app,
+    derived from the dict of all fields.
+    """
+    # Create options for primary variable
+    # -------------------------------------------------------------------------
 
-opts_primary = (
-    all_fields['person_id'].copy(set_item_name='person'),
-    all_fields['measurement_type'].copy(set_item_name='measurement type')
-)
+    opts_primary = (
+        all_fields['person_id'].copy(set_item_name='person'),
+        all_fields['measurement_type'].copy(set_item_name='measurement type')
+    )
 
+    # Create options for secondary variables
+    # -------------------------------------------------------------------------
 
-# Create options for secondary variables
-# -------------------------------------------------------------------------
+    opts_secondary = [
+        all_fields['age'].copy(),
+        all_fields['sex'].copy(),
+        all_fields['race'].copy(),
+        all_fields['visit_type'].copy(set_item_name='visit type'),
+        all_fields['admission_type'].copy(set_item_name='admission type'),
+        all_fields['visit_start_date'].copy(set_item_name='visit start date'),
+        all_fields['length_of_stay_visit'].copy(set_item_name='length of stay (visit)'),
+        all_fields['length_of_stay_detail'].copy(set_item_name='length of stay (detail)'),
+        all_fields['care_site'].copy(set_item_name='care site'),
+        all_fields['death'].copy(),
+        all_fields['measurement_type'].copy(set_item_name='measurement type'),
+        all_fields['covid_positive'].copy(set_item_name='covid positive'),
+        all_fields['covid_negative'].copy(set_item_name='covid negative')
+    ]
 
-opts_secondary = [
-    all_fields['age'].copy(),
-    all_fields['sex'].copy(),
-    all_fields['race'].copy(),
-    all_fields['visit_type'].copy(set_item_name='visit type'),
-    all_fields['admission_type'].copy(set_item_name='admission type'),
-    all_fields['visit_start_date'].copy(set_item_name='visit start date'),
-    all_fields['length_of_stay_visit'].copy(set_item_name='length of stay (visit)'),
-    all_fields['length_of_stay_detail'].copy(set_item_name='length of stay (detail)'),
-    all_fields['care_site'].copy(set_item_name='care site'),
-    all_fields['death'],
-    all_fields['measurement_type'].copy(set_item_name='measurement type'),
-    all_fields['covid_positive'].copy(set_item_name='covid positive'),
-    all_fields['covid_negative'].copy(set_item_name='covid negative')
-]
+    # ############################## DEFAULTS ###########################################
 
+    default_transformations = dict()
+    default_aggregations = dict()
+    default_transformations['death'] = ['week', 'secondary']
+    default_aggregations['person'] = ['count', 'primary']
 
-# ############################## DEFAULTS ###############################################
+    for i, opts in enumerate([opts_primary, opts_secondary]):
+        for opt in opts:
+            if opt.item in default_transformations:
+                trans = default_transformations[opt.item]
+                if trans[1] != ['primary', 'secondary'][i]:
+                    continue
+                opt.set_transform(trans[0])
+            if opt.item in default_aggregations:
+                agg = default_aggregations[opt.item]
+                if agg[1] != ['primary', 'secondary'][i]:
+                    continue
+                opt.set_aggregation(agg[0])
 
-default_transformations = dict()
-default_aggregations = dict()
-default_transformations['death'] = ['week', 'secondary']
+    return dict(opts_primary=opts_primary, opts_secondary=opts_secondary)
 
-for i, opts in enumerate([opts_primary, opts_secondary]):
-    for opt in opts:
-        if opt.item in default_transformations:
-            trans = default_transformations[opt.item]
-            if trans[1] != ['primary', 'secondary'][i]:
-                continue
-            opt.set_transform(trans[0])
-        if opt.item in default_aggregations:
-            agg = default_aggregations[opt.item]
-            if agg[1] != ['primary', 'secondary'][i]:
-                continue
-            opt.set_aggregation(agg[0])
 
+def build_catalog():
+    """
+    Construct the field catalog from source (the YAML/JSON files): all fields, the
+    primary and secondary options (with their defaults) and the standard queries.
+    """
+    # Read all field definitions (incl transforms/aggs/lkps) from YAML file.
+    all_fields = read_all_fields_from_yaml(fields_file, context, tbl_lkp=node_lkp,
+                                           dim_lkp_where=dim_lkp_where)
 
-# ############################## STANDARD QUERIES ########################################
+    return dict(all_fields=all_fields, **derive_catalog(all_fields))
 
 
-with open("standard_queries.json", 'r') as f:
-    standard_queries = json.JSONDecoder(object_pairs_hook=OrderedDict).decode(f.read())
+def load_standard_queries():
+    with open(standard_queries_file, 'r') as f:
+        return json.JSONDecoder(object_pairs_hook=OrderedDict).decode(f.read())
+
+
+def derive_catalog(all_fields):
+    """
+    The primary and secondary options (with their defaults) and the standard queries,
+    for the dict of all fields.
+    """
+    return dict(standard_queries=load_standard_queries(), **make_options(all_fields))
+
+
+def build_snapshot():
+    """
+    Build step: compile the catalog into `snapshot_file` (versioned and hashed
+    against the YAML/JSON sources and this file).
+    """
+    digest = snapshot.source_digest(snapshot_sources, context)
+    snapshot.write_snapshot(snapshot_file, build_catalog(), digest, context)
+
+
+@lru_cache(maxsize=None)
+def load_catalog():
+    """
+    The field catalog, loaded from the snapshot if it is up to date (skipping the
+    YAML parsing and UserOption validation), otherwise built from source.
+    """
+    return snapshot.load_or_build(snapshot_file, snapshot_sources, context, build_catalog)
+
+
+def ui_options():
+    """
+    (primary options, secondary options), as offered in the app.
+    """
+    catalog = load_catalog()
+    return catalog['opts_primary'], catalog['opts_secondary']
+
+
+def compile_sql_table(max_secondary=2, workers=None):
+    """
+    Build step: compile the SQL of every query the app can produce (with up to
+    `max_secondary` secondary fields) into `sql_table_file`.
+    """
+    digest = snapshot.source_digest(snapshot_sources, context)
+    return compile_table(sql_table_file, ui_options, digest, max_secondary=max_secondary,
+                         workers=workers)
+
+
+def load_sql_table():
+    """
+    The compiled SQL table, or None if it has not been compiled or is out of date.
+    """
+    digest = snapshot.source_digest(snapshot_sources, context)
+    return CompiledTable.open(sql_table_file, digest)
+
+
+def advise_indexes(max_secondary=1, **build_kwargs):
+    """
+    Index recommendations (see `pysqlgen.advisor`) for the standard queries and the
+    UI query space with up to `max_secondary` secondary fields.
+    """
+    from pysqlgen.advisor import IndexAdvisor
+    from pysqlgen.apputils import standard_query_to_opts
+    primary_opts, secondary_opts = ui_options()
+    advisor = IndexAdvisor(**build_kwargs)
+    advisor.add_workload(standard_query_to_opts(q, primary_opts, secondary_opts)[0]
+                         for q in load_catalog()['standard_queries'].values())
+    advisor.add_workload(rows_to_specs(p, s, primary_opts, secondary_opts)
+                         for p, s in enumerate_space(primary_opts, secondary_opts,
+                                                     max_secondary))
+    return advisor.recommend()
+
+
+def query_report(n=10):
+    """
+    A report of the query log of the app (see `pysqlgen.querylog`): the most
+    frequent queries, the slowest tables and the hit ratios a cache would have.
+    """
+    from pysqlgen.querylog import QueryLog
+    log = QueryLog(query_log_file)
+    ratios, n_queries, n_distinct = log.cache_potential()
+    lines = [f'{n_queries} queries logged, {n_distinct} distinct', '', 'Hottest specs:']
+    for key, fields, count, gen_ms, exec_ms, n_rows in log.hottest_specs(n):
+        lines.append(f'  {count:6d}  {key}  {gen_ms:7.2f} ms  {json.dumps(fields)}')
+    for by, label in (('gen_ms', 'generation'), ('exec_ms', 'execution')):
+        slowest = log.slowest_tables(n, by=by)
+        if len(slowest) > 0:
+            lines += ['', f'Slowest tables ({label} time, mean / p95):']
+            lines += [f'  {table:20s} {count:6d} queries  {mean:8.2f} / {p95:8.2f} ms'
+                      for table, count, mean, p95 in slowest]
+    lines += ['', 'Cache hit potential: ' + ', '.join(
+        f'{"unbounded" if size is None else size}: {ratio:.0%}'
+        for size, ratio in ratios.items())]
+    log.close()
+    return '\n'.join(lines)
+
+
+def load_schema():
+    """
+    (context, node_lkp, dim_lkp_where) as currently defined in this file. The file
+    is re-executed, so that edits to the schema are picked up by a running app.
+    """
+    ns = runpy.run_path(os.path.abspath(__file__), run_name='__decovid_schema__')
+    return ns['context'], ns['node_lkp'], ns['dim_lkp_where']
+
+
+def catalog_manager():
+    """
+    A CatalogManager which reloads the catalog (with the options and the standard
+    queries) when `db_fields.yaml`, the standard queries or the schema in this file
+    change. Its first catalog is the one loaded (from the snapshot) with this
+    module's context, so the sources are not read again until they change.
+    """
+    catalog = load_catalog()
+    derived = {k: v for k, v in catalog.items() if k != 'all_fields'}
+    return CatalogManager(fields_file, load_schema, derive=derive_catalog,
+                          schema_files=[os.path.abspath(__file__), standard_queries_file],
+                          initial=(context, node_lkp, dim_lkp_where, catalog['all_fields'],
+                                   derived))
+
+
+def __getattr__(name):
+    # The catalog is loaded lazily, on first access to any of its attributes.
+    if name in ('all_fields', 'opts_primary', 'opts_secondary', 'standard_queries'):
+        return load_catalog()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
-    agg_opt = opts_primary[0]
-    agg_opt.set_aggregation('count')
-    _opts = opts_secondary[6:8]
-    _opts[0].set_aggregation('avg')
-    _opts.append(opts_secondary[-3])
-    for o in _opts:
-        o.is_secondary=True
+    if '--build-snapshot' in sys.argv:
+        build_snapshot()
+        sys.exit(0)
+    if '--compile-queries' in sys.argv:
+        # optionally followed by the maximum number of secondary fields.
+        i = sys.argv.index('--compile-queries') + 1
+        max_secondary = int(sys.argv[i]) if len(sys.argv) > i else 2
+        build_snapshot()
+        print(f'Compiled {compile_sql_table(max_secondary)} queries to {sql_table_file}')
+        sys.exit(0)
+    if '--query-report' in sys.argv:
+        print(query_report())
+        sys.exit(0)
+    if '--advise-indexes' in sys.argv:
+        # optionally followed by the dialect and the maximum number of secondary fields.
+        i = sys.argv.index('--advise-indexes') + 1
+        dialect = sys.argv[i] if len(sys.argv) > i else 'MSSS'
+        max_secondary = int(sys.argv[i + 1]) if len(sys.argv) > i + 1 else 1
+        for rec in advise_indexes(max_secondary):
+            print(f'-- serves {rec.queries} queries (weight {rec.weight})')
+            print(rec.sql(dialect))
+        sys.exit(0)
+    catalog = load_catalog()
+    opts_primary, opts_secondary = catalog['opts_primary'], catalog['opts_secondary']
+    agg_opt = opts_primary[0].to_spec(aggregation='count')
+    _opts = [opts_secondary[6].to_spec(aggregation='avg', is_secondary=True),
+             opts_secondary[7].to_spec(is_secondary=True),
+             opts_secondary[-3].to_spec(is_secondary=True)]
     tmp = construct_query(agg_opt, *_opts)
     print(tmp)
@@ -0,0 +1,251 @@
+import hashlib
+import re
+from collections import OrderedDict
+from .dbtree import LookupNode, SchemaNode
+from .explain import sqlite_cost
+from .query import UNSUPPORTED_QUERY, build_statement
+
+# Index recommendations from the generated queries. The planner knows exactly how
+# each query uses each table: the columns it is joined on (the ON conditions of the
+# FROM clause), the columns it is filtered on (the lookups' WHERE templates), the
+# columns it is grouped by, and the remaining columns it reads. `IndexAdvisor`
+# aggregates this over a workload (e.g. the standard queries, the UI query space, or
+# logged queries) into ranked CREATE INDEX statements, per dialect, where the other
+# columns read are suggested as covering (INCLUDE) columns. See `compare_sqlite_plans`
+# to check the recommendations against the query plans of a (sample) SQLite database.
+
+_COLUMN = re.compile(r'\w+')
+JOIN, FILTER, GROUP, READ = range(4)    # (how a query uses a column of a table)
+
+
+def template_columns(template):
+    """ The columns referenced by the SQLTemplate `template` (via its alias placeholders) """
+    if template is None:
+        return []
+    matches = (_COLUMN.match(s) for s in template.segments[1:])
+    return list(dict.fromkeys(m.group() for m in matches if m is not None))
+
+
+def _is_table(node):
+    return isinstance(node, SchemaNode) and not node.is_cte
+
+
+def _statement_usage(stmt):
+    """
+    {table: [join, filter, group, read] columns} of the (schema) tables used by the
+    statement `stmt`, but not within its CTEs.
+    """
+    usage = OrderedDict()
+
+    def use(table, kind, columns):
+        if _is_table(table):
+            cols = usage.setdefault(table, [dict(), dict(), dict(), dict()])
+            cols[kind].update(dict.fromkeys(columns))
+
+    for node, cond in stmt._from.items():
+        if len(cond) > 0:
+            use(node, JOIN, cond[1][1])
+    for _, (dim, f_dim) in stmt.lkp_aliases:
+        use(dim, JOIN, [f_dim])
+    has_agg = any(o.has_aggregation for o in stmt.fields)
+    for o in stmt.fields:
+        group = has_agg and not o.has_aggregation
+        use(o.table, GROUP if group else READ, template_columns(o.sql_template))
+        dtbl = o.dimension_table
+        if o.perform_lkp and ((o.table, o.sql_fieldname), (dtbl, dtbl.pk[0])) in \
+                stmt.lkp_aliases:       # (not via a shared LookupNode)
+            use(dtbl, FILTER, template_columns(o.option.dim_where_template))
+            use(dtbl, GROUP if group else READ, template_columns(o.option.lkp_template))
+    return usage
+
+
+def _lookup_usage(node):
+    """ As `_statement_usage`, for the inner query of the LookupNode `node` """
+    cols = [dict(), dict(), dict(), dict()]
+    if len(node.restrict) > 0:
+        cols[JOIN][node.pk[0]] = None       # (WHERE pk IN (...))
+    cols[FILTER].update(dict.fromkeys(template_columns(node.where)))
+    cols[READ].update(dict.fromkeys(node.columns))
+    return OrderedDict([(node.table, cols)])
+
+
+def statement_accesses(stmt, dialect='MSSS'):
+    """
+    The accesses of (schema) tables by the statement `stmt` and its CTEs, which an
+    index could serve: a list of (table, key columns, covering columns). The key
+    columns of a joined table are its join and filter columns; of the root table of
+    a query (which is scanned), its filter and group by columns. The covering
+    columns are the others read.
+    """
+    usages = [_lookup_usage(node) if isinstance(node, LookupNode) else
+              _statement_usage(stmt.ctes.inner(node, dialect))
+              for node in stmt.ctes.nodes(dialect)]
+    usages.append(_statement_usage(stmt))
+    out = []
+    for usage in usages:
+        for table, (join, filt, group, read) in usage.items():
+            is_root = len(join) == 0
+            key = {**filt, **group} if is_root else {**join, **filt}
+            if len(key) == 0:
+                continue
+            include = {**join, **filt, **group, **read}
+            out.append((table, tuple(key), tuple(c for c in include if c not in key)))
+    return out
+
+
+class IndexRecommendation:
+    """
+    IndexRecommendation: an index on `table` (a SchemaNode) with the key `columns`
+    and covering `include` columns, which would serve `queries` queries of the
+    workload (of total weight `weight`).
+    """
+    def __init__(self, table, columns, include, weight, queries, schema=''):
+        self.table = table
+        self.columns = tuple(columns)
+        self.include = tuple(include)
+        self.weight = weight
+        self.queries = queries
+        self.schema = schema
+
+    @property
+    def name(self):
+        name = f'ix_{self.table.name.lower()}_' + '_'.join(self.columns)
+        if len(name) > 63:      # (the limit of Postgres identifiers)
+            digest = hashlib.sha1(name.encode()).hexdigest()[:8]
+            name = name[:54] + '_' + digest
+        return name
+
+    @property
+    def prefix(self):
+        """ The schema prefix of the table (and of the index, in SQLite) """
+        schema = self.schema if self.table.schema is None else self.table.schema
+        return '' if schema == '' else schema + '.'
+
+    def sql(self, dialect='MSSS'):
+        """
+        The CREATE INDEX statement. SQLite does not support INCLUDE: the covering
+        columns are appended to the key instead.
+        """
+        dialect = dialect.lower()
+        assert dialect in ["msss", "postgres", "sqlite"], \
+            "dialect must be 'MSSS' (SQL Server), 'Postgres' or 'SQLite'"
+        prefix = self.prefix
+        columns, include = ', '.join(self.columns), ', '.join(self.include)
+        if dialect == 'sqlite':
+            columns += ', ' + include if len(self.include) > 0 else ''
+            return f'CREATE INDEX {prefix}{self.name} ON {self.table.name} ({columns});'
+        create = 'CREATE NONCLUSTERED INDEX' if dialect == 'msss' else 'CREATE INDEX'
+        sql = f'{create} {self.name} ON {prefix}{self.table.name} ({columns})'
+        if len(self.include) > 0:
+            sql += f' INCLUDE ({include})'      # (Postgres 11+)
+        return sql + ';'
+
+    def __repr__(self):
+        return f'IndexRecommendation({self.table.name}, {self.columns}, ' + \
+            f'include={self.include}, weight={self.weight})'
+
+
+class IndexAdvisor:
+    """
+    IndexAdvisor: aggregates the table accesses (see `statement_accesses`) of a
+    workload of queries, and recommends indexes ranked by the weight of the queries
+    which they serve. Queries are added as field specs (`add`, `add_workload`) or as
+    planned Statements (`add_statement`); the keyword arguments of `build_statement`
+    (e.g. `late_lookups`) choose the plan.
+    """
+    def __init__(self, **build_kwargs):
+        self.build_kwargs = build_kwargs
+        self.n_queries = 0
+        self.n_skipped = 0      # (queries which the planner does not support)
+        self.schema = ''
+        self._usage = OrderedDict()     # (table, key) -> [weight, queries, include]
+
+    def add_statement(self, stmt, weight=1):
+        self.n_queries += 1
+        self.schema = stmt.context.schema
+        dialect = self.build_kwargs.get('dialect', 'MSSS')
+        for table, key, include in dict.fromkeys(statement_accesses(stmt, dialect)):
+            usage = self._usage.setdefault((table, key), [0, 0, dict()])
+            usage[0] += weight
+            usage[1] += 1
+            usage[2].update(dict.fromkeys(include))
+
+    def add(self, *specs, weight=1):
+        self.add_statement(build_statement(*specs, **self.build_kwargs), weight=weight)
+
+    def add_workload(self, workload, weight=1):
+        """
+        Add each query (a list of specs) of the iterable `workload`, skipping (and
+        counting) any which the planner does not support.
+        """
+        for specs in workload:
+            try:
+                stmt = build_statement(*specs, **self.build_kwargs)
+            except UNSUPPORTED_QUERY:
+                self.n_skipped += 1
+                continue
+            self.add_statement(stmt, weight=weight)
+
+    def recommend(self, max_indexes=None, min_weight=0, existing=()):
+        """
+        The recommended indexes, highest weight first. An index whose key is a
+        prefix of another's is merged into it (the longer index serves both). Any
+        index served by one in `existing` -- (table name, columns) pairs, where the
+        columns start with its key and contain its covering columns -- is omitted.
+        """
+        merged = OrderedDict()
+        by_length = sorted(self._usage.items(), key=lambda x: -len(x[0][1]))
+        for (table, key), (weight, queries, include) in by_length:
+            longer = [k for k in merged if k[0] == table and k[1][:len(key)] == key]
+            if len(longer) > 0:
+                target = merged[max(longer, key=lambda k: merged[k][0])]
+                target[0] += weight
+                target[1] += queries
+                target[2].update(dict.fromkeys(include))
+            else:
+                merged[(table, key)] = [weight, queries, dict(include)]
+
+        existing = [(name, tuple(cols)) for name, cols in existing]
+        out = []
+        for (table, key), (weight, queries, include) in merged.items():
+            include = tuple(c for c in include if c not in key)
+            if weight < min_weight or any(
+                    name == table.name and cols[:len(key)] == key and
+                    set(include) <= set(cols) for name, cols in existing):
+                continue
+            out.append(IndexRecommendation(table, key, include, weight, queries,
+                                           schema=self.schema))
+        out.sort(key=lambda x: (-x.weight, x.table.name, x.columns))
+        return out if max_indexes is None else out[:max_indexes]
+
+
+def compare_sqlite_plans(connection, queries, recommendations, analyze=True, keep=False):
+    """
+    Check index recommendations on the sqlite3 `connection`, holding (a sample of)
+    the database: the SQL `queries` (in the 'SQLite' dialect) are planned before
+    and after creating the indexes, which are then dropped unless `keep`. Returns
+    a list of (plan before, plan after, cost before, cost after) per query, where
+    plans are lists of EXPLAIN QUERY PLAN lines, and costs are from `sqlite_cost`.
+    """
+    def plans():
+        cost = sqlite_cost(connection)
+        return [([row[3] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql)],
+                 cost(sql)) for sql in queries]
+
+    def drop():
+        for rec in recommendations:
+            connection.execute(f'DROP INDEX IF EXISTS {rec.prefix}{rec.name}')
+
+    before = plans()
+    try:
+        for rec in recommendations:
+            connection.execute(rec.sql('SQLite'))
+        if analyze:
+            connection.execute('ANALYZE')
+        after = plans()
+    except Exception:
+        drop()
+        raise
+    if not keep:
+        drop()
+    return [(b[0], a[0], b[1], a[1]) for b, a in zip(before, after)]
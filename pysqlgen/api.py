@@ -0,0 +1,243 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from .apputils import standard_query_to_opts
+from .query import build_statement
+
+# A JSON HTTP API for SQL generation, for machine clients (see `register_api`). A
+# query is given in the row shape of `standard_queries.json`:
+#
+#   [["Person", null, "count"], ["Sex", null, null, true]]
+#
+# (the primary row: field, transformation, aggregation; then any secondary rows:
+# field, transformation, aggregation, lookup), or as an object with options:
+#
+#   {"fields": [...rows...], "dialect": "Postgres", "allow_coalesce": false,
+#    "pretty": false, "late_lookups": true}
+#
+# ("pretty": false gives the SQL on a single line; "late_lookups": true joins the
+# dimension tables after aggregation, see `query.late_lookup_statement`) and a batch of queries as {"batch": [query, query, ...]}. Responses carry a strong
+# ETag derived from the normalized specs (FieldSpec signatures) and the catalog
+# version, so that clients and proxies can revalidate with a conditional GET.
+
+DIALECTS = ('MSSS', 'Postgres')
+
+
+def parse_query(obj):
+    """
+    (rows, options) from a query in the request, where `options` are the keyword
+    arguments of `build_statement` (dialect, allow_coalesce, late_lookups) and
+    `pretty`. Raises ValueError if the query is malformed.
+    """
+    if isinstance(obj, list):
+        obj = {'fields': obj}
+    if not isinstance(obj, dict) or not isinstance(obj.get('fields'), list) or \
+            len(obj['fields']) == 0:
+        raise ValueError('A query must be a non-empty list of rows, or an object '
+                         'with a "fields" list of rows.')
+    rows = []
+    for i, row in enumerate(obj['fields']):
+        n = 3 if i == 0 else 4
+        if not isinstance(row, list) or not (3 <= len(row) <= n):
+            raise ValueError(f'Row {i} must be a list [field, transformation, '
+                             f'aggregation{", lookup" if i > 0 else ""}].')
+        if not isinstance(row[0], str):
+            raise ValueError(f'Row {i}: the field must be a string.')
+        rows.append(row if len(row) == n else [*row, False])
+    dialect = obj.get('dialect', 'MSSS')
+    dialect = next((d for d in DIALECTS if isinstance(dialect, str) and
+                    d.lower() == dialect.lower()), None)
+    if dialect is None:
+        raise ValueError(f'dialect must be one of {", ".join(DIALECTS)}.')
+    options = {'dialect': dialect}
+    for name, default in (('allow_coalesce', True), ('pretty', True),
+                          ('late_lookups', False)):
+        options[name] = obj.get(name, default)
+        if not isinstance(options[name], bool):
+            raise ValueError(f'{name} must be true or false.')
+    return rows, options
+
+
+def match_etag(header, etags):
+    """ Does the If-None-Match `header` match any of `etags`? """
+    if header is None:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    tags = [t[2:] if t.startswith('W/') else t for t in tags]    # (weak comparison)
+    return '*' in tags or any(t in etags for t in tags)
+
+
+class SQLService:
+    """
+    SQLService: generates the SQL and metadata for queries (see `parse_query`)
+    from the current catalog of a CatalogManager. Encoded responses are cached by
+    their ETag, so repeated queries are not planned or rendered again.
+
+    :param manager - a CatalogManager, whose catalog holds the lists of primary
+    and secondary options under `primary_key` / `secondary_key`.
+    :param query_log - an optional QueryLog (see `pysqlgen.querylog`) to which each
+    valid query is appended.
+    """
+    def __init__(self, manager, primary_key='opts_primary',
+                 secondary_key='opts_secondary', max_cached=1024, min_gzip_size=512,
+                 query_log=None):
+        self.manager = manager
+        self.primary_key = primary_key
+        self.secondary_key = secondary_key
+        self.max_cached = max_cached
+        self.min_gzip_size = min_gzip_size
+        self.query_log = query_log
+        self._cache = OrderedDict()         # etag -> (status, result)
+        self._encoded = OrderedDict()       # (etag, gzip) -> (data, etag, encoding)
+        self._lock = threading.Lock()
+
+    def _put(self, cache, key, value):
+        with self._lock:
+            cache[key] = value
+            if len(cache) > self.max_cached:
+                cache.popitem(last=False)
+
+    def _get(self, cache, key):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _etag(self, catalog, specs, options):
+        key = json.dumps([catalog.version, catalog.fingerprint, options,
+                          [o.signature() for o in specs]], default=str, sort_keys=True)
+        return '"' + hashlib.sha256(key.encode()).hexdigest()[:40] + '"'
+
+    def query(self, obj):
+        """
+        (status, etag, result) for a single query: `result` is the SQL and its
+        metadata, or {"error": ...}. The etag is None if the query is malformed.
+        """
+        try:
+            rows, options = parse_query(obj)
+            catalog = self.manager.current
+            specs, _ = standard_query_to_opts(rows, catalog[self.primary_key],
+                                              catalog[self.secondary_key])
+        except (ValueError, TypeError, IndexError, AssertionError) as e:
+            return 400, None, {'error': f'Invalid query: {e}'}
+        etag = self._etag(catalog, specs, options)
+
+        start = time.perf_counter()
+        cached = self._get(self._cache, etag)
+        if cached is not None:
+            self._log(specs, options, start, 'cache', cached)
+            return cached[0], etag, cached[1]
+
+        try:
+            dialect = options['dialect']
+            stmt = build_statement(*specs, dialect=dialect,
+                                   allow_coalesce=options['allow_coalesce'],
+                                   late_lookups=options['late_lookups'])
+            result = {'sql': stmt.generate_statement(dialect=dialect,
+                                                     pretty=options['pretty']),
+                      'columns': stmt.columns,
+                      'tables': stmt.tables(),
+                      'ctes': stmt.cte_names(),
+                      'fields': [[o.item, o.selected_transform, o.selected_aggregation,
+                                  *([o.perform_lkp] if o.is_secondary else [])]
+                                 for o in specs],
+                      **options,
+                      'catalog_version': catalog.version}
+            status = 200
+        except Exception as e:      # the planner does not support this query
+            result, status = {'error': f'{type(e).__name__}: {e}'}, 422
+
+        self._put(self._cache, etag, (status, result))
+        self._log(specs, options, start, 'live', (status, result))
+        return status, etag, result
+
+    def _log(self, specs, options, start, source, response):
+        if self.query_log is not None:
+            status, result = response
+            self.query_log.record(specs, 1e3 * (time.perf_counter() - start),
+                                  dialect=options['dialect'],
+                                  allow_coalesce=options['allow_coalesce'], source=source,
+                                  error=result['error'] if status != 200 else None)
+
+    def respond(self, payload):
+        """
+        (status, etag, body) of the JSON response to the request `payload`: a query,
+        or {"batch": [query, ...]}.
+        """
+        if isinstance(payload, dict) and 'batch' in payload:
+            if not isinstance(payload['batch'], list):
+                return 400, None, {'error': '"batch" must be a list of queries.'}
+            results = [self.query(q) for q in payload['batch']]
+            etags = [etag or '' for _, etag, _ in results]
+            etag = '"' + hashlib.sha256(''.join(etags).encode()).hexdigest()[:40] + '"'
+            body = {'results': [dict(result, status=status)
+                                for status, _, result in results]}
+            return 200, etag, body
+        return self.query(payload)
+
+    def encode(self, body, etag, accept_gzip):
+        """
+        (data, etag, content_encoding) of the response body: gzip compressed if
+        accepted and large enough (with a distinct strong ETag). Cached by ETag.
+        """
+        key = (etag, accept_gzip)
+        encoded = None if etag is None else self._get(self._encoded, key)
+        if encoded is None:
+            data = json.dumps(body).encode()
+            if accept_gzip and len(data) >= self.min_gzip_size:
+                data = gzip.compress(data, compresslevel=6, mtime=0)
+                encoded = data, None if etag is None else etag[:-1] + '-gzip"', 'gzip'
+            else:
+                encoded = data, etag, None
+            if etag is not None:
+                self._put(self._encoded, key, encoded)
+        return encoded
+
+
+def register_api(server, manager, url='/api/sql', **kwargs):
+    """
+    Add the SQL generation endpoint `url` to the Flask `server`:
+
+    * POST: the query (or batch) as the JSON body.
+    * GET: the query (or batch) as JSON in the `q` parameter. Supports conditional
+      requests: if `If-None-Match` matches the ETag, the response is 304.
+
+    Returns the SQLService, and `kwargs` are passed to its constructor.
+    """
+    from flask import request, Response     # Flask is only required within an app
+    service = SQLService(manager, **kwargs)
+
+    def sql_api():
+        if request.method == 'GET':
+            try:
+                payload = json.loads(request.args.get('q', ''))
+            except ValueError:
+                payload = None
+        else:
+            payload = request.get_json(silent=True)
+        if payload is None:
+            status, etag, body = 400, None, {'error': 'Expecting a JSON query.'}
+        else:
+            status, etag, body = service.respond(payload)
+
+        accept_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        data, tag, encoding = service.encode(body, etag, accept_gzip)
+        headers = {'Vary': 'Accept-Encoding'}
+        if tag is not None:
+            headers['ETag'] = tag
+            headers['Cache-Control'] = 'public, no-cache'     # i.e. always revalidate
+            variants = (etag, etag[:-1] + '-gzip"')
+            if request.method in ('GET', 'HEAD') and \
+                    match_etag(request.headers.get('If-None-Match'), variants):
+                return Response(status=304, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return Response(data, status=status, headers=headers,
+                        mimetype='application/json')
+
+    server.add_url_rule(url, 'pysqlgen_sql_api', sql_api, methods=['GET', 'POST'])
+    return service
@@ -1,5 +1,5 @@
-from dash import callback_context
-from .utils import sync_index, get_nth_chunk
+from .utils import sync_index
+from .fields import FieldSpec
 
 
 class RowOptionsSelected:
@@ -52,26 +52,31 @@ class RowOptionsSelected:
             return [self.item_id, self.trans_id, self.agg_id, self.perform_lkp]
 
 
-def app_state_to_opts(args, primary_fields, secondary_fields):
-    assert (len(args) - 3) % 4 == 0, "Expecting 3+4n args (n>0)"
-    num_secondary = (len(args) - 3) // 4
+def app_state_to_opts(rows, primary_fields, secondary_fields):
+    """
+    FieldSpecs from the rows of indices selected in the UI: the primary row
+    (field, transformation, aggregation) followed by any number of secondary rows
+    (field, transformation, aggregation, name). Each row may be a list or a
+    RowOptionsSelected.
+    """
+    assert len(rows) > 0, "Expecting at least the primary row"
     use_opts = []
     debug = []
-    chunksizes = [3, *([4] * num_secondary)]
-    for i in range(num_secondary + 1):
-        # Get i'th row of indices selected from the UI
-        c_args = get_nth_chunk(i, args, chunksizes)
-        debug.append(", ".join([str(x) for x in c_args]))
-        selected = RowOptionsSelected(*c_args)
+    for i, row in enumerate(rows):
+        # The i'th row of indices selected from the UI
+        selected = row if isinstance(row, RowOptionsSelected) else RowOptionsSelected(*row)
+        assert selected.n == (3 if i == 0 else 4), f"Unexpected length of row {i}"
+        debug.append(", ".join([str(x) for x in selected.to_list()]))
         # Get the field that the user has selected (dropdown column 1)
         if i == 0:
-            opt = primary_fields[selected.item_id].copy()
-            opt.perform_lkp = False     # no lookups available for primary field.
+            opt = primary_fields[selected.item_id]
+            perform_lkp = False         # no lookups available for primary field.
         elif selected.item_id is None:
             continue   # user has [x] the current item and hit submit without selecting.
         elif selected.item_id > 0:
-            opt = secondary_fields[selected.item_id - 1].copy()
-            opt.is_secondary = True
+            opt = secondary_fields[selected.item_id - 1]
+            # Get the 'name' flag in column 4 (n.b. not available in row 1.)
+            perform_lkp = selected.perform_lkp
         else:
             continue
 
@@ -80,20 +85,15 @@ def app_state_to_opts(args, primary_fields, secondary_fields):
         # try/except: might be out of range if dropdowns have changed, and hence None.
         try:
             t = opt.transformations[selected.trans_id]
-            opt.set_transform(t)
         except (IndexError, TypeError):
-            opt.set_transform(None)
+            t = None
         try:
             a = opt.aggregations[selected.agg_id]
-            opt.set_aggregation(a)
         except (IndexError, TypeError):
-            opt.set_aggregation(None)
-
-        # Get the 'name' flag in column 4 (n.b. not available in row 1.)
-        if i > 0:
-            opt.perform_lkp = selected.perform_lkp
+            a = None
 
-        use_opts.append(opt)
+        use_opts.append(FieldSpec(opt, transform=t, aggregation=a, perform_lkp=perform_lkp,
+                                  is_secondary=(i > 0)))
 
     debug = "\n".join(debug)
     return use_opts, debug
@@ -107,6 +107,7 @@ def find_in_item_names(query, user_opts, error_about='list'):
 
 
 def get_trigger(default=None):
+    from dash import callback_context   # Dash is only required within a running app
     # what called the function?
     ctx = callback_context
     if not ctx.triggered:
@@ -129,7 +130,6 @@ def standard_query_to_panel_indices(query, primary_opts, secondary_opts,
     chosen_field = primary_opts[primary_row.item_id]
     primary_row.trans_id = chosen_field.transformations.index(query[ix][1])
     primary_row.agg_id = chosen_field.aggregations.index(query[ix][2])
-    out = primary_row.to_list()
     out_obj = [primary_row]
 
     # secondary
@@ -148,10 +148,9 @@ def standard_query_to_panel_indices(query, primary_opts, secondary_opts,
         secondary_row.trans_id = chosen_field.transformations.index(query[ix][1])
         secondary_row.agg_id = chosen_field.aggregations.index(query[ix][2])
         secondary_row.perform_lkp = query[ix][3]
-        out.extend(secondary_row.to_list())
         out_obj.append(secondary_row)
 
-    return out_obj if as_obj else out
+    return out_obj if as_obj else [row.to_list() for row in out_obj]
 
 
 def get_query_from_index(i, queries):
@@ -159,6 +158,29 @@ def get_query_from_index(i, queries):
     return queries[q_txt]
 
 
+def field_options(opt):
+    """
+    The dropdown options of the field `opt`, as a JSON-serialisable dict.
+    """
+    return {'trans': opt.transformation_options,
+            'trans_default': opt.default_transformation_ix,
+            'trans_disabled': opt.transformation_is_disabled,
+            'agg': opt.aggregation_options,
+            'agg_default': opt.default_aggregation_ix,
+            'agg_disabled': opt.aggregation_is_disabled,
+            'has_lkp': opt.has_dim_lkp}
+
+
+def field_option_tables(primary_opts, secondary_opts):
+    """
+    The dropdown options for every field. These are static for a given catalog, so
+    they are sent to the browser once, and the dependent dropdowns are updated
+    client side (see `assets/clientside.js`).
+    """
+    return {'primary': [field_options(opt) for opt in primary_opts],
+            'secondary': [field_options(opt) for opt in secondary_opts]}
+
+
 def standard_query_to_opts(query, primary_opts, secondary_opts):
     indices = standard_query_to_panel_indices(query, primary_opts, secondary_opts)
     return app_state_to_opts(indices, primary_opts, secondary_opts)
@@ -0,0 +1,225 @@
+import hashlib
+import os
+import threading
+from warnings import warn
+from .fields import FieldSpec, load_fields_yaml, read_table_fields
+from .query import construct_query
+from .snapshot import schema_fingerprint
+
+
+class Catalog:
+    """
+    Catalog: one immutable version of the field catalog -- the DBMetadata context,
+    the UserOptions of every field (`fields`, by name), the field names per table
+    (`tables`), and anything derived from the fields by the application (`derived`,
+    e.g. the primary/secondary option lists).
+
+    A Catalog is never modified once published by a CatalogManager, so a request
+    which holds a reference to it will finish on that version regardless of any
+    reloads in the meantime.
+    """
+    def __init__(self, version, context, tbl_lkp, dim_lkp_where, fields, tables, raw,
+                 derived):
+        self.version = version
+        self.context = context
+        self.tbl_lkp = tbl_lkp
+        self.dim_lkp_where = dim_lkp_where
+        self.fields = fields
+        self.tables = tables
+        self.raw = raw              # YAML payload per table (to detect changes), or None
+        self.derived = derived
+        self._fingerprint = None
+
+    def __getitem__(self, key):
+        return self.derived[key]
+
+    @property
+    def fingerprint(self):
+        """
+        A hash of the schema (joins, keys, etc.), which -- together with the
+        signatures of its fields -- determines the SQL of a query.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha256(schema_fingerprint(self.context).encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def __repr__(self):
+        return f'Catalog(version={self.version}, {len(self.fields)} fields)'
+
+
+class CatalogManager:
+    """
+    CatalogManager: serves the current Catalog, and rebuilds it when the field
+    definitions (YAML) or the schema sources change on disk -- without a restart.
+
+    * A change to the YAML file rebuilds only the UserOptions of the tables whose
+      definitions changed; the UserOptions of all other tables are carried over.
+    * A change to any of the `schema_files` calls `build_context` again and
+      rebuilds every table.
+
+    The new Catalog is swapped in atomically (copy-on-write): readers simply use
+    `.current`, without locking. SQL generated via `.construct_query` is cached,
+    tagged by the tables of its fields, and entries for changed tables are dropped
+    on each swap. The cache is swapped together with its catalog, and keyed by the
+    catalog's fingerprint: SQL planned from the fields of an older catalog is never
+    stored in the cache of a newer one.
+
+    :param fields_file - the YAML field definitions.
+    :param build_context - callable returning (context, tbl_lkp, dim_lkp_where).
+    :param derive - optional callable taking the dict of all fields and returning a
+    dict of derived objects (available as `catalog[key]`).
+    :param schema_files - files defining the schema (watched for changes).
+    :param initial - optionally (context, tbl_lkp, dim_lkp_where, fields, derived) of
+    the first catalog, e.g. loaded from a snapshot, so that the sources are only
+    read (and `build_context` only called) when they change. (The first reload then
+    rebuilds every table.)
+    """
+    def __init__(self, fields_file, build_context, derive=None, schema_files=(),
+                 max_cached_queries=4096, initial=None):
+        self.fields_file = fields_file
+        self.build_context = build_context
+        self.derive = derive
+        self.schema_files = list(schema_files)
+        self.max_cached_queries = max_cached_queries
+        self._write_lock = threading.Lock()
+        self._state = (None, dict())        # (current Catalog, its SQL cache)
+        self._mtimes = None
+        self._watcher = None
+        self._stop = threading.Event()
+        if initial is None:
+            self.refresh(force=True)
+        else:
+            context, tbl_lkp, dim_lkp_where, fields, derived = initial
+            tables = {tbl_nm: tuple(k for k, o in fields.items() if o.table is tbl)
+                      for tbl_nm, tbl in tbl_lkp.items()}
+            catalog = Catalog(0, context, tbl_lkp, dim_lkp_where, fields, tables, None,
+                              dict(derived))
+            self._state = (catalog, dict())
+            self._mtimes = self._source_mtimes()
+
+    @property
+    def current(self):
+        return self._state[0]
+
+    @property
+    def version(self):
+        return self._state[0].version
+
+    def _source_mtimes(self):
+        mtimes = []
+        for path in [self.fields_file, *self.schema_files]:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def refresh(self, force=False):
+        """
+        Rebuild the catalog if any source has changed (or `force`). Returns the set
+        of table names whose fields changed (empty if nothing was rebuilt).
+        """
+        with self._write_lock:
+            mtimes = self._source_mtimes()
+            if not force and mtimes == self._mtimes:
+                return set()
+            old, cache = self._state
+            schema_changed = old is None or mtimes[1:] != self._mtimes[1:]
+
+            if schema_changed:
+                context, tbl_lkp, dim_lkp_where = self.build_context()
+            else:
+                context, tbl_lkp = old.context, old.tbl_lkp
+                dim_lkp_where = old.dim_lkp_where
+            fields_data = load_fields_yaml(self.fields_file)
+
+            fields, tables, raw, changed = dict(), dict(), dict(), set()
+            for tbl_nm, tbl in tbl_lkp.items():
+                items_in_tbl = fields_data.get(tbl_nm) or dict()
+                raw[tbl_nm] = items_in_tbl
+                if not schema_changed and old.raw is not None and \
+                        old.raw.get(tbl_nm) == items_in_tbl:
+                    tbl_fields = {k: old.fields[k] for k in old.tables[tbl_nm]}
+                else:
+                    tbl_fields = read_table_fields(tbl, items_in_tbl, context, tbl_lkp,
+                                                   dim_lkp_where=dim_lkp_where)
+                    changed.add(tbl_nm)
+                fields.update(tbl_fields)
+                tables[tbl_nm] = tuple(tbl_fields.keys())
+
+            if old is not None and not schema_changed and len(changed) == 0:
+                self._mtimes = mtimes       # e.g. only the file timestamp changed
+                return changed
+
+            derived = dict() if self.derive is None else dict(self.derive(fields))
+            version = 0 if old is None else old.version + 1
+            catalog = Catalog(version, context, tbl_lkp, dim_lkp_where, fields, tables,
+                              raw, derived)
+
+            # Invalidate dependent SQL (copy-on-write; readers never lock). (The
+            # cache is copied first: readers may still be writing to it.)
+            if schema_changed:
+                cache = dict()
+            else:
+                cache = {k: v for k, v in dict(cache).items() if v[0].isdisjoint(changed)}
+            self._state = (catalog, cache)
+            self._mtimes = mtimes
+            return changed
+
+    def construct_query(self, *args, **kwargs):
+        """
+        As `query.construct_query`, with the result cached until the catalog
+        definition of any of the tables of the fields changes.
+        """
+        specs = tuple(o if isinstance(o, FieldSpec) else o.to_spec() for o in args)
+        catalog, cache = self._state
+        if any(o.context is not catalog.context for o in specs):
+            # (fields of an older schema, e.g. of a request begun before a reload)
+            return construct_query(*specs, **kwargs)
+        key = (catalog.fingerprint, tuple(o.signature() for o in specs),
+               tuple(sorted(kwargs.items())))
+        hit = cache.get(key)
+        if hit is not None:
+            return hit[1]
+        sql = construct_query(*specs, **kwargs)
+        tables = set()
+        for o in specs:
+            for tbl in (o.option.table, o.dimension_table):
+                if tbl is not None:
+                    tables.add(getattr(tbl, 'name', tbl))
+        if len(cache) >= self.max_cached_queries:
+            with self._write_lock:
+                try:
+                    cache.pop(next(iter(cache)))    # evict the oldest entry
+                except (StopIteration, KeyError, RuntimeError):
+                    pass
+        if self._state[1] is cache:     # (else the catalog was swapped while planning)
+            cache[key] = (frozenset(tables), sql)
+        return sql
+
+    def start(self, interval=1.0):
+        """
+        Watch the sources in a background (daemon) thread, checking every
+        `interval` seconds.
+        """
+        if self._watcher is not None:
+            return
+        self._stop.clear()
+
+        def watch():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:   # keep serving the last good catalog
+                    warn(f'CatalogManager: reload failed: {type(e).__name__}: {e}')
+
+        self._watcher = threading.Thread(target=watch, name='catalog-watcher',
+                                         daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
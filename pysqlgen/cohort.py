@@ -0,0 +1,196 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+from .fields import FieldSpec, construct_simple_field
+from .query import build_statement
+
+# Cohorts: subsets of patients (e.g. the covid positive persons), shared by the
+# queries of a session. A Cohort is defined by filters, (field spec, condition)
+# pairs: the persons (the IDs `key` of the `root` table) of the rows of the query of
+# the fields, which satisfy every condition, e.g.
+#
+#   Cohort([(all_fields['covid_positive'].to_spec(aggregation='max'), '= 1')], Person)
+#
+# A CohortSession materializes a cohort once, into a temporary table of the keys on
+# the session's connection (temporary tables are per connection), when it is first
+# acquired, and drops it when the last user releases it. A query planned with the
+# CohortTable (`build_statement(..., cohort=table)`) is restricted to the cohort by
+# a semi-join on the key of the root table (or failing that, of the first table of
+# the query with the key): `p.person_id IN (SELECT person_id FROM <temp table>)`.
+# The CTEs of the query are not restricted, only the rows joined to them.
+
+
+def _strip_alias(item, name):
+    return item[:-len(f' AS {name}')] if item.endswith(f' AS {name}') else item
+
+
+def temp_table_sql(dialect, name, inner, key):
+    """
+    (statements to create, table reference, statement to drop) of a temporary table
+    `name` of the distinct values of the column `key` of the query `inner` (SQL),
+    indexed on `key`.
+    """
+    select = f'SELECT DISTINCT {key} FROM ({inner}) AS c'
+    if dialect == 'MSSS':
+        table = '#' + name
+        create = [f'SELECT DISTINCT {key} INTO {table} FROM ({inner}) AS c',
+                  f'CREATE CLUSTERED INDEX ix_{name} ON {table} ({key})']
+        return create, table, f'DROP TABLE IF EXISTS {table}'
+    if dialect == 'Postgres':
+        # (temporary tables are not analyzed automatically)
+        create = [f'CREATE TEMPORARY TABLE {name} AS {select}',
+                  f'CREATE INDEX ON {name} ({key})', f'ANALYZE {name}']
+        return create, name, f'DROP TABLE IF EXISTS {name}'
+    if dialect == 'SQLite':
+        create = [f'CREATE TEMP TABLE {name} AS {select}',
+                  f'CREATE INDEX temp.ix_{name} ON {name} ({key})']
+        return create, f'temp.{name}', f'DROP TABLE IF EXISTS temp.{name}'
+    raise ValueError(f'Temporary tables are not supported for dialect {dialect}.')
+
+
+class Cohort:
+    """
+    Cohort: the keys (`key`, by default the first primary key of the `root` table)
+    of the rows of the query of the filter fields which satisfy every condition.
+
+    :param filters - a list of (UserOption or FieldSpec, condition), where the
+    condition is SQL following the field's expression, e.g. '= 1' or 'IS NOT NULL'.
+    The fields are not coalesced: a person without rows for a field has NULL.
+    """
+    def __init__(self, filters, root, key=None, name=None):
+        assert len(filters) > 0, "A cohort requires at least one filter."
+        self.filters = [(o if isinstance(o, FieldSpec) else o.to_spec(), condition)
+                        for o, condition in filters]
+        self.root = root
+        self.key = root.pk[0] if key is None else key
+        self.context = self.filters[0][0].context
+        signature = repr([(o.signature(), c) for o, c in self.filters] +
+                         [root.name, self.key]).encode()
+        self.name = (name or 'cohort') + '_' + hashlib.sha256(signature).hexdigest()[:8]
+
+    def statement(self, dialect='MSSS'):
+        """
+        The Statement selecting the keys of the cohort (possibly repeated). Raises
+        ValueError if a filter aggregates a field of the root table.
+        """
+        key = construct_simple_field(self.key, self.root, self.context,
+                                     is_secondary=False).to_spec()
+        # (unique aliases, to find the column of each filter)
+        fields = [o.derive(is_secondary=True, field_alias=f'filter{i}')
+                  for i, (o, _) in enumerate(self.filters)]
+        stmt = build_statement(key, *fields, dialect=dialect, allow_coalesce=False,
+                               shared_lookups=False)
+        if any(o.has_aggregation for o in stmt.fields):
+            raise ValueError(f'The fields of a cohort of {self.root.name} may only be '
+                             f'aggregated from other tables.')
+        exprs = {name: _strip_alias(item, name)
+                 for item, name in zip(stmt.select, stmt.columns)}
+        stmt.where.extend(f'{exprs[f"filter{i}"]} {condition}'
+                          for i, (_, condition) in enumerate(self.filters))
+        stmt.select[:] = [f'{exprs[self.key]} AS {self.key}']
+        stmt.columns[:] = [self.key]
+        stmt.fields[:], stmt.table_aliases[:] = stmt.fields[:1], stmt.table_aliases[:1]
+        return stmt
+
+    def inner_sql(self, dialect='MSSS'):
+        """ SQL of the Statement of the keys of the cohort (see `statement`) """
+        # (CTEs are inlined: SQL Server allows no WITH clause in a derived table)
+        inline = dialect == 'MSSS'
+        return self.statement(dialect).generate_statement(dialect=dialect, pretty=False,
+                                                          inline_ctes=inline)
+
+    def select_sql(self, dialect='MSSS'):
+        """ SQL selecting the distinct keys of the cohort """
+        return f'SELECT DISTINCT {self.key} FROM ({self.inner_sql(dialect)}) AS c'
+
+
+class CohortTable:
+    """
+    CohortTable: the temporary table of a materialized Cohort, with which the
+    planner restricts a query to the cohort (see `restriction`).
+    """
+    def __init__(self, cohort, table):
+        self.cohort = cohort
+        self.table = table
+        self.key = cohort.key
+
+    def restriction(self, stmt):
+        """
+        The WHERE condition restricting the Statement `stmt` to the cohort: a
+        semi-join on the key of its root table, or of the first table with the key.
+        Raises ValueError if no table of the query has the key.
+        """
+        root = self.cohort.root
+        nodes = [node for node in stmt._from if not node.is_cte]
+        node = root if root in nodes else next(
+            (node for node in nodes if self.key in node.pk + node.fks), None)
+        if node is None:
+            raise ValueError(f'No table of the query has the cohort key {self.key}.')
+        alias = stmt.aliases[node]
+        column = (alias + '.' if alias else '') + self.key
+        return f'{column} IN (SELECT {self.key} FROM {self.table})'
+
+
+class CohortSession:
+    """
+    CohortSession: the cohorts materialized on one database connection, with
+    reference counts. `execute(sql)` runs SQL on the connection. `acquire` a cohort
+    for the CohortTable to plan queries with (materializing it if needed), and
+    `release` it when done, or use `with session.use(cohort) as table: ...`. Closing
+    the session (or leaving it as a context manager) drops all its tables.
+    """
+    def __init__(self, execute, dialect='MSSS'):
+        self.execute = execute
+        self.dialect = dialect
+        self._tables = dict()       # cohort name -> (CohortTable, drop SQL, count)
+        self._lock = threading.Lock()
+
+    def acquire(self, cohort):
+        with self._lock:
+            entry = self._tables.get(cohort.name)
+            if entry is None:
+                create, table, drop = temp_table_sql(self.dialect, cohort.name,
+                                                     cohort.inner_sql(self.dialect),
+                                                     cohort.key)
+                try:
+                    for sql in create:
+                        self.execute(sql)
+                except Exception:
+                    self.execute(drop)      # (e.g. if the index failed, after the table)
+                    raise
+                entry = (CohortTable(cohort, table), drop, 0)
+            self._tables[cohort.name] = (*entry[:2], entry[2] + 1)
+            return entry[0]
+
+    def release(self, cohort):
+        with self._lock:
+            table, drop, count = self._tables[cohort.name]
+            if count > 1:
+                self._tables[cohort.name] = (table, drop, count - 1)
+            else:
+                del self._tables[cohort.name]
+                self.execute(drop)
+
+    @contextmanager
+    def use(self, cohort):
+        table = self.acquire(cohort)
+        try:
+            yield table
+        finally:
+            self.release(cohort)
+
+    def references(self, cohort):
+        entry = self._tables.get(cohort.name)
+        return 0 if entry is None else entry[2]
+
+    def close(self):
+        with self._lock:
+            for _, drop, _ in self._tables.values():
+                self.execute(drop)
+            self._tables = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,309 @@
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from . import dbtree, fields, graph, query, template
+from .fields import FieldSpec
+from .query import construct_query
+
+# Ahead-of-time compilation of a bounded UI's query space. The UI selects a primary
+# field and up to `max_secondary` secondary fields, each with a transformation and
+# an aggregation (by index), and for secondary fields a lookup flag. The order of
+# the secondary fields does not change the meaning of a query, so the secondary rows
+# are put into a canonical (sorted) order, and only one query is compiled for each
+# *multiset* of rows. The SQL is generated in parallel, and written to a single file:
+#
+#   MAGIC | JSON header line | hashes | key offsets | blob ids | blob offsets
+#         | keys | blobs
+#
+# `hashes` is the sorted array of the (8 byte) hashes of the keys, and entry `i`
+# has key `keys[key_offsets[i]:key_offsets[i+1]]` and SQL `blobs[blob_ids[i]]`
+# (zlib compressed). Identical SQL is stored only once. Lookups bisect the hashes
+# over an mmap of the file, so opening the table is O(1) and costs no memory. The
+# table is only used with the planner which compiled it (`planner_digest`).
+
+TABLE_VERSION = 1
+MAGIC = b'PYSQLGEN-SQLTABLE\n'
+_HASH_SIZE = 8
+
+
+def _hash(key):
+    return hashlib.blake2b(key, digest_size=_HASH_SIZE).digest()
+
+
+@lru_cache(maxsize=None)
+def planner_digest():
+    """ Content hash of the modules which plan and render the SQL """
+    h = hashlib.sha256()
+    for module in (dbtree, fields, graph, query, template):
+        with open(module.__file__, 'rb') as f:
+            h.update(f.read() + b'\0')
+    return h.hexdigest()
+
+
+def canonical_order(specs):
+    """
+    The specs (primary first) with the secondary fields sorted into the canonical
+    order used by the compiled table. Generating SQL from the canonical order means
+    that the SQL is the same whether or not it comes from the table.
+    """
+    primary, secondary = specs[0], specs[1:]
+    secondary = sorted(secondary, key=lambda o: repr(o.signature()))
+    return [primary, *secondary]
+
+
+def _row(spec, opts_ix):
+    opt = spec.option
+    j = opts_ix.get(id(opt))
+    if j is None or spec.selected_transform not in opt.transformations or \
+            spec.selected_aggregation not in opt.aggregations:
+        return None
+    return (j, opt.transformations.index(spec.selected_transform),
+            opt.aggregations.index(spec.selected_aggregation), int(bool(spec.perform_lkp)))
+
+
+def spec_key(specs, primary_opts, secondary_opts, allow_coalesce=True):
+    """
+    The key (bytes) of the query for `specs` (FieldSpecs, primary first) in a compiled
+    table, or None if the specs are not in the space of the UI (e.g. the fields are
+    not taken from `primary_opts` / `secondary_opts`).
+    """
+    if len(specs) == 0:
+        return None
+    rows = [_row(specs[0], {id(o): j for j, o in enumerate(primary_opts)})]
+    secondary_ix = {id(o): j for j, o in enumerate(secondary_opts)}
+    rows.extend(_row(o, secondary_ix) for o in specs[1:])
+    if any(r is None for r in rows):
+        return None
+    rows[0] = (*rows[0][:3], int(bool(allow_coalesce)))   # primary: no lookup flag.
+    return _encode(rows[0], sorted(rows[1:]))
+
+
+def _encode(primary_row, secondary_rows):
+    return '|'.join(','.join(str(x) for x in r)
+                    for r in (primary_row, *secondary_rows)).encode()
+
+
+def _secondary_rows(secondary_opts):
+    rows = []
+    for j, opt in enumerate(secondary_opts):
+        lkps = (0, 1) if opt.has_dim_lkp else (0,)
+        rows.extend(itertools.product([j], range(len(opt.transformations)),
+                                      range(len(opt.aggregations)), lkps))
+    return rows
+
+
+def enumerate_space(primary_opts, secondary_opts, max_secondary=2):
+    """
+    Generate the (primary row, secondary rows) of every query in the UI space, with
+    the secondary rows in canonical order. Each primary row is (field, transformation,
+    aggregation, allow_coalesce); each secondary row is (field, transformation,
+    aggregation, perform_lkp), all as indices.
+    """
+    rows = _secondary_rows(secondary_opts)
+    for j, opt in enumerate(primary_opts):
+        for t, a, c in itertools.product(range(len(opt.transformations)),
+                                         range(len(opt.aggregations)), (0, 1)):
+            for k in range(max_secondary + 1):
+                for secondary in itertools.combinations_with_replacement(rows, k):
+                    yield (j, t, a, c), secondary
+
+
+def rows_to_specs(primary_row, secondary_rows, primary_opts, secondary_opts):
+    j, t, a, _ = primary_row
+    opt = primary_opts[j]
+    specs = [FieldSpec(opt, transform=opt.transformations[t],
+                       aggregation=opt.aggregations[a], perform_lkp=False,
+                       is_secondary=False)]
+    for j, t, a, lkp in secondary_rows:
+        opt = secondary_opts[j]
+        specs.append(FieldSpec(opt, transform=opt.transformations[t],
+                               aggregation=opt.aggregations[a], perform_lkp=bool(lkp),
+                               is_secondary=True))
+    return specs
+
+
+# ------------------------------- COMPILER -------------------------------------------
+
+_worker_opts = None
+
+
+def _init_worker(load_options):
+    global _worker_opts
+    _worker_opts = load_options()
+
+
+def _compile_chunk(chunk):
+    primary_opts, secondary_opts = _worker_opts
+    out = []
+    for primary_row, secondary_rows in chunk:
+        specs = rows_to_specs(primary_row, secondary_rows, primary_opts, secondary_opts)
+        try:
+            sql = construct_query(*canonical_order(specs),
+                                  allow_coalesce=bool(primary_row[3]))
+        except Exception:
+            continue    # not supported by the planner: left to live generation.
+        out.append((_encode(primary_row, secondary_rows), sql))
+    return out
+
+
+def _chunks(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def compile_table(filename, load_options, digest, max_secondary=2, workers=None,
+                  chunksize=256):
+    """
+    Compile the SQL of every query in the UI space into `filename`.
+
+    :param load_options - a picklable callable (e.g. a module-level function)
+    returning (primary_opts, secondary_opts). It is called in each worker process.
+    :param digest - identifies the sources of the options (see
+    `snapshot.source_digest`): the table is only used if the digest matches.
+    :param max_secondary - the maximum number of secondary fields.
+    :param workers - the number of processes (default: the number of CPUs).
+    :return the number of queries compiled.
+    """
+    primary_opts, secondary_opts = load_options()
+    space = enumerate_space(primary_opts, secondary_opts, max_secondary=max_secondary)
+    entries = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(load_options,)) as pool:
+        for out in pool.map(_compile_chunk, _chunks(space, chunksize)):
+            entries.extend(out)
+    write_table(filename, entries, digest, max_secondary=max_secondary)
+    return len(entries)
+
+
+def write_table(filename, entries, digest, max_secondary=None):
+    """
+    Write the (key, sql) `entries` to `filename` (atomically).
+    """
+    entries = sorted(((_hash(k), k, sql) for k, sql in entries), key=lambda x: x[:2])
+    blob_lkp, blobs, blob_ids = dict(), [], []
+    for _, _, sql in entries:
+        i = blob_lkp.get(sql)
+        if i is None:
+            i = blob_lkp[sql] = len(blobs)
+            blobs.append(zlib.compress(sql.encode(), 9))
+        blob_ids.append(i)
+
+    key_offsets, blob_offsets = [0], [0]
+    for _, k, _ in entries:
+        key_offsets.append(key_offsets[-1] + len(k))
+    for b in blobs:
+        blob_offsets.append(blob_offsets[-1] + len(b))
+
+    n, m = len(entries), len(blobs)
+    header = json.dumps({'version': TABLE_VERSION, 'digest': digest,
+                         'planner': planner_digest(), 'count': n,
+                         'blobs': m, 'max_secondary': max_secondary}).encode()
+    parts = [MAGIC, header, b'\n',
+             b''.join(h for h, _, _ in entries),
+             struct.pack(f'<{n + 1}Q', *key_offsets),
+             struct.pack(f'<{n}I', *blob_ids),
+             struct.pack(f'<{m + 1}Q', *blob_offsets),
+             b''.join(k for _, k, _ in entries),
+             *blobs]
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.sqltable-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.writelines(parts)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class CompiledTable:
+    """
+    CompiledTable: read-only access to a table written by `compile_table`. Use
+    `CompiledTable.open(filename, digest)`, which returns None if the file is
+    missing, or was compiled from different sources (`digest`), by a different
+    planner or by a different version.
+    """
+    def __init__(self, buf, header, start):
+        self.header = header
+        self._buf = buf
+        n, m = header['count'], header['blobs']
+        self._n = n
+        self._hashes = start
+        self._key_offsets = self._hashes + _HASH_SIZE * n
+        self._blob_ids = self._key_offsets + 8 * (n + 1)
+        self._blob_offsets = self._blob_ids + 4 * n
+        self._keys = self._blob_offsets + 8 * (m + 1)
+        self._blobs = self._keys + self._key_offset(n)
+
+    @classmethod
+    def open(cls, filename, digest):
+        try:
+            with open(filename, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if buf[:len(MAGIC)] != MAGIC:
+            return None
+        end = buf.find(b'\n', len(MAGIC))
+        try:
+            header = json.loads(buf[len(MAGIC):end])
+        except ValueError:
+            return None
+        if header.get('version') != TABLE_VERSION or header.get('digest') != digest or \
+                header.get('planner') != planner_digest():
+            return None
+        return cls(buf, header, end + 1)
+
+    def __len__(self):
+        return self._n
+
+    def _hash_at(self, i):
+        s = self._hashes + _HASH_SIZE * i
+        return self._buf[s:s + _HASH_SIZE]
+
+    def _key_offset(self, i):
+        return struct.unpack_from('<Q', self._buf, self._key_offsets + 8 * i)[0]
+
+    def _key_at(self, i):
+        s, e = struct.unpack_from('<2Q', self._buf, self._key_offsets + 8 * i)
+        return self._buf[self._keys + s:self._keys + e]
+
+    def _sql_at(self, i):
+        j = struct.unpack_from('<I', self._buf, self._blob_ids + 4 * i)[0]
+        s, e = struct.unpack_from('<2Q', self._buf, self._blob_offsets + 8 * j)
+        return zlib.decompress(self._buf[self._blobs + s:self._blobs + e]).decode()
+
+    def get(self, key, default=None):
+        """
+        The SQL for `key` (see `spec_key`), or `default` if it was not compiled.
+        """
+        if key is None:
+            return default
+        h = _hash(key)
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self._n and self._hash_at(lo) == h:
+            if self._key_at(lo) == key:
+                return self._sql_at(lo)
+            lo += 1
+        return default
+
+    def close(self):
+        self._buf.close()
@@ -1,6 +1,5 @@
-import queue
 import math
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from warnings import warn
 from .utils import str_to_fieldname, rm_alias_placeholder
 from .graph import Graph
@@ -18,7 +17,7 @@ class DBMetadata:
             for p in node.parents:
                 p.children.append(node)
         for node in nodes:
-            node.children = list(set(node.children))
+            node.children = list(dict.fromkeys(node.children))
 
         self.nodes = nodes
         self.custom_tables = custom_tables
@@ -28,6 +27,55 @@ class DBMetadata:
         self.coalesce_default = coalesce_default
         self.agg_alias_lkp = agg_alias_lkp if not None else dict()
 
+        # Freeze the schema into an indexed form, which the SchemaNode methods use.
+        self.index = SchemaIndex(nodes)
+        for i, node in enumerate(self.index.nodes):
+            node._index, node._id = self.index, i
+
+    def __contains__(self, node):
+        return node in self.index.ids
+
+
+class SchemaIndex:
+    """
+    SchemaIndex: a frozen, indexed form of the schema, built once by DBMetadata.
+    Each node is given a dense integer id, and the depth (`num_parents`), key
+    sets, parent ranks, BFS neighbours and pairwise common keys are precomputed
+    so that the corresponding SchemaNode methods are O(1) lookups.
+
+    Nodes constructed after the index (e.g. CTENodes) are not included, and
+    fall back to computing these properties directly.
+    """
+    def __init__(self, nodes):
+        self.nodes = tuple(nodes)
+        self.ids = {node: i for i, node in enumerate(self.nodes)}
+        n = len(self.nodes)
+
+        # depth: follow the *FIRST* parent (memoised over the chain)
+        depth = [None] * n
+        for i in range(n):
+            chain, v = [], self.nodes[i]
+            while v in self.ids and depth[self.ids[v]] is None:
+                chain.append(self.ids[v])
+                v = v.parents[0] if len(v.parents) > 0 else None
+            if v is None:
+                d = -1
+            elif v in self.ids:
+                d = depth[self.ids[v]]
+            else:
+                d = v.num_parents()    # parent outside of the indexed nodes
+            for j in reversed(chain):
+                d += 1
+                depth[j] = d
+        self.depth = tuple(depth)
+
+        self.key_sets = tuple(frozenset(v.pk + v.fks) for v in self.nodes)
+        self.parent_rank = tuple({p: r for r, p in reversed(list(enumerate(v.parents)))}
+                                 for v in self.nodes)
+        self.neighbours = tuple((*v.parents, *v.children) for v in self.nodes)
+        self.common_keys = [[_common_keys(v, w, self.key_sets[j])
+                             for j, w in enumerate(self.nodes)] for v in self.nodes]
+
 
 class SchemaNode:
     """
@@ -55,6 +103,7 @@ class SchemaNode:
         self.default_lkp = default_lkp     # if used as a Dimension table
         self.schema = schema
         self.is_cte = False
+        self._index, self._id = None, None  # set by DBMetadata
 
     def __repr__(self):
         return f'{self.name} Table <SchemaNode with parent(s) ' + \
@@ -68,23 +117,39 @@ class SchemaNode:
         Calculates the number of parents above the node (only using the *FIRST* parent
         in the `.parents` list, in the case there are > 1).
         """
+        if self._index is not None:
+            return self._index.depth[self._id]
         return 0 if len(self.parents) == 0 else self.parents[0].num_parents() + 1
 
     def parent_rank(self, parent):
+        if self._index is not None:
+            rank = self._index.parent_rank[self._id].get(parent)
+            if rank is not None:
+                return rank
         try:
             return self.parents.index(parent)
         except ValueError:
             raise Exception(f"parent_rank: cannot find parent {parent} in {self}.")
 
+    def key_set(self):
+        if self._index is not None:
+            return self._index.key_sets[self._id]
+        return frozenset(self.pk + self.fks)
+
     def common_keys(self, node_to):
-        parent_keys = set(node_to.pk + node_to.fks)
-        pk_intersect = list(filter(lambda x: x in parent_keys, self.pk))
-        if len(pk_intersect) > 0:
-            return pk_intersect
-        fk_intersect = list(filter(lambda x: x in parent_keys, self.fks))
-        if len(fk_intersect) > 0:
-            return fk_intersect
-        raise RuntimeError(f'No common keys between {self.name} and {node_to.name}.')
+        index = self._index
+        if index is not None and node_to._index is index:
+            keys = index.common_keys[self._id][node_to._id]
+        else:
+            keys = _common_keys(self, node_to, node_to.key_set())
+        if keys is None:
+            raise RuntimeError(f'No common keys between {self.name} and {node_to.name}.')
+        return list(keys)
+
+    def bfs_neighbours(self):
+        if self._index is not None:
+            return self._index.neighbours[self._id]
+        return (*self.parents, *self.children)
 
     def traverse_to_ancestor(self, b, internal=False):
         assert isinstance(b, SchemaNode)
@@ -118,12 +183,13 @@ class SchemaNode:
 
 
 class CTENode(SchemaNode):
-    def __init__(self, parents, pk, fields, default_lkp=None, children=None):
+    def __init__(self, parents, pk, fields, default_lkp=None, children=None, name=None):
         assert isinstance(parents, list), "parents must be a list of nodes"
         assert isinstance(fields, list), "fields must be a list of UserOptions"
 
-        agg_fields = [x.item for x in fields if x.has_aggregation]
-        name = '_'.join([str_to_fieldname(x) for x in agg_fields]) + '_agg'
+        if name is None:
+            agg_fields = [x.item for x in fields if x.has_aggregation]
+            name = '_'.join([str_to_fieldname(x) for x in agg_fields]) + '_agg'
 
         self.name = name
         self.parents = parents
@@ -134,6 +200,7 @@ class CTENode(SchemaNode):
         self.default_lkp = default_lkp     # if used as a Dimension table
         self.schema = ''
         self.is_cte = True
+        self._index, self._id = None, None
 
     @property
     def fks(self):
@@ -154,6 +221,67 @@ class CTENode(SchemaNode):
         return self.__copy__()
 
 
+class SummaryNode(CTENode):
+    """
+    SummaryNode: the physical summary table `name` (in `schema`) holding the rows of
+    the CTE `cte`, which the planner reads in place of the CTE (see `materialize.py`).
+    """
+    def __init__(self, cte, name, schema):
+        super().__init__(list(cte.parents), list(cte.pk), list(cte.fields),
+                         default_lkp=cte.default_lkp, name=name)
+        self.cte = cte
+        self.schema = schema
+        self.is_cte = False
+
+    def __repr__(self):
+        return f'{self.name} Table <SummaryNode of {self.cte.name}>'
+
+
+class LookupNode(CTENode):
+    """
+    LookupNode: a CTE holding the rows of the dimension table `table` needed by
+    several lookups: the `columns` of the rows which satisfy the lookups' WHERE
+    template `where` (if any), optionally restricted to the IDs in the (CTE, field)
+    pairs `restrict`.
+    """
+    def __init__(self, table, columns, where, restrict, context):
+        self.name = table.name.lower() + '_lkp'
+        self.table = table
+        self.columns = list(columns)
+        self.where = where
+        self.restrict = list(restrict)
+        self.context = context
+        self.parents = []
+        self.pk = [table.pk[0]]
+        self.children = []
+        self.fields = []
+        self.primary_date_field = None
+        self.default_lkp = table.default_lkp
+        self.schema = ''
+        self.is_cte = True
+        self._index, self._id = None, None
+
+    def __repr__(self):
+        return f'{self.name} Table <LookupNode of {self.table}>'
+
+    def __str__(self):
+        return f'{self.name} Table with columns: {self.columns}'
+
+
+def _common_keys(node_from, node_to, to_keys):
+    """
+    The primary keys of `node_from` which are keys of `node_to` (`to_keys`), or failing
+    that, the foreign keys. None if there are no common keys.
+    """
+    pk_intersect = tuple(x for x in node_from.pk if x in to_keys)
+    if len(pk_intersect) > 0:
+        return pk_intersect
+    fk_intersect = tuple(x for x in node_from.fks if x in to_keys)
+    if len(fk_intersect) > 0:
+        return fk_intersect
+    return None
+
+
 def topological_sort_hierarchical(nodes, return_perm):
     """
     This MASSIVELY takes advantage of an assumed star schema.
@@ -174,12 +302,11 @@ def breadthfirstsearch(A, B):
     Perform BFS to find shortest path from v -> w through nodes defined by "nodes"
     """
 
-    Q = queue.Queue()
-    Q.put(A)
+    Q = deque([A])
     path_exist = {A: None}    # mark visited, and capture the preceding node
 
-    while not Q.empty():
-        v = Q.get()
+    while Q:
+        v = Q.popleft()
         if v is B:
             # Success
             path = [v]
@@ -187,10 +314,10 @@ def breadthfirstsearch(A, B):
                 v = path_exist[v]
                 path.append(v)
             return path
-        for w in [*v.parents, *v.children]:
+        for w in v.bfs_neighbours():
             if w not in path_exist:
                 path_exist[w] = v
-                Q.put(w)
+                Q.append(w)
 
 
 def minimum_subtree(nodes):
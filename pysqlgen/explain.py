@@ -0,0 +1,204 @@
+import json
+import math
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from .fields import FieldSpec
+from .query import build_statement
+
+# Cost-based choice between equivalent shapes of the SQL of a query. The planner
+# can write a query with its nested aggregations as CTEs or as derived tables (CTEs
+# are an optimization fence on some engines, e.g. Postgres < 12), with its lookups
+# joined before or after aggregation (`late_lookups`), and with lookups into the
+# same dimension table shared or not (`shared_lookups`). Each shape is rendered and
+# costed by the target database via EXPLAIN -- or locally by SQLite's EXPLAIN QUERY
+# PLAN, see `sqlite_cost` -- and the cheapest is chosen (see `ShapeSelector`).
+#
+# The late shapes are not equivalent: aggregating on the IDs keeps distinct IDs with
+# the same name (e.g. two concepts 'Other') as separate rows, where the other shapes
+# merge them. They are therefore not chosen between by default (EQUIVALENT_SHAPES),
+# so that the rows of a query never depend on a cost estimate.
+
+SHAPES = OrderedDict([
+    ('cte', dict(late_lookups=False, shared_lookups=False, inline_ctes=False)),
+    ('derived', dict(late_lookups=False, shared_lookups=False, inline_ctes=True)),
+    ('shared', dict(late_lookups=False, shared_lookups=True, inline_ctes=False)),
+    ('late', dict(late_lookups=True, shared_lookups=True, inline_ctes=False)),
+    ('late_derived', dict(late_lookups=True, shared_lookups=False, inline_ctes=True)),
+])      # (the first is the default plan of `construct_query`)
+EQUIVALENT_SHAPES = ('cte', 'derived', 'shared')    # (the same rows as the default)
+
+
+def shape_query(specs, shape, dialect='MSSS', allow_coalesce=True, pretty=True):
+    """
+    The SQL of the query `specs` in the shape `shape` (a key of SHAPES), or None
+    if the CTEs of the query cannot be written as derived tables.
+    """
+    options = SHAPES[shape]
+    stmt = build_statement(*specs, dialect=dialect, allow_coalesce=allow_coalesce,
+                           late_lookups=options['late_lookups'],
+                           shared_lookups=options['shared_lookups'])
+    if options['inline_ctes'] and not stmt.can_inline(dialect):
+        return None
+    return stmt.generate_statement(dialect=dialect, pretty=pretty,
+                                   inline_ctes=options['inline_ctes'])
+
+
+# ----------------------------- COST FUNCTIONS ---------------------------------------
+def postgres_cost(connection):
+    """
+    A cost function (SQL -> estimated cost) using Postgres' `EXPLAIN` on the DB-API
+    `connection`: the total cost of the plan.
+    """
+    def cost(sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+            plan = cursor.fetchone()[0]
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        return float(plan[0]['Plan']['Total Cost'])
+    return cost
+
+
+_UNKNOWN_ROWS = 1000        # (rows assumed of a table or subquery of unknown size)
+_LOOP = re.compile(r'(SCAN|SEARCH) (?:TABLE |SUBQUERY )?([\w.]+)(?: AS (\w+))?')
+_TABLE_REF = re.compile(r'(?:FROM|JOIN)\s+([\w.]+)'
+                        r'(?:\s+(?!ON\b|LEFT\b|WHERE\b|GROUP\b)(\w+))?', re.IGNORECASE)
+
+
+def sqlite_cost(connection):
+    """
+    A cost function (SQL -> estimated cost) using SQLite's `EXPLAIN QUERY PLAN` on
+    the sqlite3 `connection`, holding (a sample of) the database. SQLite does not
+    report costs, so the plan is scored: each loop costs the rows of its table (a
+    SCAN) or the depth of an index (a SEARCH) per row of its enclosing loops, and
+    materialized subqueries (CTEs, derived tables) are costed once. Table sizes are
+    from `sqlite_stat1` (after ANALYZE) or counted.
+    """
+    sizes = dict()
+
+    def table_rows(table):
+        if table not in sizes:
+            schema, _, name = table.rpartition('.')
+            prefix = schema + '.' if schema else ''
+            try:
+                stat = connection.execute(f'SELECT stat FROM {prefix}sqlite_stat1 WHERE '
+                                          f'tbl = ? COLLATE NOCASE', (name,)).fetchone()
+            except Exception:     # (not analyzed)
+                stat = None
+            if stat is not None:
+                sizes[table] = int(stat[0].split()[0])
+            else:
+                try:
+                    sizes[table] = connection.execute(
+                        f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                except Exception:     # e.g. a CTE which SQLite did not materialize.
+                    sizes[table] = _UNKNOWN_ROWS
+        return sizes[table]
+
+    def cost(sql):
+        plan = connection.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        children = defaultdict(list)
+        for node, parent, _, detail in plan:
+            children[parent].append((node, detail))
+        aliases = {alias or table: table for table, alias in _TABLE_REF.findall(sql)}
+        return _plan_cost(children, 0, aliases, table_rows, dict())[0]
+    return cost
+
+
+def _plan_cost(children, parent, aliases, table_rows, subquery_rows):
+    """ (cost, rows) of the part of a SQLite query plan below `parent` """
+    cost, rows = 0.0, 1.0
+    for node, detail in children[parent]:
+        loop = _LOOP.match(detail)
+        if detail.startswith(('MATERIALIZE', 'CO-ROUTINE')):
+            c, r = _plan_cost(children, node, aliases, table_rows, subquery_rows)
+            subquery_rows[detail.split()[-1]] = r
+            cost += c
+        elif loop is not None:
+            name = loop.group(3) or loop.group(2)
+            name = name if name in subquery_rows else aliases.get(name, name)
+            if name in subquery_rows:
+                n = subquery_rows[name]
+            else:
+                n = table_rows(name)
+            if loop.group(1) == 'SCAN':
+                cost += rows * n
+                rows *= max(n, 1)
+            else:
+                cost += rows * (math.log2(n + 1) + 1) + (n if 'AUTOMATIC' in detail else 0)
+        elif detail.startswith('USE TEMP B-TREE'):
+            cost += rows * math.log2(rows + 1)
+        else:                       # (subqueries, compound queries)
+            cost += _plan_cost(children, node, aliases, table_rows, subquery_rows)[0]
+    return cost, rows
+
+
+# ----------------------------- SHAPE SELECTION --------------------------------------
+class ShapeSelector:
+    """
+    ShapeSelector: chooses the cheapest of the `shapes` (keys of SHAPES, by default
+    those which return the same rows, EQUIVALENT_SHAPES) of the SQL of a query,
+    where the cost of the SQL (in `explain_dialect`) is estimated by `cost`, e.g.
+    `sqlite_cost(connection)` or `postgres_cost(connection)`. Shapes which the
+    database cannot plan are skipped; if none can be planned, the first shape is
+    used. The choice is memoized per spec signature and catalog version.
+    """
+    def __init__(self, cost, explain_dialect='SQLite', shapes=EQUIVALENT_SHAPES,
+                 max_cached=4096):
+        self.cost = cost
+        self.explain_dialect = explain_dialect
+        self.shapes = shapes
+        self.max_cached = max_cached
+        self._cache = OrderedDict()         # key -> shape
+        self._lock = threading.Lock()
+
+    def explain(self, specs, allow_coalesce=True):
+        """
+        {shape: estimated cost} of the shapes of the query `specs` (None if the
+        database cannot plan it). Shapes giving the same SQL as an earlier shape are
+        omitted.
+        """
+        out, seen = OrderedDict(), set()
+        for shape in self.shapes:
+            sql = shape_query(specs, shape, dialect=self.explain_dialect,
+                              allow_coalesce=allow_coalesce, pretty=False)
+            if sql is None or sql in seen:
+                continue
+            seen.add(sql)
+            try:
+                out[shape] = self.cost(sql)
+            except Exception:       # e.g. SQL which the database cannot parse.
+                out[shape] = None
+        return out
+
+    def choose(self, specs, allow_coalesce=True, version=0):
+        """
+        The cheapest shape of the query `specs` (UserOptions or FieldSpecs) for
+        catalog `version`
+        """
+        specs = tuple(o if isinstance(o, FieldSpec) else o.to_spec() for o in specs)
+        key = (version, allow_coalesce, tuple(o.signature() for o in specs))
+        with self._lock:
+            shape = self._cache.get(key)
+            if shape is not None:
+                self._cache.move_to_end(key)
+                return shape
+        costs = {k: v for k, v in self.explain(specs, allow_coalesce).items()
+                 if v is not None}
+        shape = min(costs, key=costs.get) if len(costs) > 0 else self.shapes[0]
+        with self._lock:
+            self._cache[key] = shape
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return shape
+
+    def construct_query(self, *specs, dialect='MSSS', allow_coalesce=True, pretty=True,
+                        version=0):
+        """ As `query.construct_query`, but in the cheapest shape """
+        shape = self.choose(specs, allow_coalesce=allow_coalesce, version=version)
+        sql = shape_query(specs, shape, dialect=dialect, allow_coalesce=allow_coalesce,
+                          pretty=pretty)
+        if sql is None:     # (the target dialect cannot inline all CTEs)
+            sql = shape_query(specs, self.shapes[0], dialect=dialect,
+                              allow_coalesce=allow_coalesce, pretty=pretty)
+        return sql
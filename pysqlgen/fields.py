@@ -1,8 +1,9 @@
-import copy
-import yaml
+import re
+from functools import lru_cache
 from warnings import warn
-from .utils import *
-from .dbtree import *
+from .utils import node_isin_context, str_to_fieldname, rm_alias_placeholder
+from .dbtree import DBMetadata, SchemaNode, is_node
+from .template import compile_template
 
 
 class UserOption:
@@ -56,7 +57,7 @@ class UserOption:
                      "unable to select the raw field.")
 
         self.item = item
-        self.sql_item = sql_item
+        self.sql_item = sql_item     # compiled into `self.sql_template`
         self._field_alias = field_alias
         self.sql_where = sql_where
         self.is_secondary = is_secondary
@@ -79,9 +80,10 @@ class UserOption:
         self.table = table if isinstance(table, SchemaNode) else table.title()
         self.dimension_table = dimension_table
         self._perform_lkp = perform_lkp
-        self.dim_where = dim_where
+        self.dim_where = dim_where   # compiled into `self.dim_where_template`
         self.coalesce = None
 
+        self.lkp_template = None
         if dimension_table is not None:
             if lkp_field is not None:
                 self.lkp_field = lkp_field
@@ -90,6 +92,23 @@ class UserOption:
                     f'{item} No `default_lkp` field in dimension table. You must supply' \
                     + ' a `lkp_field` in the UserOption arguments.'
                 self.lkp_field = self.dimension_table.default_lkp
+            self.lkp_template = compile_template('{alias:s}' + self.lkp_field)
+
+    @property
+    def sql_item(self):
+        return self.sql_template.source
+
+    @sql_item.setter
+    def sql_item(self, value):
+        self.sql_template = compile_template(value)
+
+    @property
+    def dim_where(self):
+        return None if self.dim_where_template is None else self.dim_where_template.source
+
+    @dim_where.setter
+    def dim_where(self, value):
+        self.dim_where_template = compile_template(value)
 
     def set_transform(self, t, force=False):
         # if self.transformations is None:
@@ -186,25 +205,14 @@ class UserOption:
         self._field_alias = value
 
     def _field_alias_logic(self, will_perform_lkp=True, depend_agg=True):
-        if self._field_alias is None:
-            field_alias = str_to_fieldname(self.item)
-            field_alias += '_id' if (self.has_dim_lkp and not will_perform_lkp) else ''
-        else:
-            field_alias = self._field_alias
-        if depend_agg and self.has_aggregation and self._field_alias is None:
-            agg_prefix = self.selected_aggregation.lower().strip()
-            # Transform max->has in case of CASE WHEN statements
-            if agg_prefix == 'max':
-                field_stmt = self.sql_fieldname
-                if len(field_stmt) > 3 and field_stmt[:4].lower() == 'case':
-                    agg_prefix = 'has'
-            agg_prefix = self.context.agg_alias_lkp.get(agg_prefix, agg_prefix)
-            field_alias = agg_prefix + '_' + field_alias
-        return field_alias
+        aggregation = self.selected_aggregation if depend_agg else None
+        return _field_alias(self.item, self._field_alias, self.sql_template,
+                            self.has_dim_lkp and not will_perform_lkp,
+                            aggregation, self.context)
 
     @property
     def sql_fieldname(self):
-        return rm_alias_placeholder(self.sql_item)
+        return self.sql_template.fieldname
 
     def __copy__(self, set_item_name=None):
         obj = type(self).__new__(self.__class__)
@@ -235,92 +243,334 @@ class UserOption:
         The return value is the tuple (`sel`, `where`).
 
         """
+        expr, field_alias, where = self.sql_expression(alias=alias, dialect=dialect,
+                                                       coalesce=coalesce)
+        sel = expr if field_alias is None else f'{expr} AS {field_alias}'
+        return sel, list(where)
+
+    def sql_expression(self, alias=None, dialect="MSSS", coalesce=None, lkp_where=True):
+        """
+        As `sql_transform`, but returns the tuple (`expr`, `field_alias`, `where`)
+        where `expr` is the SELECT expression without its alias (as required for
+        a GROUP BY clause), and `field_alias` is None if the field is unaliased.
+        If not `lkp_where`, the WHERE clause of a lookup is omitted (i.e. if the
+        dimension table has already been filtered).
+        """
+        return self.to_spec().sql_expression(alias=alias, dialect=dialect,
+                                             coalesce=coalesce, lkp_where=lkp_where)
+
+    def to_spec(self, **kwargs):
+        """
+        Return an immutable FieldSpec of this option. The currently selected
+        transformation/aggregation/lookup are used unless overridden by `kwargs`
+        (any of `transform`, `aggregation`, `perform_lkp`, `is_secondary`).
+        """
+        return FieldSpec(self, **kwargs)
+
+
+_UNSET = object()
+
+
+class FieldSpec:
+    """
+    FieldSpec: an immutable selection of a catalog field (UserOption) for a
+    single query -- the transformation, aggregation and lookup flag chosen by
+    the user, and whether it is the primary field. The query planner derives
+    new FieldSpecs (e.g. pointing at a CTE rather than the source table) via
+    `derive`, rather than mutating copies of the UserOption.
+
+    FieldSpecs are slotted, hashable and compare by value, so they are cheap to
+    build, safe to share between threads and may be used as cache keys. They
+    expose the same read-only interface as UserOption used by `construct_query`.
+    """
+    __slots__ = ('option', 'selected_transform', 'selected_aggregation', 'perform_lkp',
+                 'is_secondary', 'coalesce', 'table', 'sql_template', '_field_alias',
+                 '_key', '_hash')
+
+    def __init__(self, option, transform=_UNSET, aggregation=_UNSET, perform_lkp=_UNSET,
+                 is_secondary=_UNSET):
+        assert isinstance(option, UserOption), "option is not a UserOption"
+        transform = option.selected_transform if transform is _UNSET else transform
+        aggregation = option.selected_aggregation if aggregation is _UNSET else aggregation
+        perform_lkp = option.perform_lkp if perform_lkp is _UNSET else perform_lkp
+        is_secondary = option.is_secondary if is_secondary is _UNSET else is_secondary
+        assert transform in option.transformations, \
+            f'{transform} is an invalid transformation. Allowed=' + \
+            ','.join([str(s) for s in option.transformations])
+        assert aggregation in option.aggregations, \
+            f'{aggregation} is an invalid aggregation. Allowed=' + \
+            ','.join([str(s) for s in option.aggregations])
+        if perform_lkp is True:
+            assert option.has_dim_lkp, "Cannot set `perform_lkp=True` - no dimension table!"
+        self._set(option, transform, aggregation, perform_lkp, is_secondary,
+                  option.coalesce, option.table, option.sql_template, option._field_alias)
+
+    def _set(self, *values):
+        for k, v in zip(self.__slots__[:9], values):
+            object.__setattr__(self, k, v)
+        object.__setattr__(self, '_key', values)
+        object.__setattr__(self, '_hash', hash(values))
+
+    def derive(self, **kwargs):
+        """
+        Return a new FieldSpec with the given attributes replaced. Unlike the
+        constructor this is not validated against the catalog, since the planner
+        uses it to point fields at derived tables (CTEs). Accepted keywords are
+        `transform`, `aggregation`, `perform_lkp`, `is_secondary`, `coalesce`,
+        `table`, `sql_item` and `field_alias`.
+        """
+        values = dict(zip(self.__slots__[:9], self._key))
+        renames = dict(transform='selected_transform', aggregation='selected_aggregation',
+                       sql_item='sql_template', field_alias='_field_alias')
+        for k, v in kwargs.items():
+            k = renames.get(k, k)
+            assert k in values, f"derive: unknown FieldSpec attribute {k}"
+            values[k] = compile_template(v) if k == 'sql_template' else v
+        obj = FieldSpec.__new__(FieldSpec)
+        obj._set(*values.values())
+        return obj
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable. Use `.derive` instead.")
+
+    def __eq__(self, other):
+        return isinstance(other, FieldSpec) and self._key == other._key
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return _spec_from_key, (self._key,)
+
+    def signature(self):
+        """
+        A tuple of plain values identifying the SQL this spec generates, independent
+        of object identity (so equal for specs of separately loaded catalogs), for
+        use in persistent or cross-version cache keys.
+        """
+        option = self.option
+        dimension_table = option.dimension_table
+        return (self.item, getattr(self.table, 'name', self.table), self.sql_item,
+                self._field_alias, self.selected_transform, self.selected_aggregation,
+                bool(self.perform_lkp), bool(self.is_secondary), self.coalesce,
+                None if dimension_table is None else dimension_table.name,
+                getattr(option, 'lkp_field', None), option.dim_where)
+
+    # ~~~~~~~~~~~~~ UserOption interface ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    @property
+    def item(self):
+        return self.option.item
+
+    @property
+    def context(self):
+        return self.option.context
+
+    @property
+    def verbose(self):
+        return self.option.verbose
+
+    @property
+    def transformations(self):
+        return self.option.transformations
+
+    @property
+    def aggregations(self):
+        return self.option.aggregations
+
+    @property
+    def dimension_table(self):
+        return self.option.dimension_table
+
+    @property
+    def has_dim_lkp(self):
+        return self.option.has_dim_lkp
+
+    @property
+    def has_transformation(self):
+        return self.selected_transform is not None
+
+    @property
+    def has_aggregation(self):
+        return self.selected_aggregation is not None
+
+    @property
+    def sql_item(self):
+        return self.sql_template.source
 
-        assert isinstance(self, UserOption), "opt is not a UserOption"
+    @property
+    def sql_fieldname(self):
+        return self.sql_template.fieldname
+
+    def validate(self):
+        if self.table == 'Custom':
+            return self.item in self.context.custom_tables
+        return True
 
-        where = []  # initialise empty where clause
+    def get_table(self):
+        if self.table == 'Custom':
+            return '(\n' + self.context.custom_tables[self.item] + '\n)'
+        return self.table
+
+    @property
+    def field_alias(self):
+        return self._field_alias_logic(will_perform_lkp=self.perform_lkp)
+
+    def _field_alias_logic(self, will_perform_lkp=True, depend_agg=True):
+        aggregation = self.selected_aggregation if depend_agg else None
+        return _field_alias(self.item, self._field_alias, self.sql_template,
+                            self.has_dim_lkp and not will_perform_lkp,
+                            aggregation, self.context)
+
+    def sql_transform(self, alias=None, dialect="MSSS", coalesce=None):
+        """ See `UserOption.sql_transform`. """
+        expr, field_alias, where = self.sql_expression(alias=alias, dialect=dialect,
+                                                       coalesce=coalesce)
+        sel = expr if field_alias is None else f'{expr} AS {field_alias}'
+        return sel, list(where)
+
+    def sql_expression(self, alias=None, dialect="MSSS", coalesce=None, lkp_where=True):
+        """
+        See `UserOption.sql_expression`. Fragments are cached, so repeated renders
+        of the same field are free.
+        """
         alias = '' if (alias is None or len(alias) == 0) else alias + '.'
-        if not self.perform_lkp:
-            name, table = self.sql_item, self.table
-        else:
-            name, table = self.lkp_field, self.dimension_table
-            name = '{alias:s}' + name
-            if self.dim_where is not None:
-                dimension_where = self.dim_where.format(alias=alias)
-                where.append(dimension_where)
-        name = name.format(alias=alias)
-        datefield = self.table.primary_date_field
-
-
-        dialect = dialect.lower()
-        assert dialect in ["msss",
-                           "postgres"], "dialect must be 'MSSS' (SQL Server) or 'Postgres'"
-
-        sel = f'{name}'
-        # _____________________ TRANSFORMATION _________________________________________
-
-        if self.has_transformation:
-            t = self.selected_transform.lower().strip()
-            if t == 'not null':
-                sel = f'CASE WHEN {name:s} IS NOT NULL THEN 1 ELSE 0 END'
-            elif t in ['day', 'month', 'year']:
-                if dialect == 'msss':
-                    sel = f'{t.upper():s}({name:s})'
-                elif dialect == 'postgres':
-                    sel = f'EXTRACT({t.upper():s} FROM {name:s})'
-                else:
-                    raise Exception("Unreachable Error")
-            elif t == 'week':
-                if dialect == 'msss':
-                    sel = f'DATEADD({name:s}, (DATEDIFF({name:s}, 0, GETDATE()) / 7) * 7 + 7, 0)'
-                elif dialect == 'postgres':
-                    sel = f'{name:s} - CAST(EXTRACT(DOW FROM {name:s}) AS INT) + 1'
-                else:
-                    raise Exception("Unreachable Error")
-            elif t in ['hour', 'weekday']:
-                if dialect == 'msss':
-                    sel = f'DATEPART({t.upper():s}, {name:s})'
-                elif dialect == 'postgres':
-                    tform = t if t != 'weekday' else 'dow'
-                    sel = f'EXTRACT({tform.upper():s} FROM {name:s}) AS INT) + 1'
-                else:
-                    raise Exception("Unreachable Error")
-            elif t == 'first':
-                assert table.num_parents() < 2, "can only use 'first' on tables which join to the Person table."
-                sel = f'{name:s}'
-                where.append('ROW_NUMBER() OVER (PARTITION BY person_id ORDER BY {datefield:s}) = 1')
-            elif t == 'tens':
-                if dialect == 'msss':
-                    sel = f"CAST((({name}) / 10)*10 AS VARCHAR) + '-' +\n" + " "*10 + \
-                          f"CAST((({name}) / 10)*10+9 AS VARCHAR)"
-                elif dialect == 'postgres':
-                    sel = f"CONCAT(CAST(({name} / 10)*10 AS VARCHAR), '-', CAST(({name} / 10)*10+9 AS VARCHAR))"
-                else:
-                    raise Exception("Unreachable Error")
+        field_alias = self.field_alias if self._field_alias != '' else None
+        option = self.option
+        dim_where = option.dim_where_template if lkp_where else None
+        expr, where = _render_fragment(self.sql_template, self.table, self.perform_lkp,
+                                       option.lkp_template, option.dimension_table,
+                                       dim_where, self.selected_transform,
+                                       self.selected_aggregation, dialect, alias,
+                                       coalesce, option.verbose)
+        return expr, field_alias, where
+
+    def __repr__(self):
+        return f'FieldSpec({self.item}, tf={self.selected_transform}, ' + \
+            f'agg={self.selected_aggregation}, lkp={self.perform_lkp})'
+
+
+def _spec_from_key(key):
+    obj = FieldSpec.__new__(FieldSpec)
+    obj._set(*key)
+    return obj
+
+
+@lru_cache(maxsize=4096)
+def _field_alias(item, field_alias, sql_template, is_id, aggregation, context):
+    """
+    Cached logic for `UserOption._field_alias_logic`: the alias depends only on
+    the (hashable) arguments, so it need not be recomputed on every render.
+    """
+    if field_alias is None:
+        field_alias = str_to_fieldname(item)
+        field_alias += '_id' if is_id else ''
+        if aggregation is not None:
+            agg_prefix = aggregation.lower().strip()
+            # Transform max->has in case of CASE WHEN statements
+            if agg_prefix == 'max':
+                field_stmt = sql_template.fieldname
+                if len(field_stmt) > 3 and field_stmt[:4].lower() == 'case':
+                    agg_prefix = 'has'
+            agg_prefix = context.agg_alias_lkp.get(agg_prefix, agg_prefix)
+            field_alias = agg_prefix + '_' + field_alias
+    return field_alias
+
+
+@lru_cache(maxsize=4096)
+def _render_fragment(sql_template, table, perform_lkp, lkp_template, dimension_table,
+                     dim_where_template, transform, aggregation, dialect, alias,
+                     coalesce, verbose):
+    """
+    Render the SELECT expression (and any WHERE clauses) for a field. This is the
+    body of `UserOption.sql_expression`, cached on the field's templates, table,
+    transformation, aggregation, dialect and alias. Returns (`sel`, `where`).
+    """
+    where = []  # initialise empty where clause
+    if not perform_lkp:
+        name, table = sql_template.render(alias), table
+    else:
+        name, table = lkp_template.render(alias), dimension_table
+        if dim_where_template is not None:
+            where.append(dim_where_template.render(alias))
+    datefield = table.primary_date_field
+
+    dialect = dialect.lower()
+    assert dialect in ["msss", "postgres", "sqlite"], \
+        "dialect must be 'MSSS' (SQL Server), 'Postgres' or 'SQLite'"
+
+    sel = f'{name}'
+    # _____________________ TRANSFORMATION _________________________________________
+
+    if transform is not None:
+        t = transform.lower().strip()
+        if t == 'not null':
+            sel = f'CASE WHEN {name:s} IS NOT NULL THEN 1 ELSE 0 END'
+        elif t in ['day', 'month', 'year']:
+            if dialect == 'msss':
+                sel = f'{t.upper():s}({name:s})'
+            elif dialect == 'postgres':
+                sel = f'EXTRACT({t.upper():s} FROM {name:s})'
+            elif dialect == 'sqlite':
+                fmt = {'day': '%d', 'month': '%m', 'year': '%Y'}[t]
+                sel = f"CAST(STRFTIME('{fmt}', {name:s}) AS INTEGER)"
             else:
-                raise KeyError(f'sql_transform: Unknown transformation: {t:s}')
-
-        # _____________________ AGGREGATION ____________________________________________
-        if self.has_aggregation:
-            a = self.selected_aggregation.lower().strip()
-            if a == 'rows':
-                sel = f'COUNT({sel})'
-            elif a == 'count':
-                sel = f'COUNT(DISTINCT {sel})'
+                raise Exception("Unreachable Error")
+        elif t == 'week':
+            if dialect == 'msss':
+                sel = f'DATEADD({name:s}, (DATEDIFF({name:s}, 0, GETDATE()) / 7) * 7 + 7, 0)'
+            elif dialect == 'postgres':
+                sel = f'{name:s} - CAST(EXTRACT(DOW FROM {name:s}) AS INT) + 1'
+            elif dialect == 'sqlite':
+                sel = f"DATE({name:s}, '-' || STRFTIME('%w', {name:s}) || ' days', '+1 day')"
             else:
-                if self.verbose:
-                    warn(f'Aggregation {a} is not explicitly plumbed in. ' +
-                         f'Trying {a.upper()}')
-                sel = '{:s}({:s})'.format(a.upper(), sel)
+                raise Exception("Unreachable Error")
+        elif t in ['hour', 'weekday']:
+            if dialect == 'msss':
+                sel = f'DATEPART({t.upper():s}, {name:s})'
+            elif dialect == 'postgres':
+                tform = t if t != 'weekday' else 'dow'
+                sel = f'EXTRACT({tform.upper():s} FROM {name:s}) AS INT) + 1'
+            elif dialect == 'sqlite':
+                sel = f"CAST(STRFTIME('%H', {name:s}) AS INTEGER)" if t == 'hour' else \
+                      f"CAST(STRFTIME('%w', {name:s}) AS INTEGER) + 1"
+            else:
+                raise Exception("Unreachable Error")
+        elif t == 'first':
+            assert table.num_parents() < 2, "can only use 'first' on tables which join to the Person table."
+            sel = f'{name:s}'
+            where.append('ROW_NUMBER() OVER (PARTITION BY person_id ORDER BY {datefield:s}) = 1')
+        elif t == 'tens':
+            if dialect == 'msss':
+                sel = f"CAST((({name}) / 10)*10 AS VARCHAR) + '-' +\n" + " "*10 + \
+                      f"CAST((({name}) / 10)*10+9 AS VARCHAR)"
+            elif dialect == 'postgres':
+                sel = f"CONCAT(CAST(({name} / 10)*10 AS VARCHAR), '-', CAST(({name} / 10)*10+9 AS VARCHAR))"
+            elif dialect == 'sqlite':
+                sel = f"CAST(({name} / 10)*10 AS TEXT) || '-' || CAST(({name} / 10)*10+9 AS TEXT)"
+            else:
+                raise Exception("Unreachable Error")
+        else:
+            raise KeyError(f'sql_transform: Unknown transformation: {t:s}')
+
+    # _____________________ AGGREGATION ____________________________________________
+    if aggregation is not None:
+        a = aggregation.lower().strip()
+        if a == 'rows':
+            sel = f'COUNT({sel})'
+        elif a == 'count':
+            sel = f'COUNT(DISTINCT {sel})'
+        else:
+            if verbose:
+                warn(f'Aggregation {a} is not explicitly plumbed in. ' +
+                     f'Trying {a.upper()}')
+            sel = '{:s}({:s})'.format(a.upper(), sel)
 
-        # ________________ Coalesce with default (if left join) _______________________
-        if coalesce is not None:
-            coalesce = f"'{coalesce}'" if isinstance(coalesce, str) else str(coalesce)
-            sel = f"COALESCE({sel}, {coalesce})"
+    # ________________ Coalesce with default (if left join) _______________________
+    if coalesce is not None:
+        coalesce = f"'{coalesce}'" if isinstance(coalesce, str) else str(coalesce)
+        sel = f"COALESCE({sel}, {coalesce})"
 
-        if self._field_alias != '':
-            sel += f' AS {self.field_alias}'
-        return sel, where
+    return sel, tuple(where)
 
 
 class UserOptionCompound(UserOption):
@@ -329,9 +579,53 @@ class UserOptionCompound(UserOption):
 # e.g. discharge type including death and C19 status.
 
 
-def read_all_fields_from_yaml(filename, context, tbl_lkp, dim_lkp_where=None):
+def load_fields_yaml(filename):
+    """
+    Parse the field definitions file: {table name: {field name: payload}}.
+    """
+    import yaml     # optional dependency: only required to read the field definitions
     with open(filename, "r") as f:
-        fields_data = yaml.load(f, Loader=yaml.CLoader)
+        return yaml.load(f, Loader=getattr(yaml, 'CLoader', yaml.Loader))
+
+
+def read_table_fields(tbl, items_in_tbl, context, tbl_lkp, dim_lkp_where=None):
+    """
+    Construct the UserOptions for the fields `items_in_tbl` ({field name: payload},
+    as in the YAML file) of the table `tbl`.
+    """
+    table_fields = dict()
+    for field_nm, payload in items_in_tbl.items():
+        if (len(payload) == 5) and payload[4] is not None:
+            # IGNORE
+            continue
+        stmt = payload[0]
+        has_transforms = (len(payload) > 1) and (payload[1] is not None)
+        transformations = payload[1] if has_transforms else [None]
+        has_aggregations = (len(payload) > 2) and (payload[2] is not None)
+        aggregations = payload[2] if has_aggregations else [None]
+        def_agg = None if None in aggregations else aggregations[0]
+
+        if len(payload) > 3:
+            lkp_tbl, lkp_def, lkp_where = payload[3]
+            lkp_tbl = tbl_lkp[lkp_tbl]
+            if lkp_where is not None and lkp_where[0] == '$':
+                assert dim_lkp_where is not None, "dim_lkp_where must be specified."
+                lkp_where = dim_lkp_where[lkp_where[1:]]
+        else:
+            lkp_tbl, lkp_def, lkp_where = None, False, None
+        field = UserOption(field_nm, stmt, tbl, context,
+                           transformations=transformations,
+                           aggregations=aggregations,
+                           dimension_table=lkp_tbl,
+                           perform_lkp=lkp_def,
+                           dim_where=lkp_where,
+                           default_aggregation=def_agg)
+        table_fields[field_nm] = field
+    return table_fields
+
+
+def read_all_fields_from_yaml(filename, context, tbl_lkp, dim_lkp_where=None):
+    fields_data = load_fields_yaml(filename)
 
     all_fields = dict()
     for tbl_nm, tbl in tbl_lkp.items():
@@ -339,33 +633,8 @@ def read_all_fields_from_yaml(filename, context, tbl_lkp, dim_lkp_where=None):
         if len(items_in_tbl) == 0:
             # No items for Table in YAML file.
             continue
-        for field_nm, payload in items_in_tbl.items():
-            if (len(payload) == 5) and payload[4] is not None:
-                # IGNORE
-                continue
-            stmt = payload[0]
-            has_transforms = (len(payload) > 1) and (payload[1] is not None)
-            transformations = payload[1] if has_transforms else [None]
-            has_aggregations = (len(payload) > 2) and (payload[2] is not None)
-            aggregations = payload[2] if has_aggregations else [None]
-            def_agg = None if None in aggregations else aggregations[0]
-
-            if len(payload) > 3:
-                lkp_tbl, lkp_def, lkp_where = payload[3]
-                lkp_tbl = tbl_lkp[lkp_tbl]
-                if lkp_where is not None and lkp_where[0] == '$':
-                    assert dim_lkp_where is not None, "dim_lkp_where must be specified."
-                    lkp_where = dim_lkp_where[lkp_where[1:]]
-            else:
-                lkp_tbl, lkp_def, lkp_where = None, False, None
-            field = UserOption(field_nm, stmt, tbl, context,
-                               transformations=transformations,
-                               aggregations=aggregations,
-                               dimension_table=lkp_tbl,
-                               perform_lkp=lkp_def,
-                               dim_where=lkp_where,
-                               default_aggregation=def_agg)
-            all_fields[field_nm] = field
+        all_fields.update(read_table_fields(tbl, items_in_tbl, context, tbl_lkp,
+                                            dim_lkp_where=dim_lkp_where))
 
     return all_fields
 
@@ -1,6 +1,5 @@
-import queue
-from copy import copy, deepcopy
-from collections import defaultdict
+from array import array
+from collections import deque
 
 # This file exists in order to deal with generic graph structures. The `dbtree.py`
 # file also implements a graph structure, but it is inherently tied to the schema data
@@ -8,17 +7,40 @@ from collections import defaultdict
 # more efficient algorithms.
 
 # https://stackoverflow.com/a/30747003
-# With thanks to author mVChr for the basic Graph structure.
-# I've only added the "distance_from_leaf", "topological_sort" and "copy" methods.
+# With thanks to author mVChr for the basic Graph structure (the public methods
+# below). Nodes are now mapped to dense integer ids internally, and the traversals
+# run over a compressed sparse row (CSR) copy of the adjacency.
 class Graph(object):
-    """ Graph data structure, undirected by default. """
+    """
+    Graph data structure, undirected by default.
+
+    Nodes may be any hashable objects: each is mapped to a dense integer id on
+    insertion, and adjacency is kept as insertion-ordered lists of ids so that
+    traversals are deterministic. The traversals (BFS, leaf distances, leaf
+    peeling) run over a CSR form of the adjacency (`array`s of offsets and
+    targets), which is built lazily and cached until the graph is next modified.
+    None of the traversals mutate the graph.
+    """
 
     def __init__(self, connections, directed=False):
-        self._graph = defaultdict(set)
+        self._ids = {}          # node -> int
+        self._nodes = []        # int -> node (None if removed)
+        self._adj = []          # int -> {int: None} (ordered set of neighbours)
+        self._csr = None
         self._directed = directed
         self.add_connections(connections)
         self.data = {}
 
+    def _id(self, node):
+        """ Get (or create) the integer id of node """
+
+        i = self._ids.get(node)
+        if i is None:
+            i = self._ids[node] = len(self._nodes)
+            self._nodes.append(node)
+            self._adj.append({})
+        return i
+
     def add_connections(self, connections):
         """ Add connections (list of tuple pairs) to graph """
 
@@ -28,117 +50,162 @@ class Graph(object):
     def add(self, node1, node2):
         """ Add connection between node1 and node2 """
 
-        self._graph[node1].add(node2)
-        # if node1 not in self.data:
-        #     self.data[node1] = 0
+        i, j = self._id(node1), self._id(node2)
+        self._adj[i][j] = None
         if not self._directed:
-            self._graph[node2].add(node1)
-            # if node2 not in self.data:
-            #     self.data[node2] = 0
-
+            self._adj[j][i] = None
+        self._csr = None
 
     def remove(self, node):
         """ Remove all references to node """
 
-        for n, cxns in self._graph.items():  # python3: items(); python2: iteritems()
-            try:
-                cxns.remove(node)
-            except KeyError:
-                pass
-        try:
-            del self._graph[node]
-            del self.data[node]
-        except KeyError:
-            pass
+        i = self._ids.pop(node, None)
+        if i is None:
+            return
+        for cxns in self._adj:
+            cxns.pop(i, None)
+        self._adj[i] = {}
+        self._nodes[i] = None
+        self.data.pop(node, None)
+        self._csr = None
+
+    def nodes(self):
+        """ All nodes in the graph (in insertion order) """
+
+        return [v for v in self._nodes if v is not None]
+
+    def __contains__(self, node):
+        return node in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def csr(self):
+        """
+        The adjacency in compressed sparse row form: `(offsets, targets)`, such
+        that the neighbours of node id `i` are `targets[offsets[i]:offsets[i+1]]`.
+        """
+        if self._csr is None:
+            offsets, targets = array('l', [0]), array('l')
+            for cxns in self._adj:
+                targets.extend(cxns)
+                offsets.append(len(targets))
+            self._csr = (offsets, targets)
+        return self._csr
+
+    def neighbours(self, node):
+        """ Nodes directly connected to node (in insertion order) """
+
+        i = self._ids.get(node)
+        if i is None:
+            return []
+        return [self._nodes[j] for j in self._adj[i]]
 
     def is_connected(self, node1, node2):
         """ Is node1 directly connected to node2 """
 
-        return node1 in self._graph and node2 in self._graph[node1]
+        i, j = self._ids.get(node1), self._ids.get(node2)
+        return i is not None and j is not None and j in self._adj[i]
+
+    def _bfs(self, sources):
+        """
+        BFS from the node ids `sources` over the CSR adjacency. Returns the arrays
+        (distance, predecessor), with -1 for unreachable nodes / no predecessor.
+        """
+        offsets, targets = self.csr()
+        n = len(self._nodes)
+        dist, pred = array('l', [-1]) * n, array('l', [-1]) * n
+        Q = deque()
+        for s in sources:
+            dist[s] = 0
+            Q.append(s)
+        while Q:
+            v = Q.popleft()
+            for k in range(offsets[v], offsets[v + 1]):
+                w = targets[k]
+                if dist[w] < 0:
+                    dist[w] = dist[v] + 1
+                    pred[w] = v
+                    Q.append(w)
+        return dist, pred
+
+    def find_path(self, node1, node2):
+        """ Find a shortest path between node1 and node2 (None if not connected) """
 
-    def find_path(self, node1, node2, path=[]):
-        """ Find any path between node1 and node2 (may not be shortest) """
-
-        path = path + [node1]
         if node1 == node2:
-            return path
-        if node1 not in self._graph:
+            return [node1]
+        i, j = self._ids.get(node1), self._ids.get(node2)
+        if i is None or j is None:
+            return None
+        dist, pred = self._bfs([i])
+        if dist[j] < 0:
             return None
-        for node in self._graph[node1]:
-            if node not in path:
-                new_path = self.find_path(node, node2, path)
-                if new_path:
-                    return new_path
-        return None
+        path = [j]
+        while path[-1] != i:
+            path.append(pred[path[-1]])
+        return [self._nodes[k] for k in reversed(path)]
 
     def is_leaf(self, node):
-        return len(self._graph[node]) <= 1
+        i = self._ids.get(node)
+        return i is None or len(self._adj[i]) <= 1
 
     def calculate_dist_from_leaves(self):
-        Q = queue.Queue()
-        visited = set()
-
-        # set up leaves
-        for v in self._graph.keys():
-            if self.is_leaf(v):
-                self.data[v] = 0
-                Q.put(v)
-                visited.add(v)
-
+        live = [i for i, v in enumerate(self._nodes) if v is not None]
+        leaves = [i for i in live if len(self._adj[i]) <= 1]
         # perform BFS from all leaves
-        while not Q.empty():
-            v = Q.get()
-            for w in self._graph[v]:
-                if w not in visited:
-                    self.data[w] = self.data[v] + 1
-                    visited.add(w)
-                    Q.put(w)
+        dist, _ = self._bfs(leaves)
+        for i in live:
+            if dist[i] >= 0:
+                self.data[self._nodes[i]] = dist[i]
 
     def topological_sort(self, leave_until_last=None):
+        """
+        Order the nodes of a tree by repeatedly removing leaves. If specified,
+        `leave_until_last` is deferred until it is the only node remaining. Edges
+        are not removed from the graph: instead the remaining degree of each node
+        is tracked, so the graph may be shared (e.g. between threads).
+        """
         assert not self._directed, "currently only implemented for undirected graphs"
+        offsets, targets = self.csr()
+        n = len(self._nodes)
+        degree = array('l', (offsets[i + 1] - offsets[i] for i in range(n)))
+        done = bytearray(n)
+        last = self._ids.get(leave_until_last, -1) if leave_until_last is not None else -1
         result = []
-        G = self.copy()
-        # if leave_until_last:
-        #     # get the copy of leave_until_last object (ow. will fail for eq further down)
-        #     try:
-        #         leave_until_last = [v for v in G._graph.keys()
-        #                             if v.name == leave_until_last.name]
-        #     except AttributeError:
-        #         leave_until_last = [v for v in G._graph.keys() if v == leave_until_last]
-        #     assert len(leave_until_last) == 1, "leave_until_last value is not unique in G"
-        #     leave_until_last = leave_until_last[0]
-        # Need to take copy since we need to mutate (rm edges) graph
-        # ENSURE NO REFERENCES TO SELF IN THE BELOW CODE (subtle bugs).
-        Q = queue.Queue()
         # add leaf nodes to the queue:
-        for k in G._graph.keys():
-            if G.is_leaf(k):
-                Q.put(k)
+        Q = deque(i for i in range(n) if self._nodes[i] is not None and degree[i] <= 1)
         # loop over queue
-        while not Q.empty():
-            v = Q.get()
-            if (v == leave_until_last) and (not Q.empty()):
-                Q.put(v)
+        while Q:
+            v = Q.popleft()
+            if v == last and Q:
+                Q.append(v)
                 continue
-            result.append(v)
-            while len(G._graph[v]) > 0:
-                m = G._graph[v].pop()
-                G._graph[m].remove(v)
-                if len(G._graph[m]) == 1:
-                    Q.put(m)
+            result.append(self._nodes[v])
+            done[v] = 1
+            for k in range(offsets[v], offsets[v + 1]):
+                m = targets[k]
+                if done[m]:
+                    continue
+                degree[m] -= 1
+                if degree[m] == 1:
+                    Q.append(m)
         return result
 
     def __str__(self):
-        return '{}({})'.format(self.__class__.__name__, dict(self._graph))
+        adjacency = {v: self.neighbours(v) for v in self.nodes()}
+        return '{}({})'.format(self.__class__.__name__, adjacency)
 
     def copy(self):
         return self.__copy__()
 
     def __copy__(self):
         obj = type(self).__new__(self.__class__)
-        obj._graph = copy(self._graph)
+        obj._ids = dict(self._ids)
+        obj._nodes = list(self._nodes)
+        obj._adj = [dict(cxns) for cxns in self._adj]
+        obj._csr = self._csr       # arrays are never modified in place
         obj._directed = self._directed
-        obj.data = deepcopy(self.data)
+        obj.data = dict(self.data)
         return obj
 
 
@@ -148,3 +215,5 @@ if __name__ == "__main__":
                  ('a', 'h'), ('h', 'i'), ('i', 'j'), ('i', 'k'), ('e', 'l')])
     out = tmp.topological_sort(leave_until_last='a')
     print(out)
+    assert out == tmp.topological_sort(leave_until_last='a'), "sort mutated the graph"
+    print(tmp.find_path('g', 'k'))
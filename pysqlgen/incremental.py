@@ -0,0 +1,266 @@
+import hashlib
+from . import partial, snapshot
+from .compiled import planner_digest
+from .partial import _date_literal, partial_statement, ShardedQuery
+
+# Incremental refresh of the results of chosen queries. Fact tables are mostly
+# appended to between loads, so a stored query keeps the partial aggregates of its
+# rows (as a shard would: see `pysqlgen.partial`), and a high-water mark on each
+# table in its FROM clause (the root table and the tables joined to it): the maximum
+# of its primary date field (or, failing that, of its first primary key, e.g.
+# person_id). A row of the query is made of one row of each of these tables, and is
+# new if any of them is above its mark. On refresh, the partial query of only the
+# new rows (the delta) is run, and its partials are combined with the stored ones
+# by the decomposable aggregations.
+#
+# The planner joins tables with LEFT JOIN, so a row of the root (or of a parent
+# table) without any row of a joined table gives a row of NULLs for that table. Its
+# first rows replace this row, which a delta cannot remove. So a joined table takes
+# a delta only if each of its new rows joins to a key which already had a row of
+# the table (e.g. a new measurement of a person already measured); otherwise the
+# query is rebuilt. Appended root rows only add rows to the query.
+#
+# Other changes are detected, and trigger a full rebuild:
+#   * late-arriving rows of a table in the FROM clause: the count of its rows at or
+#     below its mark (or without a mark value) has changed;
+#   * any change to another table the query touches: its row count or the maximum of
+#     its date (or key) column has changed. These are dimension tables, and the
+#     tables within CTEs: a CTE aggregates its rows per key before the join (e.g.
+#     whether a person has had a positive test), so a new row may change the value
+#     of a key rather than add rows to the query.
+# All of this is checked by a single statement of scalar subqueries. Updates in
+# place, which change neither count nor maximum, are not detected.
+
+STORE_VERSION = 2
+
+
+def _literal(x, dialect='MSSS'):
+    return str(x) if isinstance(x, (int, float)) and not isinstance(x, bool) \
+        else _date_literal(x, dialect)
+
+
+def _mark_column(node):
+    return node.primary_date_field if node.primary_date_field is not None else node.pk[0]
+
+
+def _table(context, node):
+    schema = context.schema if node.schema is None else node.schema
+    return ('' if schema == '' else schema + '.') + node.name
+
+
+def _above(col, mark, dialect):
+    """ Condition for the rows of `col` above `mark` (with a value, if None) """
+    return f'{col} IS NOT NULL' if mark is None else f'{col} > {_literal(mark, dialect)}'
+
+
+def _at_most(col, mark, dialect):
+    """ Condition for the rows of `col` at or below `mark`, or without a value """
+    return f'{col} IS NULL' if mark is None else \
+        f'({col} <= {_literal(mark, dialect)} OR {col} IS NULL)'
+
+
+def fingerprint_parts(context, node):
+    """
+    Scalar subqueries for the row count of the table `node`, and the maximum of its
+    primary date field (or first primary key): a change to either is a change to
+    the table (short of an update in place).
+    """
+    table = _table(context, node)
+    return [f'SELECT COUNT(*) FROM {table}',
+            f'SELECT MAX({_mark_column(node)}) FROM {table}']
+
+
+class IncrementalQuery:
+    """
+    IncrementalQuery: the stored result of the query `args` (as `construct_query`),
+    refreshed from the new rows of the tables in its FROM clause (see `refresh`).
+    `rows()` are the rows of the query, in the order of `columns`. Raises ValueError
+    if an aggregation is not decomposable.
+    """
+    def __init__(self, *args, dialect='MSSS', allow_coalesce=True):
+        stmt, plan = partial_statement(*args, dialect=dialect,
+                                       allow_coalesce=allow_coalesce)
+        root = next(iter(stmt._from))
+        if root.is_cte:
+            raise ValueError('The root of the query is not a table.')
+        context = stmt.context
+        self.stmt, self.dialect = stmt, dialect
+        self.query = ShardedQuery([], {}, None, [name for name, _, _, _ in plan],
+                                  stmt.columns, [p[1:] for p in plan],
+                                  any(o.has_aggregation for o in stmt.fields))
+        self.root = root
+        # the tables with a mark: those joined in the FROM clause (not within a CTE,
+        # whose rows are aggregated before the join), with the join columns of each.
+        in_ctes = {name for node in stmt.ctes.nodes()
+                   for name in stmt.ctes.inner(node).tables()}
+        self.facts = [node for node in stmt._from
+                      if not node.is_cte and node.name not in in_ctes]
+        self.keys = {node: [cols for table, cols in stmt._from[node] if table is node][0]
+                     for node in self.facts[1:]}
+        self.fields = {node: (stmt.aliases[node] + '.' if stmt.aliases[node] else '') +
+                       _mark_column(node) for node in self.facts}
+        nodes = {node.name: node for node in context.nodes}
+        marked = {node.name for node in self.facts}
+        self.others = [nodes[name] for name in stmt.tables()
+                       if name not in marked and name in nodes]
+
+        self.marks = None       # ((watermark, count) of each table in `facts`)
+        self.fingerprint = None     # (count and maximum of each other table)
+        self.partials = None
+        stmt.where.append(None)
+
+    @property
+    def columns(self):
+        return self.query.columns
+
+    def state_sql(self):
+        """
+        SQL for the state of the tables. For each table with a mark: the maximum of
+        the mark column, the number of rows, and the number of rows at or below the
+        current watermark (or without a value); for each joined table, also the
+        number of its rows above the watermark whose key had no row of the table at
+        or below it. Then the count and maximum of each other table.
+        """
+        context, dialect, parts = self.stmt.context, self.dialect, []
+        marks = self.marks or [(None, None)] * len(self.facts)
+        for node, (watermark, _) in zip(self.facts, marks):
+            table, col = _table(context, node), _mark_column(node)
+            parts += [f'SELECT MAX({col}) FROM {table}', f'SELECT COUNT(*) FROM {table}',
+                      f'SELECT COUNT(*) FROM {table} WHERE '
+                      f'{_at_most(col, watermark, dialect)}']
+            if node in self.keys:
+                key = self.keys[node]
+                parts.append(
+                    f'SELECT COUNT(*) FROM {table} n WHERE '
+                    f'{_above("n." + col, watermark, dialect)} AND ' +
+                    ' AND '.join(f'n.{k} IS NOT NULL' for k in key) +
+                    f' AND NOT EXISTS (SELECT 1 FROM {table} o WHERE ' +
+                    ' AND '.join(f'o.{k} = n.{k}' for k in key) +
+                    f' AND {_at_most("o." + col, watermark, dialect)})')
+        for node in self.others:
+            parts += fingerprint_parts(context, node)
+        return 'SELECT ' + ', '.join(f'({p})' for p in parts)
+
+    def partial_sql(self, upper, lower=None):
+        """
+        SQL for the partial rows of the query from the rows of the tables with a
+        mark at most `upper` (one mark per table in `facts`), or without a mark
+        value. With `lower`, only the rows with some table above its mark in `lower`
+        are included.
+        """
+        dialect = self.dialect
+        where = [_at_most(self.fields[node], mark, dialect)
+                 for node, mark in zip(self.facts, upper)]
+        if lower is not None:
+            where.append('(' + ' OR '.join(
+                f'({_above(self.fields[node], lo, dialect)})'
+                for node, lo, hi in zip(self.facts, lower, upper) if lo != hi) + ')')
+        self.stmt.where[-1] = ' AND '.join(where)
+        return self.stmt.generate_statement(dialect=self.dialect, pretty=False)
+
+    def refresh(self, execute):
+        """
+        Bring the stored result up to date. `execute(sql)` runs SQL on the database
+        and returns its rows. Returns 'built' (all rows were aggregated: the first
+        refresh, or after other changes than appended rows), 'delta' (the new rows
+        were aggregated and combined with the stored partials) or 'unchanged'.
+        """
+        state = list(execute(self.state_sql())[0])
+        marks, unjoined = [], 0
+        for node in self.facts:
+            mark, total, kept = state[:3]
+            marks.append((mark, total, kept))
+            unjoined += state[3] if node in self.keys else 0
+            del state[:3 + (node in self.keys)]
+        fingerprint = tuple(state)
+        upper = [mark for mark, _, _ in marks]
+        if self.partials is None or fingerprint != self.fingerprint or unjoined > 0 or \
+                any(kept != count for (_, _, kept), (_, count) in zip(marks, self.marks)):
+            status = 'built'
+            self.partials = self.query.combine([execute(self.partial_sql(upper))])
+        elif all(mark == watermark for mark, (watermark, _) in zip(upper, self.marks)):
+            return 'unchanged'
+        else:
+            status = 'delta'
+            lower = [watermark for watermark, _ in self.marks]
+            delta = execute(self.partial_sql(upper, lower))
+            self.partials = self.query.combine([self.partials, delta])
+        # (rows appended since the state was read are caught by the next refresh: they
+        # are either above a mark, or change the count at or below it.)
+        self.marks = tuple((mark, total) for mark, total, _ in marks)
+        self.fingerprint = fingerprint
+        return status
+
+    def rows(self):
+        """ The rows of the query as of the last refresh """
+        assert self.partials is not None, "The query has not been refreshed."
+        return self.query.merge([self.partials])
+
+    def state(self):
+        return self.marks, self.fingerprint, self.partials
+
+    def restore(self, state):
+        self.marks, self.fingerprint, self.partials = state
+
+
+def query_key(*args, dialect='MSSS', allow_coalesce=True):
+    """ A key of plain values for the query `args`, the same across catalog loads """
+    return (dialect, bool(allow_coalesce), tuple(o.signature() for o in args))
+
+
+def store_digest():
+    """ Content hash of the planner and the partial aggregation (see planner_digest) """
+    h = hashlib.sha256(f'{STORE_VERSION}:{planner_digest()}'.encode())
+    with open(partial.__file__, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+class AggregateStore:
+    """
+    AggregateStore: a store of IncrementalQuery results for chosen queries (`add`),
+    refreshed together (`refresh`). If `filename` is given, the stored partials and
+    watermarks are loaded from it (if it was written by the same planner) and saved
+    to it after each refresh, so that an app restart need not rebuild them.
+    """
+    def __init__(self, context, dialect='MSSS', filename=None):
+        self.context = context
+        self.dialect = dialect
+        self.filename = filename
+        self.queries = dict()       # key -> IncrementalQuery
+        self._saved = dict()
+        if filename is not None:
+            self._saved = snapshot.read_snapshot(filename, store_digest(), context) or {}
+
+    def add(self, *args, allow_coalesce=True):
+        """
+        Add the query `args` (if not already stored) and return its key. Raises
+        ValueError if the query cannot be refreshed incrementally.
+        """
+        key = query_key(*args, dialect=self.dialect, allow_coalesce=allow_coalesce)
+        if key not in self.queries:
+            query = IncrementalQuery(*args, dialect=self.dialect,
+                                     allow_coalesce=allow_coalesce)
+            if key in self._saved:
+                query.restore(self._saved[key])
+            self.queries[key] = query
+        return key
+
+    def refresh(self, execute, keys=None):
+        """
+        Refresh the stored queries (or those of `keys`) with `execute(sql)`: see
+        IncrementalQuery.refresh. Returns {key: status}.
+        """
+        keys = list(self.queries) if keys is None else keys
+        status = {key: self.queries[key].refresh(execute) for key in keys}
+        if self.filename is not None and any(s != 'unchanged' for s in status.values()):
+            self.save()
+        return status
+
+    def rows(self, key):
+        return self.queries[key].rows()
+
+    def save(self):
+        self._saved.update({key: q.state() for key, q in self.queries.items()
+                            if q.partials is not None})
+        snapshot.write_snapshot(self.filename, self._saved, store_digest(), self.context)
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from warnings import warn
+from .compiled import planner_digest
+from .dbtree import CTENode, LookupNode, SummaryNode
+from .incremental import _table, fingerprint_parts
+from .query import UNSUPPORTED_QUERY, _cte_statement, build_statement
+
+# Materialization of recurring CTEs. Many queries aggregate the same CTE, e.g. the
+# average length of stay per visit. `recurring_ctes` finds the CTEs of a workload of
+# specs by their signature (parent, keys and field specs), and a SummaryStore keeps
+# a physical summary table of the rows of each of the most frequent ones. When
+# given the store (`build_statement(..., summaries=store)`), the planner reads a CTE
+# from its summary table, if that is fresh, in place of computing it. Only the CTEs
+# of the outer query are substituted (not those nested within a CTE, nor the CTE of
+# late lookups).
+#
+# A summary is fresh if it was built by the same planner from the current state of
+# its source tables: the row count and the maximum of the date (or key) column of
+# each (see `incremental.fingerprint_parts`), all read by one statement. The state
+# at build time is kept in a metadata table in the database, so that every process
+# of an app sees the same summaries: one (e.g. a scheduled job) refreshes them,
+# rebuilding stale ones, and the others only check them (`rebuild=False`). Between
+# checks, summaries are trusted for at most `max_age` seconds. The summaries are
+# built in order of frequency until their total rows exceed `max_rows`; the metadata
+# also records those over the budget (with their rows), which are then not built
+# again while their sources are unchanged.
+
+META_TABLE = 'pysqlgen_summaries'
+_TEXT = {'MSSS': 'VARCHAR(MAX)', 'Postgres': 'TEXT', 'SQLite': 'TEXT'}
+
+
+def cte_key(node):
+    """ The signature of the CTE `node`, of plain values (as FieldSpec.signature) """
+    return (tuple(p.name for p in node.parents), tuple(node.pk),
+            tuple(f.signature() for f in node.fields))
+
+
+def _quote(s):
+    return "'" + str(s).replace("'", "''") + "'"
+
+
+def recurring_ctes(workload, dialect='MSSS', min_count=2, **build_kwargs):
+    """
+    The CTEs of the outer queries of a `workload` (an iterable of specs, which may
+    repeat) used at least `min_count` times: a list of (CTENode, count), most
+    frequent first. Specs which the planner does not support are skipped.
+    """
+    counts, nodes = OrderedDict(), dict()
+    for specs in workload:
+        try:
+            stmt = build_statement(*specs, dialect=dialect, **build_kwargs)
+        except UNSUPPORTED_QUERY:
+            continue
+        for node in stmt.ctes:
+            if isinstance(node, CTENode) and not isinstance(node, LookupNode):
+                key = cte_key(node)
+                nodes.setdefault(key, node)
+                counts[key] = counts.get(key, 0) + 1
+    out = [(nodes[key], n) for key, n in counts.items() if n >= min_count]
+    return sorted(out, key=lambda x: -x[1])
+
+
+class Summary:
+    """
+    Summary: the summary table of the CTE `node`, and the SQL to build it. Raises
+    ValueError if it cannot be built in the dialect.
+    """
+    def __init__(self, node, schema, dialect):
+        context = node.fields[0].context
+        stmt = _cte_statement(node, dialect)
+        key = cte_key(node)
+        self.key = key
+        self.digest = hashlib.sha256(json.dumps([planner_digest(), key], default=str)
+                                     .encode()).hexdigest()
+        self.name = f'{node.name}_{self.digest[:8]}'
+        self.node = SummaryNode(node, self.name, schema)
+        self.table = _table(context, self.node)
+        names = {n.name: n for n in context.nodes}
+        self.sources = [names[name] for name in stmt.tables() if name in names]
+        if dialect == 'MSSS':
+            if not stmt.can_inline(dialect):
+                raise ValueError(f'The CTE {node.name} cannot be written as a derived '
+                                 f'table.')
+            inline = stmt.generate_statement(dialect=dialect, pretty=False,
+                                             inline_ctes=True)
+            self.create = f'SELECT * INTO {self.table} FROM ({inline}) AS t'
+        else:
+            sql = stmt.generate_statement(dialect=dialect, pretty=False)
+            self.create = f'CREATE TABLE {self.table} AS {sql}'
+
+
+class SummaryStore:
+    """
+    SummaryStore: summary tables of CTEs (`add`, `advise`) in `schema` (by default
+    the context's), kept fresh by `refresh`. Pass the store to the planner as
+    `summaries`: `get(cte)` is the SummaryNode of a fresh summary, or None.
+
+    :param max_rows - the size budget: the most rows of all summary tables together.
+    :param max_age - the seconds for which a check of freshness is trusted.
+    """
+    def __init__(self, context, dialect='MSSS', schema=None, max_rows=None, max_age=None):
+        self.context = context
+        self.dialect = dialect
+        self.schema = context.schema if schema is None else schema
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.summaries = OrderedDict()      # key -> Summary, in order of priority
+        self._fresh = dict()                # key -> SummaryNode
+        self.errors = dict()                # summary name -> error of its last build
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def add(self, node):
+        """ Add a summary of the CTE `node` (if not already added) """
+        key = cte_key(node)
+        if key not in self.summaries:
+            self.summaries[key] = Summary(node, self.schema, self.dialect)
+        return self.summaries[key]
+
+    def advise(self, workload, min_count=2, max_tables=None, **build_kwargs):
+        """
+        Add summaries of the CTEs recurring in `workload` (see `recurring_ctes`), at
+        most `max_tables`. Returns the list of (Summary, count).
+        """
+        out = []
+        for node, n in recurring_ctes(workload, self.dialect, min_count, **build_kwargs):
+            if max_tables is not None and len(out) >= max_tables:
+                break
+            try:
+                out.append((self.add(node), n))
+            except ValueError:
+                continue
+        return out
+
+    def get(self, node):
+        if len(self._fresh) == 0 or (self.max_age is not None and
+                                     time.time() - self._checked > self.max_age):
+            return None
+        return self._fresh.get(cte_key(node))
+
+    @property
+    def meta_table(self):
+        return ('' if self.schema == '' else self.schema + '.') + META_TABLE
+
+    def _create_meta(self, execute):
+        text = _TEXT.get(self.dialect, 'TEXT')
+        create = f'CREATE TABLE {self.meta_table} (name VARCHAR(128), digest ' \
+                 f'VARCHAR(64), fingerprint {text}, n_rows INTEGER, built_at FLOAT, ' \
+                 f'built INTEGER)'
+        if self.dialect == 'MSSS':
+            execute(f"IF OBJECT_ID('{self.meta_table}') IS NULL {create}")
+        else:
+            execute(create.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+
+    def _state(self, execute):
+        """ {table name: its fingerprint} of the source tables of all summaries """
+        nodes = list(OrderedDict.fromkeys(node for s in self.summaries.values()
+                                          for node in s.sources))
+        if len(nodes) == 0:
+            return {}
+        parts = [p for node in nodes for p in fingerprint_parts(self.context, node)]
+        values = execute('SELECT ' + ', '.join(f'({p})' for p in parts))[0]
+        return {node.name: values[2 * i:2 * i + 2] for i, node in enumerate(nodes)}
+
+    def refresh(self, execute, rebuild=True):
+        """
+        Check the summaries against the current state of their source tables, with
+        `execute(sql)` (which runs SQL on the database, returning its rows), and
+        (if `rebuild`) build any stale ones within the size budget. Returns {summary
+        name: status}, one of 'fresh', 'built', 'stale' (not rebuilt), 'over budget'
+        (not built, or dropped) or 'failed' (the database could not build it: the
+        error is kept in `errors`, and warned of). Only fresh and built summaries
+        are then substituted.
+
+        A summary is not built if the rows of its last build exceed the budget left,
+        and one found over budget is not built again while its sources are unchanged.
+        """
+        with self._lock:
+            self._create_meta(execute)
+            meta = {name: rest for name, *rest in execute(
+                f'SELECT name, digest, fingerprint, n_rows, built FROM {self.meta_table}')}
+            state = self._state(execute)
+            status, fresh, used = OrderedDict(), dict(), 0
+
+            def fits(n_rows):
+                return self.max_rows is None or used + n_rows <= self.max_rows
+
+            for key, s in self.summaries.items():
+                fingerprint = json.dumps([state[node.name] for node in s.sources],
+                                         default=str)
+                digest, stored, n_rows, built = meta.get(s.name, (None, None, None, 0))
+                known = digest == s.digest      # (n_rows is of the same SQL)
+                if known and stored == fingerprint and built:
+                    status[s.name] = 'fresh'
+                elif known and stored == fingerprint and not fits(n_rows):
+                    status[s.name] = 'over budget'      # (and unchanged since)
+                    continue
+                elif not rebuild:
+                    status[s.name] = 'stale'
+                    continue
+                else:
+                    self._fresh.pop(key, None)      # (not substituted while rebuilt)
+                    self._drop(execute, s)
+                    if known and not fits(n_rows):  # (estimated by its last build)
+                        self._insert_meta(execute, s, fingerprint, n_rows, built=False)
+                        status[s.name] = 'over budget'
+                        continue
+                    try:
+                        execute(s.create)
+                    except Exception as e:  # (e.g. a function the database lacks)
+                        self.errors[s.name] = f'{type(e).__name__}: {e}'
+                        warn(f'SummaryStore: {s.name} not built: {self.errors[s.name]}')
+                        status[s.name] = 'failed'
+                        continue
+                    self.errors.pop(s.name, None)
+                    n_rows = execute(f'SELECT COUNT(*) FROM {s.table}')[0][0]
+                    self._insert_meta(execute, s, fingerprint, n_rows, built=True)
+                    status[s.name] = 'built'
+                if not fits(n_rows):
+                    if rebuild:
+                        self._drop(execute, s)
+                        self._insert_meta(execute, s, fingerprint, n_rows, built=False)
+                    status[s.name] = 'over budget'
+                    continue
+                used += n_rows
+                fresh[key] = s.node
+            self._fresh, self._checked = fresh, time.time()
+            return status
+
+    def _insert_meta(self, execute, summary, fingerprint, n_rows, built):
+        execute(f'INSERT INTO {self.meta_table} VALUES ({_quote(summary.name)}, '
+                f'{_quote(summary.digest)}, {_quote(fingerprint)}, {int(n_rows)}, '
+                f'{time.time()}, {int(built)})')
+
+    def _drop(self, execute, summary):
+        execute(f'DROP TABLE IF EXISTS {summary.table}')
+        execute(f'DELETE FROM {self.meta_table} WHERE name = {_quote(summary.name)}')
+
+    def drop_all(self, execute):
+        """ Drop the summary tables of the store """
+        with self._lock:
+            self._fresh = dict()
+            self._create_meta(execute)
+            for s in self.summaries.values():
+                self._drop(execute, s)
@@ -0,0 +1,388 @@
+import datetime
+import io
+import operator
+import re
+import textwrap
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from .dbtree import CTENode, LookupNode
+from .query import StmtGeneric, build_statement
+
+# Two-phase aggregation of a query over shards: several schemas of the same layout
+# (e.g. one per site, see `sharded_query`), or time slices of the rows of one schema
+# (see `sliced_query`). Each shard computes partial aggregates of its own rows:
+# counts, sums, minima and maxima, and the sum and count for an average. The
+# partials are then merged by a final aggregation, either in SQL (one statement, the
+# UNION ALL of the shards' partial queries) or locally (the partial queries run on
+# each shard in parallel, see `ShardedQuery.run`). Only the outer aggregation is
+# split: the rows of a CTE (e.g. per person) are assumed to be within a single schema,
+# and CTEs are computed in full by each time slice.
+#
+# A distinct count cannot be summed over shards unless the values counted are
+# disjoint between shards (e.g. site-local person IDs): with distinct='disjoint' it
+# is. Otherwise (distinct='exact') each shard sends the distinct values themselves,
+# grouping its partials by them, which the final step counts.
+
+AGGREGATIONS = ('rows', 'count', 'sum', 'min', 'max', 'avg')    # (decomposable)
+_IDENTIFIER = re.compile(r'[A-Za-z_]\w*')
+
+
+class ShardedQuery:
+    """
+    ShardedQuery: a query over several shards (schemas, or time slices: see
+    `sharded_query`, `sliced_query`), as the SQL of the partial aggregation on each
+    shard (`partials`: {shard: SQL}) and the SQL of the whole query (`sql`: the
+    final aggregation of the UNION ALL of the partials). The partial rows (in the
+    order of `partial_columns`) may instead be merged locally (`merge`, `run`) into
+    rows in the order of `columns`.
+    """
+    def __init__(self, shards, partials, sql, columns, partial_columns, plan, has_agg):
+        self.shards = list(shards)
+        self.partials = partials
+        self.sql = sql
+        self.columns = columns
+        self.partial_columns = partial_columns
+        self.plan = plan        # (merge, partial column indices, coalesce) per column
+        self.has_agg = has_agg
+
+    def run(self, execute, max_workers=None):
+        """
+        Run the partial queries on all shards in parallel, and merge the results.
+        `execute(shard, sql)` runs the SQL on a shard and returns its rows, e.g. a
+        ConnectionPool. Returns the rows of the query.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers or len(self.shards)) as pool:
+            results = list(pool.map(lambda s: execute(s, self.partials[s]), self.shards))
+        return self.merge(results)
+
+    def merge(self, results):
+        """
+        Merge the partial rows of each shard (a list of row lists). The rows are
+        grouped, and each column of a group is reduced at once (by `sum`, `min`, ...).
+        """
+        if not self.has_agg:
+            return [tuple(row) for rows in results for row in rows]
+        key_ix = [ix[0] for merge, ix, _ in self.plan if merge == 'group']
+        key = operator.itemgetter(*key_ix) if len(key_ix) > 0 else lambda row: ()
+        groups = OrderedDict()
+        for rows in results:
+            for row in rows:
+                groups.setdefault(key(row), []).append(row)
+        out = []
+        for rows in groups.values():
+            cols = list(zip(*rows))
+            out.append(tuple(_reduce(merge, [cols[j] for j in ix], coalesce)
+                             for merge, ix, coalesce in self.plan))
+        return out
+
+    def combine(self, results):
+        """
+        Combine the partial rows of each shard (a list of row lists) into partial
+        rows, as if of a single shard: e.g. to add the partials of new rows to
+        stored partials. (Distinct values remain group keys.)
+        """
+        if not self.has_agg:
+            return [tuple(row) for rows in results for row in rows]
+        folds = [None] * len(self.partial_columns)
+        for merge, ix, _ in self.plan:
+            for j in ix:
+                folds[j] = None if merge in ('group', 'distinct') else \
+                    merge if merge in ('min', 'max') else 'sum'
+        key_ix = [j for j, fold in enumerate(folds) if fold is None]
+        key = operator.itemgetter(*key_ix) if len(key_ix) > 0 else lambda row: ()
+        groups = OrderedDict()
+        for rows in results:
+            for row in rows:
+                groups.setdefault(key(row), []).append(row)
+        out = []
+        for rows in groups.values():
+            cols = list(zip(*rows))
+            out.append(tuple(col[0] if fold is None else _fold(fold, col)
+                             for fold, col in zip(folds, cols)))
+        return out
+
+
+def _fold(fold, values):
+    """ sum, min or max of the non-NULL `values` (NULL if there are none) """
+    values = [v for v in values if v is not None]
+    if len(values) == 0:
+        return None
+    return sum(values) if fold == 'sum' else min(values) if fold == 'min' else max(values)
+
+
+def _reduce(merge, cols, coalesce):
+    """ The final aggregate of the partial columns `cols` of a group """
+    if merge == 'group':
+        return cols[0][0]
+    if merge == 'distinct':
+        return len(set(cols[0]).difference((None,)))
+    if merge == 'avg':
+        n = sum(cols[1])
+        value = _fold('sum', cols[0]) / n if n > 0 else None
+    else:
+        value = _fold(merge, cols[0])
+    return coalesce if value is None and coalesce is not None else value
+
+
+class ConnectionPool:
+    """
+    ConnectionPool: an `execute(shard, sql)` function for `ShardedQuery.run`, which
+    reuses idle DB-API connections, opening another with `connect()` (or with
+    `connect(shard)`, if `per_shard`) when none is idle. Connections may be used by
+    different threads (e.g. sqlite3.connect(..., check_same_thread=False)). Close
+    the pool (or use it as a context manager) to close the connections.
+    """
+    def __init__(self, connect, per_shard=False):
+        self.connect = connect
+        self.per_shard = per_shard
+        self._idle = defaultdict(list)      # shard (or None) -> connections
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def __call__(self, shard, sql):
+        key = shard if self.per_shard else None
+        with self._lock:
+            connection = self._idle[key].pop() if len(self._idle[key]) > 0 else None
+        if connection is None:
+            connection = self.connect(shard) if self.per_shard else self.connect()
+            with self._lock:
+                self._connections.append(connection)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        finally:
+            with self._lock:
+                self._idle[key].append(connection)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections, self._idle = [], defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def partial_statement(*args, dialect='MSSS', allow_coalesce=True, distinct='exact'):
+    """
+    The Statement of the partial aggregation of the query `args` on one shard, and
+    the plan to merge its columns: a list of (name, merge, partial column indices,
+    coalesce) per column of the query, where `merge` is one of 'group', 'sum',
+    'min', 'max', 'avg' or 'distinct'. Raises ValueError if an aggregation is not
+    decomposable.
+    """
+    assert distinct in ('exact', 'disjoint'), "distinct must be 'exact' or 'disjoint'"
+    # (no shared lookup CTEs, so that the CTEs can be inlined into the UNION ALL)
+    stmt = build_statement(*args, dialect=dialect, allow_coalesce=allow_coalesce,
+                           shared_lookups=False)
+    select, columns, plan = [], [], []
+    for i, (o, alias, item, name) in enumerate(zip(stmt.fields, stmt.table_aliases,
+                                                   stmt.select, stmt.columns)):
+        coalesce = o.coalesce if allow_coalesce else None
+        # (the partial columns need distinct names, unlike the columns of a query)
+        unique = name if _IDENTIFIER.fullmatch(name) and name not in columns else f'col{i}'
+        if not o.has_aggregation:
+            expr = item[:-len(f' AS {name}')] if item.endswith(f' AS {name}') else item
+            parts, merge, coalesce = [(expr, unique)], 'group', None
+        else:
+            a = o.selected_aggregation.lower().strip()
+            if a not in AGGREGATIONS:
+                raise ValueError(f'Aggregation {a} cannot be computed in parts.')
+            agg = o.derive(coalesce=None).sql_expression(alias=alias, dialect=dialect,
+                                                         lkp_where=False)[0]
+            expr = o.derive(aggregation=None, coalesce=None).sql_expression(
+                alias=alias, dialect=dialect, lkp_where=False)[0]
+            if a == 'avg':
+                parts, merge = [(f'SUM({expr})', unique + '_sum'),
+                                (f'COUNT({expr})', unique + '_n')], 'avg'
+            elif a == 'count' and distinct == 'exact':
+                parts, merge = [(expr, unique + '_value')], 'distinct'
+                if expr not in stmt.groupby:
+                    stmt.groupby.append(expr)
+            else:
+                parts, merge = [(agg, unique)], 'sum' if a in ('rows', 'count') else a
+        parts = [(f'{p} AS {n}', n) for p, n in parts]
+        ix = tuple(range(len(columns), len(columns) + len(parts)))
+        plan.append((name if _IDENTIFIER.fullmatch(name) else unique, merge, ix, coalesce))
+        select.extend(p for p, _ in parts)
+        columns.extend(n for _, n in parts)
+    stmt.select[:] = select
+    stmt.columns[:] = columns
+    return stmt, plan
+
+
+def _final_statement(partial_columns, plan):
+    select, groupby = StmtGeneric('SELECT', None), StmtGeneric('GROUP BY', None)
+    for name, merge, ix, coalesce in plan:
+        cols = [partial_columns[j] for j in ix]
+        if merge == 'group':
+            expr = cols[0]
+            groupby.append(expr)
+        elif merge == 'avg':
+            expr = f'CAST(SUM({cols[0]}) AS FLOAT) / NULLIF(SUM({cols[1]}), 0)'
+        elif merge == 'distinct':
+            expr = f'COUNT(DISTINCT {cols[0]})'
+        else:
+            expr = f'{merge.upper()}({cols[0]})'
+        if coalesce is not None:
+            coalesce = f"'{coalesce}'" if isinstance(coalesce, str) else str(coalesce)
+            expr = f'COALESCE({expr}, {coalesce})'
+        select.append(expr if expr == name else f'{expr} AS {name}')
+    return select, groupby
+
+
+def _retarget(context, tables):
+    """
+    A function substituting another schema for the context's schema in the table
+    references (of `tables`) of SQL.
+    """
+    assert context.schema != '', "Sharded queries require the tables to be in a schema."
+    names = [n.name for n in context.nodes if n.schema is None and n.name in tables]
+    if len(names) == 0:
+        return lambda sql, schema: sql
+    pattern = re.compile(rf'(?<![\w.]){re.escape(context.schema)}\.'
+                         rf'({"|".join(map(re.escape, names))})\b')
+    return lambda sql, schema: pattern.sub(lambda m: f'{schema}.{m.group(1)}', sql)
+
+
+def _sharded(stmt, plan, shards, partials, inline, pretty):
+    """ The ShardedQuery of the partial queries (and their inlined forms) of `shards` """
+    has_agg = any(o.has_aggregation for o in stmt.fields)
+    if pretty:
+        union = '\n\nUNION ALL\n\n'.join(inline)
+    else:
+        union = ' UNION ALL '.join(inline)
+    if has_agg:
+        select, groupby = _final_statement(stmt.columns, plan)
+        if pretty:
+            sql = select.generate_statement() + 'FROM (\n' + \
+                textwrap.indent(union, ' ' * 4) + '\n) partials\n\n' + \
+                groupby.generate_statement()
+        else:
+            buf = io.StringIO()
+            select.write_compact(buf)
+            buf.write(f' FROM ({union}) partials')
+            groupby.write_compact(buf)
+            sql = buf.getvalue()
+    else:
+        sql = union + ('\n' if pretty else '')
+    return ShardedQuery(shards, OrderedDict(zip(shards, partials)), sql,
+                        [name for name, _, _, _ in plan], stmt.columns,
+                        [p[1:] for p in plan], has_agg)
+
+
+def sharded_query(*args, schemas, dialect='MSSS', allow_coalesce=True, pretty=True,
+                  distinct='exact'):
+    """
+    Plan the query `args` (as `construct_query`) over the list of `schemas`, which
+    replace the context's schema: see ShardedQuery. `distinct` is 'exact' or
+    'disjoint' (the values of distinct counts are never in two shards).
+    """
+    assert len(schemas) > 0, "Expecting at least one schema."
+    stmt, plan = partial_statement(*args, dialect=dialect, allow_coalesce=allow_coalesce,
+                                   distinct=distinct)
+    retarget = _retarget(stmt.context, stmt.tables())
+    partial = stmt.generate_statement(dialect=dialect, pretty=pretty)
+    inline = stmt.generate_statement(dialect=dialect, pretty=pretty, inline_ctes=True)
+    return _sharded(stmt, plan, schemas, [retarget(partial, s) for s in schemas],
+                    [retarget(inline, s).strip() for s in schemas], pretty)
+
+
+# ------------------------------- TIME SLICES ----------------------------------------
+def _date_literal(x, dialect='MSSS'):
+    if isinstance(x, datetime.datetime):
+        # (in full: a mark truncated to the second would miss the rows at the mark)
+        literal = f"'{x.isoformat(sep=' ')}'"
+        if dialect == 'MSSS' and x.microsecond:     # (DATETIME parses milliseconds)
+            return f'CAST({literal} AS DATETIME2)'
+        return literal
+    if isinstance(x, datetime.date):
+        return f"'{x:%Y-%m-%d}'"
+    return "'" + str(x).replace("'", "''") + "'"
+
+
+def even_cuts(start, end, n_slices):
+    """ The `n_slices` - 1 datetimes dividing [start, end] into equal time slices """
+    step = (end - start) / n_slices
+    return [start + i * step for i in range(1, n_slices)]
+
+
+def slice_table(stmt):
+    """
+    The table of the Statement `stmt` on whose `primary_date_field` its rows are
+    sliced: the root table, or failing that the first table joined which has one.
+    None if there is no such table (CTEs are not sliced).
+    """
+    return next((node for node in stmt._from if not node.is_cte and
+                 node.primary_date_field is not None), None)
+
+
+def date_range_query(*args, dialect='MSSS'):
+    """ SQL for the range (MIN, MAX) of the date field on which `args` is sliced """
+    stmt = build_statement(*args, dialect=dialect, shared_lookups=False)
+    node = slice_table(stmt)
+    if node is None:
+        raise ValueError('No table of the query has a primary date field.')
+    schema = stmt.context.schema if node.schema is None else node.schema
+    prefix = '' if schema == '' else schema + '.'
+    field = node.primary_date_field
+    return f'SELECT MIN({field}), MAX({field}) FROM {prefix}{node.name}'
+
+
+def aggregate_ctes(stmt):
+    """ The CTEs of aggregations of the Statement `stmt` (not those of lookups) """
+    return [node for node in stmt.ctes
+            if isinstance(node, CTENode) and not isinstance(node, LookupNode)]
+
+
+def sliced_query(*args, cuts, dialect='MSSS', allow_coalesce=True, pretty=True,
+                 distinct='exact', slice_ctes=False):
+    """
+    Plan the query `args` (as `construct_query`) as partial queries of time slices
+    (to run in parallel, see ShardedQuery): the rows are split on the primary date
+    field of the root table (or of the first joined table which has one, see
+    `slice_table`) at the sorted `cuts` (dates, datetimes or ISO strings; see
+    `even_cuts`). The first slice also holds the rows whose date is NULL. Each row
+    of the query is then in exactly one slice. The shards of the ShardedQuery are
+    the (lower, upper) bounds of each slice. Raises ValueError if an aggregation is
+    not decomposable, or no table has a date field.
+
+    Only the rows of the outer query are sliced: each slice computes the CTEs of
+    aggregations (over their whole tables) again, so that N slices do the work of
+    the CTEs N times. Unless `slice_ctes`, a query with such CTEs is therefore
+    planned as a single slice, (None, None).
+    """
+    stmt, plan = partial_statement(*args, dialect=dialect, allow_coalesce=allow_coalesce,
+                                   distinct=distinct)
+    node = slice_table(stmt)
+    if node is None:
+        raise ValueError('No table of the query has a primary date field to slice on.')
+    alias = stmt.aliases[node]
+    field = (alias + '.' if alias else '') + node.primary_date_field
+    if not slice_ctes and len(aggregate_ctes(stmt)) > 0:
+        cuts = []       # (lookup CTEs, filtered dimension tables, are cheap to repeat)
+    bounds = list(zip([None, *cuts], [*cuts, None]))
+    partials, inline = [], []
+    stmt.where.append(None)
+    for lower, upper in bounds:
+        if lower is None:
+            where = f'{field} IS NULL' if upper is None else \
+                f'{field} < {_date_literal(upper, dialect)} OR {field} IS NULL'
+        elif upper is None:
+            where = f'{field} >= {_date_literal(lower, dialect)}'
+        else:
+            where = f'{field} >= {_date_literal(lower, dialect)} AND ' \
+                    f'{field} < {_date_literal(upper, dialect)}'
+        stmt.where[-1] = where if len(bounds) > 1 else None
+        partials.append(stmt.generate_statement(dialect=dialect, pretty=pretty))
+        inline.append(stmt.generate_statement(dialect=dialect, pretty=pretty,
+                                              inline_ctes=True).strip())
+    return _sharded(stmt, plan, bounds, partials, inline, pretty)
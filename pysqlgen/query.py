@@ -1,11 +1,12 @@
 from collections import UserList, OrderedDict, defaultdict
+from functools import lru_cache
 import copy
-import re
+import io
 import textwrap
-from .dbtree import CTENode, minimum_subtree, topological_sort_hierarchical
-from .fields import UserOption, construct_simple_field
-from .utils import rm_alias_placeholder, make_unique_name, flatten, ilen, \
-    replace_in_ordered_dict
+from .dbtree import CTENode, LookupNode, minimum_subtree, topological_sort_hierarchical
+from .fields import UserOption, FieldSpec, construct_simple_field
+from .utils import make_unique_name, flatten, ilen, replace_in_ordered_dict, \
+    squash_whitespace, str_to_fieldname
 from . import graph
 
 
@@ -28,11 +29,33 @@ class Statement:
         self.where = StmtGeneric('WHERE', parent=self, conj=' AND', wrappers=('(', ')'))
         self.groupby = StmtGeneric('GROUP BY', parent=self)
         self.ctes = StmtCTE(parent=self)
-
-    def generate_statement(self, dialect='MSSS'):
-        out1 = self.ctes.generate_statement(dialect=dialect)
+        self.columns = []       # the name (alias) of each column in the SELECT clause
+        self.fields = []        # the FieldSpec of each column in the SELECT clause
+        self.table_aliases = []     # ... and the alias of the table it is selected from
+
+    def generate_statement(self, dialect='MSSS', pretty=True, with_ctes=True,
+                           inline_ctes=False):
+        """
+        The SQL of the statement. If not `pretty`, the SQL is compact: the same
+        tokens, but on a single line with single spaces, written to one buffer.
+        The WITH clause is omitted if not `with_ctes` (for the body of a CTE). If
+        `inline_ctes`, the CTEs are instead written as derived tables in the FROM
+        clauses (see `can_inline`).
+        """
+        if not pretty:
+            buf = io.StringIO()
+            self.write_compact(buf, dialect=dialect, with_ctes=with_ctes,
+                               inline_ctes=inline_ctes)
+            return buf.getvalue()
+        if inline_ctes:
+            assert self.can_inline(dialect), "The CTEs of this statement cannot be inlined."
+            inline = lambda node: _cte_sql(node, dialect, pretty=True, inline=True)
+            out1 = ''
+        else:
+            inline = None
+            out1 = self.ctes.generate_statement(dialect=dialect) if with_ctes else ''
         out2 = self.select.generate_statement()
-        out3 = self._from.generate_statement()
+        out3 = self._from.generate_statement(inline=inline)
         out4 = self.where.generate_statement()
         out5 = self.groupby.generate_statement()
         return out1 + out2 + out3 + out4 + out5
@@ -42,6 +65,47 @@ class Statement:
         #        self.where.generate_statement() + \
         #        self.groupby.generate_statement()
 
+    def write_compact(self, buf, dialect='MSSS', with_ctes=True, inline_ctes=False):
+        if inline_ctes:
+            assert self.can_inline(dialect), "The CTEs of this statement cannot be inlined."
+            inline = lambda node: _cte_sql(node, dialect, pretty=False, inline=True)
+        else:
+            inline = None
+            if with_ctes:
+                self.ctes.write_compact(buf, dialect=dialect)
+        self.select.write_compact(buf)
+        self._from.write_compact(buf, inline=inline)
+        self.where.write_compact(buf)
+        self.groupby.write_compact(buf)
+
+    def can_inline(self, dialect='MSSS'):
+        """
+        Can the CTEs be written as derived tables? Not if a lookup CTE is restricted
+        to the IDs of another CTE, which it refers to by name.
+        """
+        return not any(isinstance(node, LookupNode) and len(node.restrict) > 0
+                       for node in self.ctes.nodes(dialect))
+
+    def cte_names(self):
+        """
+        The names of all CTEs in the query (including any nested within CTEs), in
+        the order in which they are defined.
+        """
+        return [node.name for node in self.ctes.nodes()]
+
+    def tables(self):
+        """
+        The names of all (schema) tables touched by the query, including dimension
+        tables used for lookups and the tables within CTEs.
+        """
+        out = dict()
+        for node in self.ctes.nodes():
+            out.update(dict.fromkeys(self.ctes.inner(node).tables()))
+        out.update(dict.fromkeys(node.name for node in self._from if not node.is_cte))
+        out.update(dict.fromkeys(join[1][0].name for join in self.lkp_aliases
+                                 if not join[1][0].is_cte))
+        return list(out)
+
 
 class StmtGeneric(UserList):
     """
@@ -73,6 +137,21 @@ class StmtGeneric(UserList):
         return f'{self.statement} ' + \
                (self.conj + '\n' + ' ' * ws).join(lines) + '\n\n'
 
+    def write_compact(self, buf):
+        lines = list(filter(lambda x: x is not None and len(x) > 0, self))
+        if len(lines) == 0:
+            return
+        if buf.tell() > 0:
+            buf.write(' ')
+        buf.write(self.statement)
+        for i, line in enumerate(lines):
+            buf.write(' ' if i == 0 else self.conj + ' ')
+            if self.wrappers:
+                buf.write(self.wrappers[0])
+            buf.write(squash_whitespace(line))
+            if self.wrappers:
+                buf.write(self.wrappers[1])
+
 
 class StmtCTE(StmtGeneric):
 
@@ -80,17 +159,35 @@ class StmtCTE(StmtGeneric):
         statement_type, wrappers, ws = 'WITH', None, 4
         super().__init__(statement_type, parent, conj, wrappers, ws)
 
+    def nodes(self, dialect='MSSS'):
+        """
+        The CTEs of the statement, each preceded by any CTEs that its inner query
+        uses. (These are hoisted into the one WITH clause, since a CTE may not itself
+        contain a WITH clause in SQL Server.)
+        """
+        out = []
+        for node in filter(lambda x: isinstance(x, CTENode), self):
+            out.extend(x for x in self.inner(node, dialect).ctes.nodes(dialect)
+                       if x not in out)
+            if node not in out:
+                out.append(node)
+        return out
+
+    def inner(self, node, dialect='MSSS'):
+        """ The Statement of the inner query of CTE `node` """
+        return _cte_statement(node, dialect)
+
     def generate_statement(self, dialect='MSSS'):
-        tables = list(filter(lambda x: isinstance(x, CTENode), self))
+        tables = self.nodes(dialect)
         if len(tables) == 0:
             return ''
         out = []
         for i, node in enumerate(tables):
             # construct inner CTE query (and add margin)
-            q = construct_query(*node.fields, dialect=dialect).strip()
+            q = _cte_sql(node, dialect, pretty=True)
             q = "\n".join([" "*self.whitespace + line for line in q.split("\n")])
-            # construct outer part of CTE query.
-            fields = [x.field_alias for x in node.fields]
+            # construct outer part of CTE query: columns in the order of its SELECT.
+            fields = self.inner(node, dialect).columns
             # wrap header of CTE query if required, and indent subsequent lines
             indent_str = ' ' * (len(node.name) + 3 + 4*(i == 0))
             wrap = textwrap.TextWrapper(width=100, subsequent_indent=indent_str)
@@ -101,6 +198,85 @@ class StmtCTE(StmtGeneric):
             out.append(cte)
         return f'{self.statement} ' + ("\n\n" + self.conj).join(out) + '\n\n'
 
+    def write_compact(self, buf, dialect='MSSS'):
+        tables = self.nodes(dialect)
+        if len(tables) == 0:
+            return
+        if buf.tell() > 0:
+            buf.write(' ')
+        buf.write(self.statement)
+        for i, node in enumerate(tables):
+            buf.write(' ' if i == 0 else self.conj + ' ')
+            buf.write(f'{node.name} ({", ".join(self.inner(node, dialect).columns)}) AS (')
+            buf.write(_cte_sql(node, dialect, pretty=False))
+            buf.write(')')
+
+
+# CTEs are hash-consed: equal CTEs (the same parent, keys and field specs) are the
+# same CTENode, within and across statements, so that the inner query of each is
+# planned and rendered once.
+@lru_cache(maxsize=1024)
+def _cte_node(parents, pk, fields, name=None):
+    return CTENode(list(parents), list(pk), list(fields), name=name)
+
+
+@lru_cache(maxsize=1024)
+def _lookup_node(table, columns, where, restrict, context):
+    return LookupNode(table, columns, where, restrict, context)
+
+
+@lru_cache(maxsize=1024)
+def _cte_statement(node, dialect):
+    if isinstance(node, LookupNode):
+        return _lookup_statement(node)
+    return build_statement(*node.fields, dialect=dialect)
+
+
+def _lookup_statement(node):
+    """ The Statement of the inner query of a LookupNode """
+    stmt = Statement(node.context)
+    stmt._from[node.table] = ()
+    stmt._from.generate_basic_statement()
+    stmt.select.extend(node.columns)
+    stmt.columns.extend(node.columns)
+    if node.where is not None:
+        stmt.where.append(node.where.render(''))
+    if len(node.restrict) > 0:
+        ids = '\nUNION '.join(f'SELECT {f} FROM {tbl.name}' for tbl, f in node.restrict)
+        stmt.where.append(f'{node.pk[0]} IN ({ids})')
+    return stmt
+
+
+def _shared_lookups(args):
+    """
+    Lookups of two or more fields into the same dimension table (with the same
+    WHERE clause) are made from a single LookupNode: only the columns needed, and
+    only the rows satisfying the WHERE clause. If the fields are all in CTEs, it is
+    also restricted to the IDs which they reference. Returns a dict mapping the
+    lookup joins to their joins onto the LookupNodes.
+    """
+    groups = defaultdict(list)
+    for o in args:
+        if o.perform_lkp:
+            groups[(o.dimension_table, o.option.dim_where_template)].append(o)
+    out = dict()
+    for (dtbl, where), fields in groups.items():
+        joins = list(dict.fromkeys(((o.table, o.sql_fieldname), (dtbl, dtbl.pk[0]))
+                                   for o in fields))
+        if len(joins) < 2:
+            continue
+        columns = dict.fromkeys([dtbl.pk[0]] + [o.option.lkp_field for o in fields])
+        restrict = [j[0] for j in joins] if all(j[0][0].is_cte for j in joins) else []
+        node = _lookup_node(dtbl, tuple(columns), where, tuple(restrict), fields[0].context)
+        out.update({j: (j[0], (node, dtbl.pk[0])) for j in joins})
+    return out
+
+
+@lru_cache(maxsize=1024)
+def _cte_sql(node, dialect, pretty, inline=False):
+    return _cte_statement(node, dialect).generate_statement(
+        dialect=dialect, pretty=pretty, with_ctes=False, inline_ctes=inline).strip()
+
 
 class StmtFrom(OrderedDict):
     """
@@ -113,6 +289,7 @@ class StmtFrom(OrderedDict):
         self.parent = parent
         self.generated = None
         self.additional_lkps = None
+        self.joins = []         # (node, table, alias, join conditions): for re-rendering
 
     def __setitem__(self, key, value):
         if key in self.keys():
@@ -141,6 +318,7 @@ class StmtFrom(OrderedDict):
                     alias = '' if (n == 1 and not force_alias) else node.name[0].lower()
                     aliases[node] = alias
                     join_list.append(f'     {schema}{node.name} {alias}')
+                    self.joins.append((node, f'{schema}{node.name}', alias, []))
                 else:
                     # make human readable alias (using table prefix, not simply a,b,c,...)
                     alias = make_unique_name(node.name, aliases)
@@ -151,6 +329,7 @@ class StmtFrom(OrderedDict):
                     on_stmt = [f'{a[0]}.{c[0][i]} = {a[1]}.{c[1][i]}' for i in range(s)]
                     join_list.append(f'LEFT JOIN {schema}{node.name} {alias}\nON        '
                                      + '\nAND       '.join(on_stmt))
+                    self.joins.append((node, f'{schema}{node.name}', alias, on_stmt))
             self.generated = 'FROM ' + '\n'.join(join_list)
         return self.generated + '\n'
 
@@ -166,43 +345,131 @@ class StmtFrom(OrderedDict):
             schema = global_schema if tbl_dim.schema is None else tbl_dim.schema
             alias = make_unique_name(tbl_dim.name, aliases, lkp_aliases)
             lkp_aliases[join] = alias
+            on_stmt = f'{aliases[tbl_existing]}.{f_existing} = {alias}.{f_dim}'
             join_list.append(f'LEFT JOIN {schema}{tbl_dim.name} {alias}\nON        '
-                             + f'{aliases[tbl_existing]}.{f_existing} = {alias}.{f_dim}')
+                             + on_stmt)
+            self.joins.append((tbl_dim, f'{schema}{tbl_dim.name}', alias, [on_stmt]))
         self.additional_lkps = '\n'.join(join_list)
 
-    def generate_statement(self):
+    def generate_statement(self, inline=None):
+        """
+        The FROM clause. `inline` is an optional function returning the SQL of a CTE
+        node, which is then written as a derived table.
+        """
         assert self.generated is not None, "Please run 'generate_basic_statement' first."
+        if inline is not None:
+            join_list = []
+            for i, (node, table, alias, on_stmt) in enumerate(self.joins):
+                if node.is_cte:
+                    table = '(\n' + textwrap.indent(inline(node), ' ' * 4) + '\n)'
+                    alias = alias or node.name
+                if i == 0:
+                    join_list.append(f'     {table} {alias}')
+                else:
+                    join_list.append(f'LEFT JOIN {table} {alias}\nON        '
+                                     + '\nAND       '.join(on_stmt))
+            return 'FROM ' + '\n'.join(join_list) + '\n\n'
         generated = self.generated
         if self.additional_lkps is not None and len(self.additional_lkps) > 0:
             generated += '\n' + self.additional_lkps
         return generated + '\n\n'
 
-
-def construct_query(*args, dialect='MSSS', allow_coalesce=True):
+    def write_compact(self, buf, inline=None):
+        assert self.generated is not None, "Please run 'generate_basic_statement' first."
+        if buf.tell() > 0:
+            buf.write(' ')
+        buf.write('FROM ')
+        for i, (node, table, alias, on_stmt) in enumerate(self.joins):
+            if i > 0:
+                buf.write(' LEFT JOIN ')
+            if inline is not None and node.is_cte:
+                table = '(' + inline(node) + ')'
+                alias = alias or node.name
+            buf.write(table)
+            if alias:
+                buf.write(' ' + alias)
+            if on_stmt:
+                buf.write(' ON ' + ' AND '.join(on_stmt))
+
+
+# The errors which the planner raises for a query it does not support (e.g. a field
+# whose table the join tree cannot reach, or a CTE which cannot be inlined). Any
+# other error is a bug, and is not to be caught as such.
+UNSUPPORTED_QUERY = (IndexError, ValueError)
+
+
+def construct_query(*args, dialect='MSSS', allow_coalesce=True, pretty=True,
+                    late_lookups=False, shared_lookups=False, schemas=None, summaries=None,
+                    cohort=None):
     """
     Construct a SQL query from a list of various UserOptions. Each option
     contains a field, a transformation/aggregation, and the table in which
     the field resides. This function handles constructing the query, which
     uses the graph implicit in the SchemaNodes residing in the UserOptions.
 
-    :param dialect - may be MS SQL Server ('MSSS') or 'Postgres'. Very limited
+    :param dialect - may be MS SQL Server ('MSSS'), 'Postgres' or 'SQLite'. Very limited
     customisation is currently available for these. The differences have been
     populated on a case-by-case basis rather than anything systematic.
+    :param pretty - if False, the SQL is compact (a single line): for machines.
+    :param late_lookups - if True, aggregate on the IDs of any looked-up fields in
+    a CTE, and join the dimension tables onto the (smaller) aggregated result. See
+    `late_lookup_statement`.
+    :param shared_lookups - if True, several lookups into the same dimension table
+    are joined onto one filtered CTE of the table, rather than each onto the table.
+    (Only with late lookups is the CTE restricted to the IDs referenced.)
+    :param schemas - a list of schemas with the same tables (e.g. one per site), in
+    place of the context's schema: the query is aggregated over all of them in two
+    phases, partial aggregates per schema and a final merge. See `partial.py`. (Not
+    with late or shared lookups, summaries or a cohort: raises ValueError.)
+    :param summaries - a SummaryStore (see `materialize.py`), or any object whose
+    `get(cte)` returns a SummaryNode or None: CTEs with a fresh summary table are
+    read from the table instead.
+    :param cohort - a CohortTable (see `cohort.py`): the query is restricted to the
+    cohort by a semi-join on its key. (Lookups are then not late.)
     :return: (string) SQL statement
     """
+    if schemas is not None:
+        # (the partial queries plan their own lookups; summary and cohort tables are
+        # in one database, not in each schema)
+        if late_lookups or shared_lookups or summaries is not None or cohort is not None:
+            raise ValueError('Late or shared lookups, summaries and cohorts cannot be '
+                             'combined with schemas.')
+        from .partial import sharded_query      # (which imports this module)
+        return sharded_query(*args, schemas=schemas, dialect=dialect,
+                             allow_coalesce=allow_coalesce, pretty=pretty).sql
+    stmt = build_statement(*args, dialect=dialect, allow_coalesce=allow_coalesce,
+                           late_lookups=late_lookups, shared_lookups=shared_lookups,
+                           summaries=summaries, cohort=cohort)
+    return stmt.generate_statement(dialect=dialect, pretty=pretty)
+
+
+def build_statement(*args, dialect='MSSS', allow_coalesce=True, late_lookups=False,
+                    shared_lookups=False, summaries=None, cohort=None):
+    """
+    As `construct_query`, but returns the Statement object, whose metadata
+    (`.columns`, `.tables()`, `.cte_names()`) is available as well as the SQL
+    (`.generate_statement(dialect)`).
+    """
     n = len(args)
-    assert all([isinstance(o, UserOption) for o in args]), "Not all args are UserOptions"
+    assert all([isinstance(o, (UserOption, FieldSpec)) for o in args]), \
+        "Not all args are UserOptions or FieldSpecs"
+    args = [o if isinstance(o, FieldSpec) else o.to_spec() for o in args]
     invalids = [not o.validate() for o in args]
     assert not any(invalids), "{:d}/{:d} options have not been validated".format(
         sum(invalids), n)
     assert all([args[0].context == args[i+1].context for i in range(n-1)]), "Different" +\
         "contexts associated with the User Opts. Ensure these are the same."
+    if late_lookups and cohort is None:
+        stmt = late_lookup_statement(*args, dialect=dialect, allow_coalesce=allow_coalesce,
+                                     shared_lookups=shared_lookups)
+        if stmt is not None:
+            return stmt
     stmt = Statement(args[0].context)
 
     # ==== GET ALL TABLES AND FORM BASIC JOIN SUBTREE ============
     context = args[0].context
     nodes = [o.get_table() for o in args]
-    unique_nodes = list(set(nodes))
+    unique_nodes = list(dict.fromkeys(nodes))
     join_tree = minimum_subtree(unique_nodes)
 
     # The primary table is considered the "root node" of the tree -- edges are undirected.
@@ -215,8 +482,6 @@ def construct_query(*args, dialect='MSSS', allow_coalesce=True):
     edges = [(k, v[0][0]) for (i,(k,v)) in enumerate(join_tree.items()) if i > 0]
     G = graph.Graph(edges, directed=False)
     sorted_nodes = G.topological_sort(leave_until_last=primary_tbl)
-    # (Recreate G since the topological_sort mutates G (ikr - should fix this!))
-    G = graph.Graph(edges, directed=False)
 
     # ======= CREATE CTEs WHENEVER WE FIND A NESTED AGGREGATION ============
     field_tbl_lkp = defaultdict(list)
@@ -231,7 +496,8 @@ def construct_query(*args, dialect='MSSS', allow_coalesce=True):
         any_v_has_agg = any([arg.has_aggregation for arg in v_fields])
 
         # Get 'child tables' and 'parent tables' (wrt topological sort)
-        child_tbls = G._graph[v] - set(sorted_nodes[i:])
+        remaining = set(sorted_nodes[i:])
+        child_tbls = [w for w in G.neighbours(v) if w not in remaining]
         parent_tbl = join_tree[v][0][0]
         parent_fks, v_pks = join_tree[v][0][1], join_tree[v][1][1]
 
@@ -244,43 +510,39 @@ def construct_query(*args, dialect='MSSS', allow_coalesce=True):
             # Add in table PKs if not already included in `f_non_agg`.
             f_non_agg_names = [f.sql_fieldname for f in f_non_agg]
             pk_names_to_add = [f for f in v_pks if f not in f_non_agg_names]
-            pks_to_add = [construct_simple_field(f, v, context) for f in pk_names_to_add]
+            pks_to_add = [construct_simple_field(f, v, context).to_spec()
+                          for f in pk_names_to_add]
 
-            # Make a copy of all non-aggregated AND aggregated fields.
-            f_non_agg_cte = [f.copy() for f in f_non_agg]
-            f_agg_cte = [arg for arg in v_fields if arg.has_aggregation]
-            f_agg = [f.copy() for f in f_agg_cte]
+            # Derive the CTE fields, deferring lookups until the final query
+            f_agg = [arg for arg in v_fields if arg.has_aggregation]
+            cte_fields = pks_to_add + [f.derive(perform_lkp=False) for f in f_non_agg] + \
+                [f.derive(perform_lkp=False) for f in f_agg]
+            cte_fields = list(dict.fromkeys(cte_fields))    # (compute duplicates once)
 
-            # consolidate CTE fields and add primary designator to (any) field in root
-            cte_fields = pks_to_add + f_non_agg_cte + f_agg_cte
-            for field in cte_fields:
+            # add primary designator to (any) field in root
+            for j, field in enumerate(cte_fields):
                 if field.sql_fieldname in v_pks:
-                    field.is_secondary = False
+                    cte_fields[j] = field.derive(is_secondary=False)
                     break
 
-            # Defer lookups until the final query
-            for field in cte_fields:
-                field.perform_lkp = False
-
-            # Construct CTE
-            cte = CTENode([parent_tbl],    # parent
-                          v_pks,           # pk
-                          cte_fields)      # cte_fields
-            stmt.ctes.append(cte)
+            # Construct CTE (or reuse an equal one)
+            cte = _cte_node((parent_tbl,),        # parent
+                            tuple(v_pks),         # pk
+                            tuple(cte_fields))    # cte_fields
+            summary = None if summaries is None else summaries.get(cte)
+            if summary is not None:
+                cte = summary       # (read the CTE's rows from its summary table)
+            elif cte not in stmt.ctes:
+                stmt.ctes.append(cte)
 
             # Point the [references to the aggregations] outside the CTE to the CTE field
-            for f in f_agg:
-                f.field_alias = f.field_alias  # this is *not* a noop! (@property...)
-                f.sql_item = '{alias}' + f.field_alias
-                f.table = cte
-                f.set_aggregation(None, force=True)
-                f.set_transform(None, force=True)
-                if allow_coalesce:
-                    f.coalesce = 0                  # assumes that aggregation is numeric
-
-            for f in f_non_agg:
-                f.table = cte
-                f.sql_item = '{alias}'+f._field_alias_logic(will_perform_lkp=False)
+            f_agg = [f.derive(field_alias=f.field_alias, sql_item='{alias}' + f.field_alias,
+                              table=cte, aggregation=None, transform=None,
+                              coalesce=0 if allow_coalesce else None)  # assumes numeric
+                     for f in f_agg]
+            f_non_agg = [f.derive(table=cte, sql_item='{alias}' +
+                                  f._field_alias_logic(will_perform_lkp=False))
+                         for f in f_non_agg]
 
             # Push these pointers to within the CTE up to the parent (although not PKs)
             all_fields[v] = f_non_agg + f_agg
@@ -293,12 +555,12 @@ def construct_query(*args, dialect='MSSS', allow_coalesce=True):
             all_fields[v] = v_fields + flatten([all_fields[w] for w in child_tbls])
 
     # Set args to the args propagated up to the root node
-    primary_children = G._graph[primary_tbl]
+    primary_children = G.neighbours(primary_tbl)
     args = field_tbl_lkp[primary_tbl] + flatten([all_fields[c] for c in primary_children])
     # Place the resulting tree into the FROM clause of the Statement object.
 
     nodes = [o.get_table() for o in args]
-    unique_nodes = list(set(nodes))
+    unique_nodes = list(dict.fromkeys(nodes))
     tree_final = minimum_subtree(unique_nodes)
 
     stmt._from.update(tree_final)
@@ -313,10 +575,16 @@ def construct_query(*args, dialect='MSSS', allow_coalesce=True):
                                     "to avoid multiple copies.)"
             fk = o.sql_fieldname
             lkp_joins.append(((o.table, fk), (dtbl, dtbl.pk[0])))
+    shared = _shared_lookups(args) if shared_lookups else dict()
+    for node in dict.fromkeys(join[1][0] for join in shared.values()):
+        stmt.ctes.append(node)
+    lkp_joins = [shared.get(join, join) for join in lkp_joins]
 
     # Generate statement in order to populate aliases dict
     stmt._from.generate_basic_statement(force_alias=(len(lkp_joins) > 0))
     stmt._from.add_lookups_to_statement(lkp_joins)
+    if cohort is not None:
+        stmt.where.append(cohort.restriction(stmt))
 
     # === CONSTRUCT SELECT / WHERE ===========
     has_agg = any([arg.has_aggregation for arg in args])
@@ -329,19 +597,66 @@ def construct_query(*args, dialect='MSSS', allow_coalesce=True):
             coalesce = o.coalesce if allow_coalesce else None
         else:
             dtbl = o.dimension_table
-            fk = rm_alias_placeholder(o.sql_item)
-            alias = stmt.lkp_aliases[((o.table, fk), (dtbl, dtbl.pk[0]))]
+            fk = o.sql_fieldname
+            join = ((o.table, fk), (dtbl, dtbl.pk[0]))
+            alias = stmt.lkp_aliases[shared.get(join, join)]
             coalesce = context.coalesce_default if allow_coalesce else None
 
-        sel, where = o.sql_transform(alias=alias, dialect=dialect, coalesce=coalesce)
+        is_shared = o.perform_lkp and join in shared
+        expr, field_alias, where = o.sql_expression(alias=alias, dialect=dialect,
+                                                    coalesce=coalesce,
+                                                    lkp_where=not is_shared)
+        if is_shared and o.option.dim_where_template is not None:
+            # the LookupNode is filtered: keep only rows where the lookup succeeds.
+            where = [f'{alias}.{dtbl.pk[0]} IS NOT NULL']
         # SELECT
-        stmt.select.append(sel)
+        stmt.select.append(expr if field_alias is None else f'{expr} AS {field_alias}')
+        stmt.columns.append(expr.strip() if field_alias is None else field_alias)
+        stmt.fields.append(o)
+        stmt.table_aliases.append(alias)
         # WHERE
         if len(where) > 0:
             stmt.where.extend(where)
         # GROUP BY
-        if has_agg and not o.has_aggregation:
-            gby = re.sub('AS [a-zA-Z0-9_]+$', '', sel).strip()
-            stmt.groupby.append(gby)
+        if has_agg and not o.has_aggregation and expr.strip() not in stmt.groupby:
+            stmt.groupby.append(expr.strip())
+
+    return stmt
+
 
-    return stmt.generate_statement(dialect=dialect)
+def late_lookup_statement(*args, dialect='MSSS', allow_coalesce=True,
+                          shared_lookups=False):
+    """
+    Plan the query with late materialization of the dimension lookups: the query
+    is aggregated in a CTE grouping on the raw IDs of the looked-up fields, and the
+    dimension tables are joined onto the CTE, i.e. once per group rather than once
+    per row of the fact tables. Note that distinct IDs sharing a name (e.g. a
+    concept_name) remain distinct rows.
+
+    Returns None if the query is not eligible: i.e. unless it has an aggregation,
+    and all looked-up fields are group keys (neither transformed nor aggregated).
+    """
+    args = [o if isinstance(o, FieldSpec) else o.to_spec() for o in args]
+    lkps = [o for o in args if o.perform_lkp]
+    if len(lkps) == 0 or not any(o.has_aggregation for o in args) or \
+            any(o.has_aggregation or o.selected_transform is not None for o in lkps):
+        return None
+
+    inner = [o.derive(perform_lkp=False) for o in args]
+    name = '_'.join(str_to_fieldname(o.item) for o in inner if o.has_aggregation) + \
+        '_by_id'    # (distinct from the names of any CTEs within it)
+    cte = _cte_node((), (), tuple(inner), name)
+
+    # Point the fields at the CTE: lookups are then performed on its ID columns.
+    # (Fields are in the order of the CTE's columns, as in the usual plan.)
+    columns = _cte_statement(cte, dialect).columns
+    pairs = sorted(zip(args, inner), key=lambda x: columns.index(x[1].field_alias))
+    outer = [o.derive(table=cte, sql_item='{alias}' + f.field_alias, field_alias=o.field_alias,
+                      aggregation=None, transform=None, coalesce=None)
+             if not o.perform_lkp else
+             o.derive(table=cte, sql_item='{alias}' + f.field_alias)
+             for o, f in pairs]
+    stmt = build_statement(*outer, dialect=dialect, allow_coalesce=allow_coalesce,
+                           shared_lookups=shared_lookups)
+    stmt.ctes.insert(0, cte)    # (before any LookupNodes restricted to its IDs)
+    return stmt
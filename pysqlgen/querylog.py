@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from warnings import warn
+from .compiled import canonical_order
+from .fields import FieldSpec
+from .query import UNSUPPORTED_QUERY, build_statement
+
+# A log of the queries generated (by the app, the API, ...), to learn which specs are
+# actually used and what they cost, and so to choose what to cache or materialize.
+# Each query is appended as a row of a local SQLite database:
+#
+#   ts | spec_hash | fields | dialect | allow_coalesce | source | gen_ms | exec_ms
+#      | n_rows | error
+#
+# `spec_hash` identifies the normalized query: the FieldSpec signatures, with the
+# secondary fields in canonical order, and the dialect and allow_coalesce. `source`
+# is where the SQL came from ('live', 'table' for the compiled SQL table, 'cache').
+# The execution time and row count are given by callers which run the SQL.
+#
+# Recording is off the request path: `record` only queues the row, and a background
+# thread writes the queue in batches (one transaction each). The shape of each
+# distinct spec -- the tables of its join tree and its number of CTEs, for the
+# reports by table -- is planned once, later: by the writer when the queue is empty,
+# or by a report, and kept in the table `shapes` (spec_hash | tables | n_ctes).
+# Reports first `flush` the queue. The database is in WAL mode, so several processes
+# may append to it, and each thread has its own connection.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    ts REAL NOT NULL,
+    spec_hash TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    dialect TEXT NOT NULL,
+    allow_coalesce INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    gen_ms REAL,
+    exec_ms REAL,
+    n_rows INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS shapes (
+    spec_hash TEXT PRIMARY KEY,
+    tables TEXT NOT NULL,
+    n_ctes INTEGER
+);
+"""
+
+_FLUSH = object()     # (a marker in the queue: write the batch now)
+
+
+def spec_hash(specs, dialect='MSSS', allow_coalesce=True):
+    """ Hash of the normalized query of `specs` (primary first) """
+    key = json.dumps([dialect, bool(allow_coalesce),
+                      [o.signature() for o in canonical_order(list(specs))]], default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _fields(specs):
+    return [[o.item, o.selected_transform, o.selected_aggregation,
+             *([bool(o.perform_lkp)] if o.is_secondary else [])] for o in specs]
+
+
+def _where(since):
+    return '' if since is None else f' WHERE ts >= {float(since)}'
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class QueryLog:
+    """
+    QueryLog: the append-only log of generated queries in the SQLite database
+    `filename` (created if missing): `record` a query, and report on the log with
+    `hottest_specs`, `slowest_tables` and `cache_potential`. Rows are written by a
+    background thread, in batches of the rows queued within `flush_interval`
+    seconds (at most `batch_size`).
+    """
+    def __init__(self, filename, max_shapes=4096, batch_size=256, flush_interval=1.0):
+        self.filename = filename
+        self.max_shapes = max_shapes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._known = OrderedDict()     # spec hashes seen (whose shape is planned)
+        self._pending = OrderedDict()   # spec hash -> (specs, dialect, allow_coalesce)
+        self._lock = threading.Lock()
+        self._queue, self._writer, self._pid = None, None, None
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def _start(self):
+        # (also in a forked process, which has no writer thread)
+        if self._pid == os.getpid():
+            return self._queue
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue, self._pid = queue.Queue(), os.getpid()
+                self._writer = threading.Thread(target=self._write, args=(self._queue,),
+                                                name='query-log-writer', daemon=True)
+                self._writer.start()
+        return self._queue
+
+    def _write(self, rows):
+        # Rows are collected for up to `flush_interval` seconds (or `batch_size` rows),
+        # or until a marker: _FLUSH (write now) or None (write and stop).
+        while True:
+            try:
+                batch = [rows.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._plan_idle()
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] not in (None, _FLUSH) and len(batch) < self.batch_size:
+                try:
+                    batch.append(rows.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            values = [row for row in batch if row is not None and row is not _FLUSH]
+            try:
+                if len(values) > 0:
+                    connection = self._connect()
+                    with connection:
+                        connection.execute('BEGIN')
+                        connection.executemany('INSERT INTO queries VALUES '
+                                               '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+            except sqlite3.Error as e:     # keep logging later queries
+                warn(f'QueryLog: {len(values)} queries not written: '
+                     f'{type(e).__name__}: {e}')
+            for _ in batch:
+                rows.task_done()
+            if batch[-1] is None:
+                return
+            if rows.empty():
+                self._plan_idle()
+
+    def _plan_idle(self):
+        try:
+            self.plan_shapes()
+        except sqlite3.Error as e:
+            warn(f'QueryLog: shapes not written: {type(e).__name__}: {e}')
+
+    def record(self, specs, gen_ms, dialect='MSSS', allow_coalesce=True, source='live',
+               exec_ms=None, n_rows=None, error=None):
+        """
+        Queue a query of `specs` (FieldSpecs, primary first), whose SQL took
+        `gen_ms` milliseconds to generate (or fetch, see `source`), and optionally
+        `exec_ms` to execute, returning `n_rows` rows. Returns its spec hash.
+        """
+        specs = [o if isinstance(o, FieldSpec) else o.to_spec() for o in specs]
+        key = spec_hash(specs, dialect, allow_coalesce)
+        if key not in self._known:
+            with self._lock:
+                self._known[key] = None
+                self._pending[key] = (specs, dialect, allow_coalesce)
+                if len(self._known) > self.max_shapes:
+                    self._known.popitem(last=False)
+        self._start().put((time.time(), key, json.dumps(_fields(specs)), dialect,
+                           int(bool(allow_coalesce)), source, gen_ms, exec_ms, n_rows,
+                           error))
+        return key
+
+    def flush(self):
+        """ Write the queued queries now, and wait until they are written """
+        if self._pid == os.getpid():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def plan_shapes(self):
+        """ Plan the shapes of the specs recorded (by this process) without one """
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        shapes = []
+        for key, (specs, dialect, allow_coalesce) in pending.items():
+            try:
+                stmt = build_statement(*specs, dialect=dialect,
+                                       allow_coalesce=allow_coalesce)
+                shapes.append((key, json.dumps(stmt.tables()), len(stmt.cte_names())))
+            except UNSUPPORTED_QUERY:
+                shapes.append((key, '[]', None))
+        if len(shapes) > 0:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany('INSERT OR IGNORE INTO shapes VALUES (?, ?, ?)',
+                                       shapes)
+
+    def _rows(self, columns, since):
+        self.flush()
+        return self._connect().execute(
+            f'SELECT {columns} FROM queries{_where(since)} ORDER BY rowid').fetchall()
+
+    def hottest_specs(self, n=10, since=None):
+        """
+        The `n` most frequent queries (logged at or after the unix time `since`):
+        a list of (spec hash, fields, count, mean generation ms, mean execution ms,
+        mean rows), most frequent first. The means ignore missing values.
+        """
+        self.flush()
+        rows = self._connect().execute(
+            f'SELECT spec_hash, MIN(fields), COUNT(*), AVG(gen_ms), AVG(exec_ms), '
+            f'AVG(n_rows) FROM queries{_where(since)} GROUP BY spec_hash '
+            f'ORDER BY COUNT(*) DESC, MIN(rowid) LIMIT {int(n)}').fetchall()
+        return [(key, json.loads(fields), *rest) for key, fields, *rest in rows]
+
+    def slowest_tables(self, n=10, since=None, by='exec_ms'):
+        """
+        The `n` tables whose queries are slowest on average, by execution (`by`:
+        'exec_ms') or generation ('gen_ms') time: a list of (table, queries, mean
+        ms, 95th percentile ms), slowest first. Queries without a time are ignored.
+        """
+        assert by in ('exec_ms', 'gen_ms'), "by must be 'exec_ms' or 'gen_ms'"
+        self.flush()
+        self.plan_shapes()
+        times = defaultdict(list)
+        for tables, ms in self._connect().execute(
+                f'SELECT s.tables, q.{by} FROM queries AS q JOIN shapes AS s '
+                f'ON s.spec_hash = q.spec_hash{_where(since)}'):
+            if ms is not None:
+                for table in json.loads(tables):
+                    times[table].append(ms)
+        out = [(table, len(t), sum(t) / len(t), _percentile(t, 0.95))
+               for table, t in times.items()]
+        return sorted(out, key=lambda x: -x[2])[:n]
+
+    def cache_potential(self, sizes=(16, 128, 1024), since=None):
+        """
+        The fraction of logged queries which a cache of the SQL (or results) of the
+        most recently used queries would have served, replaying the log. Returns
+        ({size: hit ratio}, number of queries, number of distinct specs), with hit
+        ratios for LRU caches of each of `sizes` and for an unbounded cache (None).
+        """
+        keys = [key for key, in self._rows('spec_hash', since)]
+        out = dict()
+        for size in [*sizes, None]:
+            cache, hits = OrderedDict(), 0
+            for key in keys:
+                if key in cache:
+                    hits += 1
+                    cache.move_to_end(key)
+                else:
+                    cache[key] = None
+                    if size is not None and len(cache) > size:
+                        cache.popitem(last=False)
+            out[size] = hits / len(keys) if len(keys) > 0 else 0.0
+        return out, len(keys), len(set(keys))
+
+    def close(self):
+        """ Write the queued queries and stop the writer """
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._writer.join()
+            self._pid = None
+        self.plan_shapes()
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,140 @@
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+from functools import lru_cache
+from .dbtree import DBMetadata, SchemaNode
+
+# Bump whenever the pickled classes (UserOption, SQLTemplate, ...) change shape.
+SNAPSHOT_VERSION = 2
+MAGIC = b'PYSQLGEN-SNAPSHOT\n'
+
+# A snapshot is a precompiled field catalog: the UserOptions (and anything else the
+# caller wishes, e.g. standard queries) pickled *after* construction, so that loading
+# skips the YAML/JSON parsing and the UserOption validation. The schema itself
+# (DBMetadata and its SchemaNodes) is not stored: references to it are pickled by id
+# and resolved against the live context on load. The snapshot is keyed by a hash of
+# the source files, of the schema and of the code of pysqlgen (whose classes are
+# pickled), and is ignored if any has changed.
+
+
+def schema_fingerprint(context):
+    """
+    A string describing everything in `context` which the field catalog depends on.
+    """
+    nodes = [(n.name, [p.name for p in n.parents], n.pk, n.fks, n.primary_date_field,
+              n.default_lkp, n.schema) for n in context.index.nodes]
+    return json.dumps([nodes, context.custom_tables, context.schema,
+                       context.AGGREGATIONS, context.TRANSFORMATIONS,
+                       context.coalesce_default, context.agg_alias_lkp],
+                      sort_keys=True, default=str)
+
+
+@lru_cache(maxsize=1)
+def code_digest():
+    """ Content hash of the modules of pysqlgen """
+    h = hashlib.sha256()
+    package = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(package)):
+        if name.endswith('.py'):
+            with open(os.path.join(package, name), 'rb') as f:
+                h.update(name.encode() + b'\0' + f.read() + b'\0')
+    return h.hexdigest()
+
+
+def source_digest(paths, context):
+    """
+    Content hash of the source files `paths`, the schema in `context` and the code
+    of pysqlgen.
+    """
+    h = hashlib.sha256(f'pysqlgen-snapshot-{SNAPSHOT_VERSION}:{code_digest()}'.encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        h.update(os.path.basename(path).encode() + b'\0' + data + b'\0')
+    h.update(schema_fingerprint(context).encode())
+    return h.hexdigest()
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, context):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.context = context
+
+    def persistent_id(self, obj):
+        if obj is self.context:
+            return ('context',)
+        if isinstance(obj, SchemaNode) and obj._index is self.context.index:
+            return ('node', obj._id)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, context):
+        super().__init__(file)
+        self.context = context
+
+    def persistent_load(self, pid):
+        if pid[0] == 'context':
+            return self.context
+        elif pid[0] == 'node':
+            return self.context.index.nodes[pid[1]]
+        raise pickle.UnpicklingError(f'Unknown persistent id: {pid}')
+
+
+def write_snapshot(filename, payload, digest, context):
+    """
+    Write `payload` to `filename` (atomically, so concurrent readers never see a
+    partial file).
+    """
+    assert isinstance(context, DBMetadata), "context is not a DBContext object"
+    buf = io.BytesIO()
+    _Pickler(buf, context).dump(payload)
+    header = json.dumps({'version': SNAPSHOT_VERSION, 'digest': digest}).encode()
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + header + b'\n' + buf.getvalue())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(filename, digest, context):
+    """
+    Load the payload from `filename`, or return None if the file is missing, or
+    was built from different sources (`digest`) or by a different version, or
+    cannot be loaded (e.g. truncated, or of classes which have since changed).
+    """
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            header = json.loads(f.readline())
+            if header.get('version') != SNAPSHOT_VERSION or header.get('digest') != digest:
+                return None
+            return _Unpickler(f, context).load()
+    except (OSError, EOFError, ValueError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        return None
+
+
+def load_or_build(filename, sources, context, build):
+    """
+    Return the snapshot payload in `filename` if it is up to date with `sources`
+    and `context`. Otherwise call `build()` for the payload and (try to) write it
+    to `filename` for next time.
+    """
+    digest = source_digest(sources, context)
+    payload = read_snapshot(filename, digest, context)
+    if payload is None:
+        payload = build()
+        try:
+            write_snapshot(filename, payload, digest, context)
+        except OSError:
+            pass    # e.g. read-only deployment: simply build every time.
+    return payload
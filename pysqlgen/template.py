@@ -0,0 +1,69 @@
+import re
+from functools import lru_cache
+
+_ALIAS_PLACEHOLDER = re.compile('{alias(:s)?}')
+
+
+class SQLTemplate:
+    """
+    SQLTemplate: a pre-parsed SQL fragment such as `"{alias:s}person_id"`. The
+    fragment is split once into the literal segments either side of the table
+    alias placeholders, so rendering it for a given alias is a single
+    `str.join`, and the alias-free field name is computed only once.
+
+    Templates are immutable and compare equal by their source string, so they
+    may be shared between UserOptions and used within cache keys.
+    """
+    __slots__ = ('source', 'segments', 'fieldname')
+
+    def __init__(self, source):
+        assert isinstance(source, str), "SQLTemplate source must be a string"
+        segments = _ALIAS_PLACEHOLDER.split(source)[::2]   # drop the `(:s)?` groups
+        segments = tuple(s.replace('{{', '{').replace('}}', '}') for s in segments)
+        object.__setattr__(self, 'source', source)
+        object.__setattr__(self, 'segments', segments)
+        object.__setattr__(self, 'fieldname', ''.join(segments))
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    @property
+    def has_alias(self):
+        return len(self.segments) > 1
+
+    def render(self, alias=''):
+        """
+        Substitute `alias` (e.g. 'p.', including the trailing '.') for every alias
+        placeholder in the template.
+        """
+        return alias.join(self.segments)
+
+    def __eq__(self, other):
+        return isinstance(other, SQLTemplate) and self.source == other.source
+
+    def __hash__(self):
+        return hash(self.source)
+
+    def __reduce__(self):
+        return compile_template, (self.source,)
+
+    def __repr__(self):
+        return f'SQLTemplate({self.source!r})'
+
+    def __str__(self):
+        return self.source
+
+
+@lru_cache(maxsize=None)
+def _compile(source):
+    return SQLTemplate(source)
+
+
+def compile_template(x):
+    """
+    Return the (shared) SQLTemplate for the string `x`. `None` and existing
+    SQLTemplates are passed through unchanged.
+    """
+    if x is None or isinstance(x, SQLTemplate):
+        return x
+    return _compile(x)
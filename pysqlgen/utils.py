@@ -5,7 +5,7 @@ from collections import OrderedDict
 
 
 def node_isin_context(x, context, allow_custom=False, allow_None=False):
-    if x in context.nodes:
+    if x in context:
         return True
     elif allow_None and x is None:
         return True
@@ -57,16 +57,25 @@ def not_none(*args):
     return next((el for el in args if el is not None), None)
 
 
-def get_nth_chunk(n, indexable, chunksizes):
-    chunk_start = sum(chunksizes[:n])
-    chunk_end = chunk_start + chunksizes[n]
-    return indexable[chunk_start:chunk_end]
-
-
 def rm_alias_placeholder(x):
     return re.sub('{alias(:s)?}', '', x)
 
 
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"[^"]*")""")
+
+
+def squash_whitespace(x):
+    """
+    Collapse each run of whitespace in the SQL `x` to a single space, except within
+    quoted literals/identifiers.
+    """
+    if '\n' not in x and '  ' not in x and '\t' not in x:
+        return x.strip()
+    parts = _QUOTED.split(x)
+    parts[::2] = [re.sub(r'\s+', ' ', p) for p in parts[::2]]
+    return ''.join(parts).strip()
+
+
 def cur_time_ms():
     return int(round(time.time() * 1000))
 